@@ -10,6 +10,7 @@ here = os.path.abspath(os.path.dirname(__file__))
 
 install_requires = ['mysql-connector-python',
                     'ldap3',
+                    'pyasn1',
                     'ruamel.yaml',
                     'requests']
 
@@ -7,7 +7,7 @@ Entrypoint
 from logging import getLogger, basicConfig
 from logging.config import dictConfig
 
-from synchromoodle import actions
+from synchromoodle import actions, dbutils
 from synchromoodle.arguments import parse_args
 from synchromoodle.config import ConfigLoader
 
@@ -56,6 +56,9 @@ def main():
             errors += 1
             log.error("Action invalide: %s", action)
             continue
+        if arguments.dry_run and action.type != 'default':
+            log.warning("Action ignorée en mode simulation: %s", action)
+            continue
         log.info("Démarrage de l'action %s", action)
         try:
             action_func(config, action, arguments)
@@ -64,6 +67,7 @@ def main():
             log.exception("Une erreur inattendue s'est produite")
         log.info("Fin de l'action %s", action)
 
+    dbutils.close_pools()
     log.info("Terminé")
     if errors:
         exit(errors)
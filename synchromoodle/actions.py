@@ -3,66 +3,445 @@
 Actions
 """
 
+import asyncio
+import datetime
+import json
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from logging import getLogger
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from typing import Any, Dict, Iterator, List, Tuple
 
-from synchromoodle.synchronizer import Synchronizer
-from synchromoodle.timestamp import TimestampStore
+from mysql.connector.errors import DatabaseError
+
+from synchromoodle.synchronizer import Synchronizer, ChangePlan, est_grp_etab
+from synchromoodle.timestamp import TimestampStore, SyncCookieStore, FingerprintStore
 from .arguments import DEFAULT_ARGS
-from .config import Config, ActionConfig
-from .dbutils import Database
-from .ldaputils import Ldap
+from .config import Config, ActionConfig, EtablissementsConfig
+from .dbutils import Database, close_pools
+from .ldaputils import Ldap, EtablissementsIndex
+from .snapshot import open_ldap, write_snapshot
+from .syncrepl import SyncResult
 
+# Nombre de tentatives de traitement d'un établissement en conflit de verrous: l'application des plans étant
+# sérialisée entre processus, ces conflits opposent un processus aux autres clients de la base (Moodle, cron)
+ETABLISSEMENT_ATTEMPTS = 3
 
-def default(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
+# Erreurs MySQL de conflit de verrous: délai d'attente dépassé, interblocage
+LOCK_ERRORS = (1205, 1213)
+
+# Délai maximal d'attente du verrou d'application des plans, en secondes. Ce verrou unique sérialise l'application
+# de tous les plans: seuls la lecture de l'annuaire et le calcul des plans sont parallèles entre processus
+APPLY_LOCK_TIMEOUT = 600
+
+
+def write_plan(path: str, plan: ChangePlan):
     """
-    Execute la mise à jour de la base de données Moodle à partir des informations du LDAP.
-    :param config: Configuration d'execution
-    :param action: Configuration de l'action
-    :param arguments: Arguments de ligne de commande
+    Ajoute le plan des modifications d'un établissement au format JSON lines.
+    :param path: chemin du fichier, ou - pour la sortie standard
+    :param plan: Plan des modifications
     """
-    log = getLogger()
+    line = json.dumps(plan.to_dict(), ensure_ascii=False) + '\n'
+    if path == '-':
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    else:
+        with open(path, 'a', encoding='utf-8') as plan_file:
+            plan_file.write(line)
+
+
+class EtablissementResult:
+    """
+    Résultat du traitement d'un établissement, enregistré par le processus principal: plan des modifications,
+    cookies de synchronisation incrémentale et empreintes des utilisateurs traités.
+    """
+
+    def __init__(self, uai: str, plan: ChangePlan):
+        self.uai = uai  # type: str
+        self.plan = plan  # type: ChangePlan
+        self.sync_cookies = []  # type: List[Tuple[str, bytes, Dict[str, str]]]
+        self.fingerprints = {}  # type: Dict[str, Dict[str, str]]
+
+
+def get_sync_cookies(sync_cookie_store: SyncCookieStore, uai: str) -> Dict[str, Tuple[bytes, Dict[str, str]]]:
+    """
+    :param sync_cookie_store: Stockage des cookies de synchronisation
+    :param uai: code établissement
+    :return: Cookie et uids connus des élèves et des enseignants d'un établissement, par clé
+    """
+    return {key: (sync_cookie_store.get_cookie(key), sync_cookie_store.get_uids(key))
+            for key in ('%s/eleves' % uai, '%s/enseignants' % uai)}
+
+
+def partition_etablissements(etablissements: EtablissementsConfig) -> List[List[str]]:
+    """
+    Répartit les établissements en lots traités chacun par un seul processus: les établissements d'un même
+    regroupement partagent une catégorie et ses cohortes, et sont donc traités ensemble.
+    :param etablissements: Configuration des établissements
+    :return: Lots de codes établissement
+    """
+    lots = OrderedDict()  # type: Dict[str, List[str]]
+    for uai in etablissements.listeEtab:
+        regroupement = est_grp_etab(uai, etablissements)
+        lots.setdefault(regroupement.nom if regroupement else uai, []).append(uai)
+    return list(lots.values())
+
 
+def fetch_sync_results(ldap: Ldap, uai: str, sync_cookies: Dict[str, Tuple[bytes, Dict[str, str]]]) \
+        -> Tuple[SyncResult, SyncResult]:
+    """
+    Recherche dans l'annuaire les élèves et enseignants d'un établissement modifiés ou supprimés depuis les cookies de
+    synchronisation.
+    :param ldap: Couche d'accès aux données du LDAP
+    :param uai: code établissement
+    :param sync_cookies: cookies et uids connus de la synchronisation incrémentale, par clé
+    :return: résultats de la synchronisation des élèves et des enseignants
+    """
+    return (ldap.sync_eleve(uai, sync_cookies['%s/eleves' % uai][0]),
+            ldap.sync_enseignant(uai, sync_cookies['%s/enseignants' % uai][0]))
+
+
+def sync_etablissement(synchronizer: Synchronizer, ldap: Ldap, db: Database, uai: str,
+                       since_timestamp: datetime.datetime = None,
+                       sync_cookies: Dict[str, Tuple[bytes, Dict[str, str]]] = None,
+                       fingerprint_store: FingerprintStore = None, apply_lock: str = None,
+                       sync_results: Tuple[SyncResult, SyncResult] = None, log=getLogger()) -> EtablissementResult:
+    """
+    Synchronise un établissement: les utilisateurs sont lus et le plan des modifications calculé sans aucune écriture,
+    puis le plan est appliqué dans une transaction validée à la fin du traitement. En mode simulation, il est renvoyé
+    sans être appliqué.
+    :param synchronizer: Synchroniseur
+    :param ldap: Couche d'accès aux données du LDAP
+    :param db: Couche d'accès à la base de données Moodle
+    :param uai: code établissement
+    :param since_timestamp: date de dernier traitement
+    :param sync_cookies: cookies et uids connus de la synchronisation incrémentale, par clé, None pour une
+    synchronisation par date de dernier traitement
+    :param fingerprint_store: Stockage des empreintes des utilisateurs
+    :param apply_lock: nom du verrou MySQL sérialisant l'application des plans entre processus
+    :param sync_results: résultats de la synchronisation incrémentale des élèves et des enseignants, s'ils ont déjà
+    été lus par fetch_sync_results
+    :param log:
+    :return: Résultat du traitement de l'établissement
+    """
+    etablissement_log = log.getChild('etablissement.%s' % uai)
+
+    etablissement_log.info('Traitement de l\'établissement (uai=%s)' % uai)
+    etablissement_context = synchronizer.handle_etablissement(uai, log=etablissement_log)
+    result = EtablissementResult(uai, etablissement_context.plan)
+
+    # Etat de la synchronisation incrémentale, utilisé après l'application du plan
+    eleves_key = enseignants_key = None  # type: str
+    eleves_uids = enseignants_uids = None  # type: Dict[str, str]
+    sync_eleves = sync_enseignants = None  # type: SyncResult
+    if sync_cookies is not None:
+        # Synchronisation incrémentale: seules les entrées modifiées ou supprimées sont renvoyées
+        eleves_key, enseignants_key = '%s/eleves' % uai, '%s/enseignants' % uai
+        eleves_uids, enseignants_uids = sync_cookies[eleves_key][1], sync_cookies[enseignants_key][1]
+        sync_eleves, sync_enseignants = sync_results or fetch_sync_results(ldap, uai, sync_cookies)
+        eleves = [eleve for _, eleve in sync_eleves.changed]
+        enseignants = [enseignant for _, enseignant in sync_enseignants.changed]
+    else:
+        eleves = synchronizer.get_eleves(uai, since_timestamp)
+        enseignants = synchronizer.get_enseignants(uai, since_timestamp)
+
+    etablissement_log.info('Traitement des élèves pour l\'établissement (uai=%s)' % uai)
+    for eleve in eleves:
+        utilisateur_log = etablissement_log.getChild("utilisateur.%s" % eleve.uid)
+        utilisateur_log.info("Traitement de l'élève (uid=%s)" % eleve.uid)
+        synchronizer.handle_eleve(etablissement_context, eleve, log=utilisateur_log)
+
+    etablissement_log.info("Traitement du personnel enseignant pour l'établissement (uai=%s)" % uai)
+    for enseignant in enseignants:
+        utilisateur_log = etablissement_log.getChild("enseignant.%s" % enseignant.uid)
+        utilisateur_log.info("Traitement de l'enseignant (uid=%s)" % enseignant.uid)
+        synchronizer.handle_enseignant(etablissement_context, enseignant, log=utilisateur_log)
+
+    if apply_lock and not db.get_lock(apply_lock, APPLY_LOCK_TIMEOUT):
+        raise RuntimeError("Verrou %s non obtenu après %d secondes" % (apply_lock, APPLY_LOCK_TIMEOUT))
+    try:
+        if apply_lock:
+            # Le calcul du plan n'a rien écrit: sa transaction est terminée afin que les lectures de l'application du
+            # plan ne se fassent pas sur l'instantané REPEATABLE READ pris avant le verrou, mais voient les plans
+            # validés par les autres processus pendant l'attente
+            db.commit()
+        etablissement_log.info("Application du plan de l'établissement (uai=%s)" % uai)
+        synchronizer.apply_plan(etablissement_context, log=etablissement_log)
+
+        # La suppression des utilisateurs passe par le webservice: elle n'est pas simulée
+        if sync_cookies is not None and not synchronizer.dry_run:
+            etablissement_log.info("Traitement des utilisateurs supprimés de l'établissement (uai=%s)" % uai)
+            deleted_uids = sync_eleves.deleted_uids(eleves_uids) | sync_enseignants.deleted_uids(enseignants_uids)
+            synchronizer.handle_deleted_users(deleted_uids, log=etablissement_log)
+
+        if synchronizer.dry_run:
+            # Simulation: le plan est renvoyé sans avoir été appliqué, la transaction de lecture est terminée
+            etablissement_log.info("Plan de l'établissement (uai=%s): %s", uai,
+                                   dict(etablissement_context.plan.counts()))
+            db.rollback()
+            return result
+
+        db.commit()
+    finally:
+        if apply_lock:
+            db.release_lock(apply_lock)
+
+    if sync_cookies is not None:
+        result.sync_cookies = [
+            (eleves_key, sync_eleves.cookie, sync_eleves.known_uids(eleves_uids)),
+            (enseignants_key, sync_enseignants.cookie, sync_enseignants.known_uids(enseignants_uids))]
+    else:
+        synchronizer.context.etablissements_index.release(uai)
+    if fingerprint_store:
+        result.fingerprints = fingerprint_store.take(uai)
+    return result
+
+
+def _sync_etablissements_sequential(config: Config, action: ActionConfig, arguments,
+                                    since_timestamps: Dict[str, datetime.datetime],
+                                    sync_cookie_store: SyncCookieStore, fingerprint_store: FingerprintStore,
+                                    log=getLogger()) -> Iterator[EtablissementResult]:
     db = Database(config.database, config.constantes)
-    ldap = Ldap(config.ldap)
+    ldap = open_ldap(config.ldap)
     try:
         db.connect()
         ldap.connect()
 
-        synchronizer = Synchronizer(ldap, db, config, action, arguments)
+        synchronizer = Synchronizer(ldap, db, config, action, arguments, fingerprint_store)
         synchronizer.initialize()
 
-        timestamp_store = TimestampStore(action.timestamp_store)
+        if not sync_cookie_store:
+            log.info('Préchargement des données LDAP des établissements')
+            synchronizer.prefetch(action.etablissements.listeEtab, since_timestamps, log=log)
 
-        log.info('Traitement des établissements')
         for uai in action.etablissements.listeEtab:
-            etablissement_log = log.getChild('etablissement.%s' % uai)
+            yield sync_etablissement(synchronizer, ldap, db, uai, since_timestamps[uai],
+                                     get_sync_cookies(sync_cookie_store, uai) if sync_cookie_store else None,
+                                     fingerprint_store, log=log)
+    finally:
+        db.disconnect()
+        ldap.disconnect()
 
-            etablissement_log.info('Traitement de l\'établissement (uai=%s)' % uai)
-            etablissement_context = synchronizer.handle_etablissement(uai, log=etablissement_log)
 
-            etablissement_log.info('Traitement des élèves pour l\'établissement (uai=%s)' % uai)
-            since_timestamp = timestamp_store.get_timestamp(uai)
+# Etat d'un processus de traitement des établissements, initialisé par _init_worker
+_WORKER = {}  # type: Dict[str, Any]
 
-            for eleve in ldap.search_eleve(since_timestamp, uai):
-                utilisateur_log = etablissement_log.getChild("utilisateur.%s" % eleve.uid)
-                utilisateur_log.info("Traitement de l'élève (uid=%s)" % eleve.uid)
-                synchronizer.handle_eleve(etablissement_context, eleve, log=utilisateur_log)
 
-            etablissement_log.info("Traitement du personnel enseignant pour l'établissement (uai=%s)" % uai)
-            for enseignant in ldap.search_enseignant(since_timestamp=since_timestamp, uai=uai):
-                utilisateur_log = etablissement_log.getChild("enseignant.%s" % enseignant.uid)
-                utilisateur_log.info("Traitement de l'enseignant (uid=%s)" % enseignant.uid)
-                synchronizer.handle_enseignant(etablissement_context, enseignant, log=utilisateur_log)
+def _init_worker(config: Config, action: ActionConfig, arguments):
+    db = Database(config.database, config.constantes)
+    ldap = open_ldap(config.ldap)
+    fingerprint_store = FingerprintStore(action.fingerprint_store) if action.fingerprint_store.enabled else None
+    Finalize(None, _close_worker, args=(db, ldap, fingerprint_store), exitpriority=10)
+    db.connect()
+    ldap.connect()
 
-            db.connection.commit()
+    synchronizer = Synchronizer(ldap, db, config, action, arguments, fingerprint_store)
+    synchronizer.initialize()
+    _WORKER.update(synchronizer=synchronizer, ldap=ldap, db=db, fingerprint_store=fingerprint_store,
+                   apply_lock="synchromoodle.%s.%s" % (config.database.database, config.database.entete))
 
-            timestamp_store.mark(uai)
-            timestamp_store.write()
 
-        log.info("Fin du traitement des établissements")
+def _close_worker(db: Database, ldap: Ldap, fingerprint_store: FingerprintStore):
+    db.disconnect()
+    ldap.disconnect()
+    if fingerprint_store:
+        fingerprint_store.close()
+
+
+def _run_worker_task(task: Tuple[List[str], Dict[str, datetime.datetime],
+                                 Dict[str, Dict[str, Tuple[bytes, Dict[str, str]]]]]) -> List[EtablissementResult]:
+    uais, since_timestamps, sync_cookies = task
+    synchronizer, ldap, db = _WORKER['synchronizer'], _WORKER['ldap'], _WORKER['db']
+    log = getLogger()
+    if sync_cookies is None:
+        synchronizer.prefetch(uais, since_timestamps, log=log)
+
+    results = []
+    for uai in uais:
+        for attempt in range(1, ETABLISSEMENT_ATTEMPTS + 1):
+            try:
+                results.append(sync_etablissement(synchronizer, ldap, db, uai, since_timestamps[uai],
+                                                  sync_cookies[uai] if sync_cookies is not None else None,
+                                                  _WORKER['fingerprint_store'], _WORKER['apply_lock'], log=log))
+                break
+            except DatabaseError as e:
+                # Conflit de verrous avec un autre client de la base: l'établissement est traité à nouveau
+                if e.errno not in LOCK_ERRORS or attempt == ETABLISSEMENT_ATTEMPTS:
+                    raise
+                log.warning("Conflit de verrous pour l'établissement %s (tentative %d/%d): %s",
+                            uai, attempt, ETABLISSEMENT_ATTEMPTS, e)
+                db.rollback()
+                # Les empreintes mises en attente par la tentative annulée ne doivent pas être enregistrées
+                if _WORKER['fingerprint_store']:
+                    _WORKER['fingerprint_store'].take(uai)
+                if sync_cookies is None:
+                    synchronizer.ensure_prefetched(uai, since_timestamps[uai], log=log)
+    return results
+
+
+def _sync_etablissements_parallel(config: Config, action: ActionConfig, arguments,
+                                  since_timestamps: Dict[str, datetime.datetime],
+                                  sync_cookie_store: SyncCookieStore, workers: int,
+                                  log=getLogger()) -> Iterator[EtablissementResult]:
+    # Les données partagées (catégories inter-établissements, champs de profil) sont créées une seule fois, avant les
+    # processus de traitement. Les connexions sont fermées pour ne pas être partagées avec ces processus.
+    db = Database(config.database, config.constantes)
+    ldap = open_ldap(config.ldap)
+    try:
+        db.connect()
+        ldap.connect()
+        Synchronizer(ldap, db, config, action, arguments).initialize()
+        if not getattr(arguments, 'dry_run', None):
+            db.commit()
+    finally:
+        db.disconnect()
+        ldap.disconnect()
+        close_pools()
+
+    tasks = [(uais, {uai: since_timestamps[uai] for uai in uais},
+              {uai: get_sync_cookies(sync_cookie_store, uai) for uai in uais} if sync_cookie_store else None)
+             for uais in partition_etablissements(action.etablissements)]
+    log.info("Traitement de %d lot(s) d'établissements par %d processus", len(tasks), workers)
+    with Pool(workers, initializer=_init_worker, initargs=(config, action, arguments)) as pool:
+        for results in pool.imap_unordered(_run_worker_task, tasks):
+            yield from results
+
+
+async def _fetch_etablissements(loop: asyncio.AbstractEventLoop, executor: ThreadPoolExecutor, ldap: Ldap,
+                                lots: List[List[str]], since_timestamps: Dict[str, datetime.datetime],
+                                sync_cookie_store: SyncCookieStore, queue: asyncio.Queue):
+    for uais in lots:
+        if sync_cookie_store:
+            index = None
+            sync_results = {}
+            for uai in uais:
+                sync_results[uai] = await loop.run_in_executor(
+                    executor, fetch_sync_results, ldap, uai, get_sync_cookies(sync_cookie_store, uai))
+        else:
+            index = await loop.run_in_executor(executor, ldap.prefetch, uais, since_timestamps)
+            sync_results = None
+        # Bloque tant que la file contient le nombre de lots lus en avance autorisé
+        await queue.put((uais, index, sync_results))
+
+
+async def _next_lot(queue: asyncio.Queue, producer: asyncio.Future) -> Tuple[List[str], EtablissementsIndex,
+                                                                              Dict[str, Tuple[SyncResult, SyncResult]]]:
+    getter = asyncio.ensure_future(queue.get())
+    await asyncio.wait([getter, producer], return_when=asyncio.FIRST_COMPLETED)
+    if getter.done():
+        return getter.result()
+    getter.cancel()
+    # La lecture du LDAP a échoué: son erreur est propagée
+    producer.result()
+    raise RuntimeError("La lecture des établissements s'est terminée prématurément")
+
+
+def _sync_etablissements_pipelined(config: Config, action: ActionConfig, arguments,
+                                   since_timestamps: Dict[str, datetime.datetime],
+                                   sync_cookie_store: SyncCookieStore, fingerprint_store: FingerprintStore,
+                                   log=getLogger()) -> Iterator[EtablissementResult]:
+    # La lecture du LDAP d'un lot d'établissements et l'application en base du lot précédent s'exécutent chacune dans
+    # son propre thread, avec ses propres connexions, orchestrées par une boucle asyncio et une file bornée.
+    db = Database(config.database, config.constantes)
+    ldap = open_ldap(config.ldap)
+    fetch_ldap = open_ldap(config.ldap)
+    fetch_executor = ThreadPoolExecutor(max_workers=1)
+    apply_executor = ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    producer = None
+    try:
+        db.connect()
+        ldap.connect()
+        fetch_ldap.connect()
+
+        synchronizer = Synchronizer(ldap, db, config, action, arguments, fingerprint_store)
+        synchronizer.initialize()
+
+        uais = action.etablissements.listeEtab
+        size = config.ldap.prefetch_batch_size if not sync_cookie_store else 1
+        lots = [uais[i:i + size] for i in range(0, len(uais), size)] if size and size > 0 else [uais]
+        queue = asyncio.Queue(maxsize=action.pipeline)
+        producer = asyncio.ensure_future(_fetch_etablissements(loop, fetch_executor, fetch_ldap, lots, since_timestamps,
+                                                               sync_cookie_store, queue))
+        log.info("Traitement de %d lot(s) d'établissements, dont %d lu(s) en avance", len(lots), action.pipeline)
+        for _ in lots:
+            lot_uais, index, sync_results = loop.run_until_complete(_next_lot(queue, producer))
+            if index is not None:
+                synchronizer.context.etablissements_index = index
+            for uai in lot_uais:
+                yield loop.run_until_complete(loop.run_in_executor(apply_executor, partial(
+                    sync_etablissement, synchronizer, ldap, db, uai, since_timestamps[uai],
+                    get_sync_cookies(sync_cookie_store, uai) if sync_cookie_store else None, fingerprint_store,
+                    sync_results=sync_results[uai] if sync_results is not None else None, log=log)))
+        loop.run_until_complete(producer)
     finally:
+        if producer is not None and not producer.done():
+            producer.cancel()
+            loop.run_until_complete(asyncio.wait([producer]))
+        fetch_executor.shutdown()
+        apply_executor.shutdown()
+        loop.close()
+        asyncio.set_event_loop(None)
         db.disconnect()
         ldap.disconnect()
+        fetch_ldap.disconnect()
+
+
+def default(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
+    """
+    Execute la mise à jour de la base de données Moodle à partir des informations du LDAP.
+    Les établissements peuvent être répartis entre plusieurs processus, chacun disposant de ses propres connexions:
+    le processus principal est alors le seul à enregistrer les timestamps, cookies et empreintes. Dans un seul
+    processus, la lecture du LDAP des établissements suivants peut se poursuivre pendant l'application des précédents.
+    :param config: Configuration d'execution
+    :param action: Configuration de l'action
+    :param arguments: Arguments de ligne de commande
+    """
+    log = getLogger()
+
+    timestamp_store = TimestampStore(action.timestamp_store)
+    sync_cookie_store = SyncCookieStore(action.sync_cookie_store) if action.sync_cookie_store.enabled else None
+    fingerprint_store = FingerprintStore(action.fingerprint_store) if action.fingerprint_store.enabled else None
+    dry_run = getattr(arguments, 'dry_run', None)
+
+    since_timestamps = {uai: timestamp_store.get_timestamp(uai) for uai in action.etablissements.listeEtab}
+    workers = min(getattr(arguments, 'workers', None) or action.workers, len(action.etablissements.listeEtab))
+    try:
+        log.info('Traitement des établissements')
+        if workers > 1:
+            results = _sync_etablissements_parallel(config, action, arguments, since_timestamps, sync_cookie_store,
+                                                    workers, log=log)
+        elif action.pipeline:
+            results = _sync_etablissements_pipelined(config, action, arguments, since_timestamps, sync_cookie_store,
+                                                     fingerprint_store, log=log)
+        else:
+            results = _sync_etablissements_sequential(config, action, arguments, since_timestamps, sync_cookie_store,
+                                                      fingerprint_store, log=log)
+        for result in results:
+            if dry_run:
+                write_plan(dry_run, result.plan)
+                continue
+
+            if fingerprint_store:
+                fingerprint_store.mark(result.uai, result.fingerprints)
+                fingerprint_store.write()
+
+            if sync_cookie_store:
+                for key, cookie, uids in result.sync_cookies:
+                    sync_cookie_store.mark(key, cookie, uids)
+                sync_cookie_store.write()
+            else:
+                timestamp_store.mark(result.uai)
+                timestamp_store.write()
+
+        log.info("Fin du traitement des établissements")
+    finally:
+        if fingerprint_store:
+            fingerprint_store.close()
 
 
 def interetab(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
@@ -77,7 +456,7 @@ def interetab(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
     log = getLogger()
 
     db = Database(config.database, config.constantes)
-    ldap = Ldap(config.ldap)
+    ldap = open_ldap(config.ldap)
     try:
         db.connect()
         ldap.connect()
@@ -99,12 +478,15 @@ def interetab(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
             utilisateur_log.info("Traitement de l'utilisateur (uid=%s)" % personne_ldap.uid)
             synchronizer.handle_user_interetab(personne_ldap, log=utilisateur_log)
 
+        log.info('Mise à jour des administrateurs inter-établissements')
+        synchronizer.handle_admins_interetab(log=log)
+
         log.info('Mise à jour des cohortes de la categorie inter-établissements')
 
         for is_member_of, cohort_name in action.inter_etablissements.cohorts.items():
             synchronizer.mise_a_jour_cohorte_interetab(is_member_of, cohort_name, since_timestamp, log=log)
 
-        db.connection.commit()
+        db.commit()
 
         timestamp_store.mark(action.inter_etablissements.cle_timestamp)
         timestamp_store.write()
@@ -127,7 +509,7 @@ def inspecteurs(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
     log = getLogger()
 
     db = Database(config.database, config.constantes)
-    ldap = Ldap(config.ldap)
+    ldap = open_ldap(config.ldap)
     try:
         db.connect()
         ldap.connect()
@@ -149,7 +531,7 @@ def inspecteurs(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
             utilisateur_log.info("Traitement de l'inspecteur (uid=%s)" % personne_ldap.uid)
             synchronizer.handle_inspecteur(personne_ldap)
 
-        db.connection.commit()
+        db.commit()
 
         # Mise a jour de la date de dernier traitement
         timestamp_store.mark(action.inspecteurs.cle_timestamp)
@@ -173,7 +555,7 @@ def nettoyage(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
     log = getLogger()
 
     db = Database(config.database, config.constantes)
-    ldap = Ldap(config.ldap)
+    ldap = open_ldap(config.ldap)
     try:
         db.connect()
         ldap.connect()
@@ -188,21 +570,26 @@ def nettoyage(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
             etablissement_log.info("Nettoyage de l'établissement (uai=%s)" % uai)
             etablissement_context = synchronizer.handle_etablissement(uai, log=etablissement_log, readonly=True)
 
+            # Une seule lecture de l'annuaire par établissement pour l'ensemble des cohortes
+            classes_index = synchronizer.get_classes_index(etablissement_context)
+
             eleves_by_cohorts_db, eleves_by_cohorts_ldap = synchronizer.\
                 get_users_by_cohorts_comparators(etablissement_context, r'(Élèves de la Classe )(.*)$',
-                                                 'Élèves de la Classe %')
+                                                 'Élèves de la Classe %', classes_index.eleves_by_classe)
 
             eleves_lvformation_by_cohorts_db, eleves_lvformation_by_cohorts_ldap = synchronizer.\
                 get_users_by_cohorts_comparators(etablissement_context, r'(Élèves du Niveau de formation )(.*)$',
-                                                 'Élèves du Niveau de formation %')
+                                                 'Élèves du Niveau de formation %',
+                                                 classes_index.eleves_by_niveau_formation)
 
             profs_classe_by_cohorts_db, profs_classe_by_cohorts_ldap = synchronizer.\
                 get_users_by_cohorts_comparators(etablissement_context, r'(Profs de la Classe )(.*)$',
-                                                 'Profs de la Classe %')
+                                                 'Profs de la Classe %', classes_index.enseignants_by_classe)
 
             profs_etab_by_cohorts_db, profs_etab_by_cohorts_ldap = synchronizer.\
                 get_users_by_cohorts_comparators(etablissement_context, r"(Profs de l'établissement )(.*)$",
-                                                 "Profs de l'établissement %")
+                                                 "Profs de l'établissement %",
+                                                 {'(%s)' % etablissement_context.uai: classes_index.enseignants})
 
             log.info("Purge des cohortes Elèves de la Classe")
             synchronizer.purge_cohorts(eleves_by_cohorts_db, eleves_by_cohorts_ldap,
@@ -224,16 +611,55 @@ def nettoyage(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):
             db.delete_empty_cohorts()
 
         # Premier commit pour libérer les locks pour le webservice moodle
-        db.connection.commit()
+        db.commit()
         log.info("Début de la procédure d'anonymisation/suppression des utilisateurs inutiles")
-        ldap_users = ldap.search_personne()
-        db_valid_users = db.get_all_valid_users()
-        synchronizer.anonymize_or_delete_users(ldap_users, db_valid_users)
+        # Les uid de l'annuaire sont lus au fil de l'eau, sans conserver les personnes
+        ldap_users = ldap.search_personne(profil='uid-only')
+        if config.database.staging:
+            # Seuls les utilisateurs absents de l'annuaire sont lus, par jointure sur une table temporaire
+            db_absent_users = db.get_valid_users_absent_from(ldap_user.uid for ldap_user in ldap_users)
+            synchronizer.anonymize_or_delete_users([], db_absent_users)
+        else:
+            synchronizer.anonymize_or_delete_users(ldap_users, db.iter_all_valid_users())
         db.delete_useless_users()
 
-        db.connection.commit()
+        db.commit()
 
         log.info("Fin d'action de nettoyage")
     finally:
         db.disconnect()
         ldap.disconnect()
+
+
+def snapshot(config: Config, action: ActionConfig, arguments=DEFAULT_ARGS):  # pylint: disable=unused-argument
+    """
+    Exporte dans un instantané les données du LDAP consommées par la synchronisation des établissements, des
+    utilisateurs inter-établissements et des inspecteurs. L'instantané peut ensuite être rejoué sans annuaire via
+    la propriété snapshot de la configuration ldap.
+    :param config: Configuration globale
+    :param action: Configuration de l'action
+    :param arguments: Arguments de ligne de commande
+    """
+    log = getLogger()
+
+    ldap = Ldap(config.ldap)
+    try:
+        ldap.connect()
+
+        filters = {}
+        for attribute, values in [
+                (action.inter_etablissements.ldap_attribut_user,
+                 action.inter_etablissements.ldap_valeur_attribut_user),
+                (action.inter_etablissements.ldap_attribut_user, list(action.inter_etablissements.cohorts.keys())),
+                (action.inspecteurs.ldap_attribut_user, action.inspecteurs.ldap_valeur_attribut_user)]:
+            attribute_values = filters.setdefault(attribute, [])
+            for value in [values] if isinstance(values, str) else values:
+                if value not in attribute_values:
+                    attribute_values.append(value)
+
+        log.info("Export de l'instantané LDAP (fichier=%s)", action.snapshot.file)
+        count = write_snapshot(action.snapshot.file,
+                               ldap.dump(action.etablissements.listeEtab, action.snapshot.personnes, **filters))
+        log.info("Fin de l'export de l'instantané LDAP (%s entrées)", count)
+    finally:
+        ldap.disconnect()
@@ -19,6 +19,13 @@ def parse_args(args=None, namespace=None):
     parser.add_argument("-c", "--config", action="append", dest="config", default=[],
                         help="Chemin vers un fichier de configuration. Lorsque cette option est utilisée plusieurs "
                              "fois, les fichiers de configuration sont alors fusionnés.")
+    parser.add_argument("--dry-run", nargs="?", const="-", dest="dry_run", metavar="FICHIER",
+                        help="Mode simulation: le plan des modifications de chaque établissement est calculé puis "
+                             "écrit au format JSON lines dans le fichier donné (sortie standard par défaut), sans être "
+                             "appliqué. Seule l'action default est exécutée.")
+    parser.add_argument("--workers", type=int, dest="workers", metavar="N",
+                        help="Nombre de processus traitant les établissements en parallèle pour l'action default. "
+                             "Remplace la valeur workers de la configuration des actions.")
 
     arguments = parser.parse_args(args, namespace)
     return arguments
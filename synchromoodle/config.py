@@ -177,6 +177,24 @@ class DatabaseConfig(_BaseConfig):
         self.charset = "utf8"  # type: str
         """Charset à utiliser pour la connexion"""
 
+        self.batch_size = 0  # type: int
+        """Taille des lots d'écritures (0 pour désactiver)"""
+
+        self.prepared = True  # type: bool
+        """Prépare côté serveur les requêtes fréquentes"""
+
+        self.pool_size = 0  # type: int
+        """Taille du pool de connexions (0 pour désactiver)"""
+
+        self.pool_reset = True  # type: bool
+        """Réinitialise les connexions rendues au pool"""
+
+        self.staging = 0  # type: int
+        """Seuil des tables temporaires (0 pour désactiver)"""
+
+        self.infile = False  # type: bool
+        """Charge les tables temporaires via LOAD DATA"""
+
         super().__init__(**entries)
 
 
@@ -210,6 +228,24 @@ class LdapConfig(_BaseConfig):
         self.adminRDN = "ou=administrateurs"  # type: str
         """OU pour les administrateurs"""
 
+        self.page_size = 500  # type: int
+        """Nombre d'entrées par page pour les recherches paginées (0 pour désactiver la pagination)"""
+
+        self.prefetch_batch_size = 50  # type: int
+        """Nombre d'établissements regroupés dans une même recherche lors du préchargement (0 pour un seul lot)"""
+
+        self.pool_size = 1  # type: int
+        """Nombre de connexions exécutant en parallèle les recherches du préchargement (1 pour désactiver)"""
+
+        self.structures_cache = True  # type: bool
+        """Conserve les structures en mémoire pour toutes les actions d'une même exécution"""
+
+        self.structures_ttl = 0  # type: int
+        """Durée de vie en secondes du cache des structures (0 pour aucune expiration)"""
+
+        self.snapshot = None  # type: str
+        """Instantané LDAP rejoué à la place de l'annuaire (action snapshot)"""
+
         super().__init__(**entries)
 
     @property
@@ -356,6 +392,51 @@ class TimestampStoreConfig(_BaseConfig):
         super().__init__(**entries)
 
 
+class SyncCookieStoreConfig(_BaseConfig):
+    """
+    Configuration des cookies de synchronisation incrémentale LDAP (RFC 4533)
+    """
+
+    def __init__(self, **entries):
+        self.enabled = False  # type: bool
+        """Active la synchronisation incrémentale par cookie (syncrepl) à la place des timestamps"""
+
+        self.file = "sync_cookies.json"  # type: str
+        """Fichier contenant les cookies de synchronisation et les uid connus des établissements"""
+
+        super().__init__(**entries)
+
+
+class FingerprintStoreConfig(_BaseConfig):
+    """
+    Configuration des empreintes des utilisateurs synchronisés
+    """
+
+    def __init__(self, **entries):
+        self.enabled = False  # type: bool
+        """Ignore les utilisateurs dont l'empreinte est inchangée depuis la synchronisation précédente"""
+
+        self.file = "fingerprints.sqlite"  # type: str
+        """Base SQLite contenant les empreintes des utilisateurs, par établissement"""
+
+        super().__init__(**entries)
+
+
+class SnapshotConfig(_BaseConfig):
+    """
+    Configuration de l'export d'un instantané LDAP
+    """
+
+    def __init__(self, **entries):
+        self.file = "ldap-snapshot.jsonl.gz"  # type: str
+        """Fichier de l'instantané (compressé si son nom se termine par .gz)"""
+
+        self.personnes = False  # type: bool
+        """Exporte l'ensemble des personnes, nécessaire pour rejouer l'action nettoyage"""
+
+        super().__init__(**entries)
+
+
 class ActionConfig(_BaseConfig):
     """
     Configuration d'une action
@@ -365,9 +446,14 @@ class ActionConfig(_BaseConfig):
         self.id = None
         self.type = "default"
         self.timestamp_store = TimestampStoreConfig()  # type: TimestampStoreConfig
+        self.sync_cookie_store = SyncCookieStoreConfig()  # type: SyncCookieStoreConfig
+        self.fingerprint_store = FingerprintStoreConfig()  # type: FingerprintStoreConfig
+        self.snapshot = SnapshotConfig()  # type: SnapshotConfig
         self.etablissements = EtablissementsConfig()  # type: EtablissementsConfig
         self.inter_etablissements = InterEtablissementsConfig()  # type: InterEtablissementsConfig
         self.inspecteurs = InspecteursConfig()  # type: InspecteursConfig
+        self.workers = 1  # type: int
+        self.pipeline = 0  # type: int
 
         super().__init__(**entries)
 
@@ -384,6 +470,15 @@ class ActionConfig(_BaseConfig):
         if 'timestampStore' in entries:
             self.timestamp_store.update(**entries['timestampStore'])
             entries['timestampStore'] = self.timestamp_store
+        if 'syncCookieStore' in entries:
+            self.sync_cookie_store.update(**entries['syncCookieStore'])
+            entries['syncCookieStore'] = self.sync_cookie_store
+        if 'fingerprintStore' in entries:
+            self.fingerprint_store.update(**entries['fingerprintStore'])
+            entries['fingerprintStore'] = self.fingerprint_store
+        if 'snapshot' in entries:
+            self.snapshot.update(**entries['snapshot'])
+            entries['snapshot'] = self.snapshot
 
         super().update(**entries)
 
@@ -4,9 +4,17 @@
 Accès à la base de données Moodle
 """
 
+import os
+import re
+import tempfile
+import threading
+from typing import Dict, List, Tuple, Iterator, Callable
+
 import mysql.connector
 from mysql.connector import MySQLConnection
 from mysql.connector.cursor import MySQLCursor
+from mysql.connector.errors import PoolError
+from mysql.connector.pooling import MySQLConnectionPool
 
 from synchromoodle.config import DatabaseConfig, ConstantesConfig
 
@@ -113,6 +121,260 @@ def array_to_safe_sql_list(elements, name=None):
     return ','.join(format_strings), params
 
 
+# Requêtes d'écriture pouvant être différées par BatchCursor
+WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE)\s', re.IGNORECASE)
+
+
+def rows_to_safe_sql_values(rows, names):
+    """
+    Construit une liste de n-uplets SQL paramétrés: (%(a_0)s, %(b_0)s), (%(a_1)s, %(b_1)s), ...
+    :param rows:
+    :param names:
+    :return:
+    """
+    values = []
+    params = {}
+    for i, row in enumerate(rows):
+        format_strings = []
+        for name, element in zip(names, row):
+            format_strings.append('%({name}_{i})s'.format(name=name, i=i))
+            params['{name}_{i}'.format(name=name, i=i)] = element
+        values.append('(' + ', '.join(format_strings) + ')')
+    return ', '.join(values), params
+
+
+class BatchCursor:
+    """
+    Curseur différant les écritures (INSERT, UPDATE, DELETE).
+
+    Les écritures consécutives de même forme sont regroupées et exécutées via executemany, qui produit un seul
+    INSERT multi-lignes. Elles sont exécutées dans leur ordre d'origine dès que le nombre d'écritures en attente
+    atteint batch_size, avant toute autre requête (lecture) et avant tout accès à un attribut du curseur. La dernière
+    écriture est exécutée seule avant la lecture de lastrowid, qui serait sinon l'id de la première ligne d'un INSERT
+    multi-lignes.
+    """
+
+    def __init__(self, cursor: MySQLCursor, batch_size: int):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self._pending = []  # type: List[Tuple[str, List[dict]]]
+        self._count = 0
+
+    def execute(self, operation, params=None, multi=False):
+        """
+        Exécute une requête, ou la met en attente s'il s'agit d'une écriture.
+        :param operation:
+        :param params:
+        :param multi:
+        :return:
+        """
+        if multi or not WRITE_STATEMENT.match(operation):
+            self.flush()
+            return self.cursor.execute(operation, params=params, multi=multi)
+        if self._pending and self._pending[-1][0] == operation:
+            self._pending[-1][1].append(params)
+        else:
+            self._pending.append((operation, [params]))
+        self._count += 1
+        if self._count >= self.batch_size:
+            self.flush()
+        return None
+
+    def flush(self):
+        """
+        Exécute les écritures en attente.
+        :return:
+        """
+        pending = self._pending
+        self._pending = []
+        self._count = 0
+        for operation, params_list in pending:
+            if len(params_list) == 1:
+                self.cursor.execute(operation, params=params_list[0])
+            else:
+                self.cursor.executemany(operation, params_list)
+
+    def discard(self):
+        """
+        Abandonne les écritures en attente.
+        :return:
+        """
+        self._pending = []
+        self._count = 0
+
+    def close(self):
+        """
+        Ferme le curseur, en abandonnant les écritures en attente.
+        :return:
+        """
+        self.discard()
+        self.cursor.close()
+
+    @property
+    def lastrowid(self):
+        """
+        Id généré par la dernière écriture, exécutée seule.
+        :return:
+        """
+        if self._pending and len(self._pending[-1][1]) > 1:
+            operation, params_list = self._pending.pop()
+            self._pending.append((operation, params_list[:-1]))
+            self._pending.append((operation, params_list[-1:]))
+        self.flush()
+        return self.cursor.lastrowid
+
+    def __getattr__(self, name):
+        self.flush()
+        return getattr(self.cursor, name)
+
+
+# Paramètres nommés d'une requête: %(name)s
+PARAM_NAME = re.compile(r'%\((\w+)\)s')
+
+# Requêtes exécutées pour chaque utilisateur, rendues une seule fois par instance de Database
+STATEMENTS = {
+    'get_user_id': "SELECT id FROM {entete}user WHERE username = %(username)s",
+    'get_id_cohort': "SELECT id FROM {entete}cohort WHERE contextid = %(id_context)s AND name = %(cohort_name)s",
+    'get_id_role_assignment': "SELECT id FROM {entete}role_assignments"
+                              " WHERE roleid = %(role_id)s AND contextid = %(id_context)s AND userid = %(id_user)s"
+                              " LIMIT 1",
+    'count_role_assignments': "SELECT COUNT(id) FROM {entete}role_assignments"
+                              " WHERE roleid = %(role_id)s AND contextid = %(id_context)s AND userid = %(id_user)s",
+    'insert_role_assignment': "INSERT INTO {entete}role_assignments(roleid, contextid, userid)"
+                              " VALUES (%(role_id)s, %(id_context)s, %(id_user)s)",
+    'enroll_user_in_cohort': "INSERT IGNORE INTO {entete}cohort_members(cohortid, userid, timeadded)"
+                             " VALUES (%(id_cohort)s, %(id_user)s, %(time_added)s)",
+    'get_id_enrol': "SELECT id FROM {entete}enrol"
+                    " WHERE enrol = %(enrol_method)s AND courseid = %(id_course)s AND roleid = %(role_id)s",
+    'insert_user_enrolment': "INSERT IGNORE INTO {entete}user_enrolments(enrolid, userid)"
+                             " VALUES (%(id_enrol)s, %(id_user)s)",
+    'get_id_user_info_data': "SELECT id FROM {entete}user_info_data"
+                             " WHERE userid = %(id_user)s AND fieldid = %(id_field)s",
+    'insert_user_info_data': "INSERT INTO {entete}user_info_data (userid, fieldid, data)"
+                             " VALUES (%(id_user)s, %(id_field)s, %(data)s)",
+    'upsert_user_info_data': "INSERT INTO {entete}user_info_data (userid, fieldid, data)"
+                             " VALUES (%(id_user)s, %(id_field)s, %(data)s)"
+                             " ON DUPLICATE KEY UPDATE data = VALUES(data)",
+    'update_user_info_data': "UPDATE {entete}user_info_data SET data = %(data)s"
+                             " WHERE userid = %(id_user)s AND fieldid = %(id_field)s",
+    'insert_moodle_user': "INSERT INTO {entete}user"
+                          " (auth, confirmed, username, firstname, lastname, email, maildisplay, city, country, lang,"
+                          " mnethostid, theme)"
+                          " VALUES (%(auth)s, %(confirmed)s, %(username)s, %(firstname)s, %(lastname)s, %(email)s,"
+                          " %(maildisplay)s, %(city)s, %(country)s, %(lang)s, %(mnethostid)s, %(theme)s)"
+                          " ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)",
+    'update_moodle_user': "UPDATE {entete}user"
+                          " SET auth = %(USER_AUTH)s, firstname = %(first_name)s, lastname = %(last_name)s,"
+                          " email = %(email)s, maildisplay = %(mail_display)s, city = %(USER_CITY)s,"
+                          " country = %(USER_COUNTRY)s, lang = %(USER_LANG)s, mnethostid = %(USER_MNET_HOST_ID)s,"
+                          " theme = %(theme)s"
+                          " WHERE id = %(id_user)s",
+}
+
+
+class Statement:
+    """
+    Requête SQL rendue une seule fois avec l'entête des tables.
+
+    sql est la forme à paramètres nommés du protocole texte, prepared_sql la forme positionnelle envoyée au serveur
+    pour préparation.
+    """
+
+    def __init__(self, template: str, entete: str):
+        self.sql = template.format(entete=entete)
+        self.names = PARAM_NAME.findall(self.sql)
+        self.prepared_sql = PARAM_NAME.sub('%s', self.sql)
+        self.write = bool(WRITE_STATEMENT.match(self.sql))
+
+    def values(self, params: dict) -> tuple:
+        """
+        :param params: paramètres nommés
+        :return: Paramètres dans l'ordre de la requête préparée
+        """
+        return tuple(params[name] for name in self.names)
+
+
+# Nombre de lignes lues à la fois par les lectures au fil de l'eau
+STREAM_FETCH_SIZE = 1000
+
+# Nombre de lignes par INSERT multi-lignes lors du chargement des tables temporaires
+STAGING_CHUNK_SIZE = 1000
+
+# Pools de connexions partagés par toutes les instances de Database d'une même exécution, par configuration
+POOLS = {}  # type: Dict[tuple, MySQLConnectionPool]
+POOLS_LOCK = threading.Lock()
+
+# Connexions créées pour alimenter les pools, qu'elles soient disponibles ou empruntées
+POOLS_CONNECTIONS = []  # type: List[MySQLConnection]
+
+
+def connection_args(config: DatabaseConfig) -> dict:
+    """
+    :param config: Configuration de la base de données
+    :return: Paramètres de connexion à la base de données
+    """
+    args = dict(host=config.host,
+                user=config.user,
+                passwd=config.password,
+                db=config.database,
+                charset=config.charset,
+                port=config.port)
+    if config.infile:
+        args['allow_local_infile'] = True
+    return args
+
+
+def infile_line(row) -> str:
+    """
+    Formate une ligne pour LOAD DATA INFILE (champs séparés par des tabulations, caractères d'échappement par défaut)
+    :param row:
+    :return:
+    """
+    fields = []
+    for value in row:
+        if value is None:
+            fields.append('\\N')
+        else:
+            fields.append(str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n'))
+    return '\t'.join(fields) + '\n'
+
+
+def get_pool(config: DatabaseConfig) -> MySQLConnectionPool:
+    """
+    Retourne le pool de connexions associé à la configuration, en le créant au premier appel.
+    :param config: Configuration de la base de données
+    :return: Pool de connexions
+    """
+    args = connection_args(config)
+    key = tuple(sorted(args.items())) + (config.pool_size, config.pool_reset)
+    with POOLS_LOCK:
+        pool = POOLS.get(key)
+        if pool is None:
+            # Les connexions sont créées ici plutôt que par le pool, pour pouvoir être fermées par close_pools
+            pool = MySQLConnectionPool(pool_name="synchromoodle_%d" % len(POOLS),
+                                       pool_size=config.pool_size,
+                                       pool_reset_session=config.pool_reset)
+            pool.set_config(**args)
+            for _ in range(config.pool_size):
+                connection = mysql.connector.connect(**args)
+                POOLS_CONNECTIONS.append(connection)
+                pool.add_connection(connection)
+            POOLS[key] = pool
+        return pool
+
+
+def close_pools():
+    """
+    Ferme les connexions des pools, en fin d'exécution.
+    :return:
+    """
+    with POOLS_LOCK:
+        for connection in POOLS_CONNECTIONS:
+            connection.close()
+        POOLS_CONNECTIONS.clear()
+        POOLS.clear()
+
+
 class Cohort:
     """
     Données associées à une cohorte.
@@ -146,30 +408,100 @@ class Database:
     connection = None  # type: MySQLConnection
     mark = None  # type: MySQLCursor
     entete = None  # type: str
+    users_ids = None  # type: Dict[str, int]
+    cohorts_ids = None  # type: Dict[int, Dict[str, int]]
+    statements = None  # type: Dict[str, Statement]
+    prepared_cursors = None  # type: Dict[str, MySQLCursor]
 
     def __init__(self, config: DatabaseConfig, constantes: ConstantesConfig):
         self.config = config
         self.constantes = constantes
         self.entete = config.entete
+        self.statements = {name: Statement(template, self.entete) for name, template in STATEMENTS.items()}
+        self.prepared_cursors = {}
 
     def connect(self):
         """
-        Etablit la connexion à la base de données Moodle
+        Etablit la connexion à la base de données Moodle.
+        Si pool_size est renseigné, la connexion est empruntée au pool partagé par toutes les instances de la même
+        configuration, après vérification qu'elle est toujours active. Elle y est rendue par disconnect.
+        Chaque thread doit utiliser sa propre instance de Database.
         :return:
         """
-        self.connection = mysql.connector.connect(host=self.config.host,
-                                                  user=self.config.user,
-                                                  passwd=self.config.password,
-                                                  db=self.config.database,
-                                                  charset=self.config.charset,
-                                                  port=self.config.port)
+        self.connection = self._open_connection()
         self.mark = self.connection.cursor()
+        if self.config.batch_size > 1:
+            self.mark = BatchCursor(self.mark, self.config.batch_size)
+
+    def _open_connection(self) -> MySQLConnection:
+        if self.config.pool_size:
+            try:
+                connection = get_pool(self.config).get_connection()
+            except PoolError:
+                # Pool épuisé: connexion supplémentaire hors pool
+                return mysql.connector.connect(**connection_args(self.config))
+            connection.ping(reconnect=True, attempts=1)
+            return connection
+        return mysql.connector.connect(**connection_args(self.config))
+
+    def stream(self, operation, params=None, size=STREAM_FETCH_SIZE,
+               setup: Callable[[MySQLCursor], None] = None) -> Iterator[tuple]:
+        """
+        Exécute une requête de lecture sur une connexion dédiée, et retourne les lignes au fil de l'eau par lots de
+        size lignes: le résultat complet n'est jamais chargé en mémoire, et d'autres requêtes peuvent être exécutées
+        sur la connexion principale pendant le parcours. Réservée aux parcours de tables entières: l'ouverture d'une
+        connexion a un coût, et la connexion dédiée ne voit pas les écritures non validées de la connexion principale,
+        qui doivent être validées avant le parcours si le résultat en dépend.
+        :param operation: requête
+        :param params: paramètres de la requête
+        :param size: nombre de lignes lues à la fois
+        :param setup: fonction exécutée sur le curseur de la connexion dédiée avant la requête, pour y préparer par
+        exemple des tables temporaires
+        :return: Générateur des lignes
+        """
+        self.flush()
+        connection = self._open_connection()
+        try:
+            cursor = connection.cursor()
+            try:
+                if setup:
+                    setup(cursor)
+                cursor.execute(operation, params=params)
+                rows = cursor.fetchmany(size)
+                while rows:
+                    yield from rows
+                    rows = cursor.fetchmany(size)
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+
+    def iter_rows(self, operation, params=None, size=STREAM_FETCH_SIZE) -> Iterator[tuple]:
+        """
+        Exécute une requête de lecture sur la connexion principale, après exécution des écritures en attente, et
+        retourne les lignes par lots de size lignes. Le résultat voit les écritures non validées de la transaction en
+        cours, et doit être entièrement parcouru avant toute autre requête sur la connexion principale.
+        :param operation: requête
+        :param params: paramètres de la requête
+        :param size: nombre de lignes lues à la fois
+        :return: Générateur des lignes
+        """
+        self.mark.execute(operation, params=params)
+        rows = self.mark.fetchmany(size)
+        while rows:
+            yield from rows
+            rows = self.mark.fetchmany(size)
 
     def disconnect(self):
         """
         Ferme la connexion à la base de données Moodle
         :return:
         """
+        self.users_ids = None
+        self.cohorts_ids = None
+        for cursor in self.prepared_cursors.values():
+            cursor.close()
+        self.prepared_cursors = {}
         if self.mark:
             self.mark.close()
             self.mark = None
@@ -177,16 +509,88 @@ class Database:
             self.connection.close()
             self.connection = None
 
-    def safe_fetchone(self):
+    def flush(self):
+        """
+        Exécute les écritures mises en attente par le curseur
+        :return:
+        """
+        if isinstance(self.mark, BatchCursor):
+            self.mark.flush()
+
+    def commit(self):
+        """
+        Valide la transaction en cours, après exécution des écritures en attente
+        :return:
+        """
+        self.flush()
+        self.connection.commit()
+
+    def get_lock(self, name, timeout):
+        """
+        Obtient un verrou nommé MySQL, commun à toutes les connexions au serveur.
+        :param name: nom du verrou
+        :param timeout: délai maximal d'attente, en secondes
+        :return: True si le verrou est obtenu avant l'expiration du délai
+        """
+        self.mark.execute("SELECT GET_LOCK(%(name)s, %(timeout)s)", params={'name': name, 'timeout': timeout})
+        ligne = self.safe_fetchone()
+        return bool(ligne and ligne[0])
+
+    def release_lock(self, name):
+        """
+        Libère un verrou nommé MySQL obtenu par get_lock.
+        :param name: nom du verrou
+        :return:
+        """
+        self.mark.execute("SELECT RELEASE_LOCK(%(name)s)", params={'name': name})
+        self.safe_fetchone()
+
+    def rollback(self):
+        """
+        Annule la transaction en cours, en abandonnant les écritures en attente.
+        Les index des ids, qui peuvent référencer des lignes annulées, sont vidés.
+        :return:
+        """
+        if isinstance(self.mark, BatchCursor):
+            self.mark.discard()
+        self.connection.rollback()
+        self.users_ids = None
+        self.cohorts_ids = None
+
+    def execute_statement(self, name, params):
+        """
+        Exécute une requête du registre des requêtes.
+        Si les requêtes préparées sont activées, la requête est exécutée via un curseur préparé qui lui est dédié: le
+        serveur ne l'analyse qu'une seule fois. Les écritures différées par le curseur d'écritures restent sur le
+        protocole texte, pour être regroupées.
+        :param name: nom de la requête
+        :param params: paramètres nommés
+        :return: Curseur ayant exécuté la requête
+        """
+        statement = self.statements[name]
+        if not self.config.prepared or (statement.write and isinstance(self.mark, BatchCursor)):
+            self.mark.execute(statement.sql, params=params)
+            return self.mark
+        self.flush()
+        cursor = self.prepared_cursors.get(name)
+        if cursor is None:
+            cursor = self.connection.cursor(prepared=True)
+            self.prepared_cursors[name] = cursor
+        cursor.execute(statement.prepared_sql, statement.values(params))
+        return cursor
+
+    def safe_fetchone(self, cursor=None):
         """
         Retourne uniquement 1 résultat et lève une exception si la requête invoquée récupère plusieurs resultats
+        :param cursor: curseur ayant exécuté la requête (curseur principal par défaut)
         :return:
         """
-        rows = self.mark.fetchall()
+        cursor = cursor or self.mark
+        rows = cursor.fetchall()
         count = len(rows)
         if count > 1:
             raise mysql.connector.DatabaseError("Résultat de requête SQL invalide: 1 résultat attendu, %d reçus:\n%s"
-                                                % (count, self.mark.statement))
+                                                % (count, cursor.statement))
         return rows[0] if count == 1 else None
 
     def add_role_to_user(self, role_id, id_context, id_user):
@@ -201,9 +605,8 @@ class Database:
         id_role_assignment = self.get_id_role_assignment(role_id, id_context, id_user)
         if not id_role_assignment:
             # Ajout du role dans le contexte
-            s = "INSERT INTO {entete}role_assignments( roleid, contextid, userid )" \
-                " VALUES ( %(role_id)s, %(id_context)s, %(id_user)s )".format(entete=self.entete)
-            self.mark.execute(s, params={'role_id': role_id, 'id_context': id_context, 'id_user': id_user})
+            self.execute_statement('insert_role_assignment',
+                                   {'role_id': role_id, 'id_context': id_context, 'id_user': id_user})
 
     def remove_role_to_user(self, role_id, id_context, id_user):
         """
@@ -232,12 +635,9 @@ class Database:
         :param id_user: int
         :return:
         """
-        s = "SELECT id FROM {entete}role_assignments" \
-            " WHERE roleid = %(role_id)s AND contextid = %(id_context)s AND userid = %(id_user)s" \
-            " LIMIT 1" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'role_id': role_id, 'id_context': id_context, 'id_user': id_user})
-        ligne = self.safe_fetchone()
+        cursor = self.execute_statement('get_id_role_assignment',
+                                        {'role_id': role_id, 'id_context': id_context, 'id_user': id_user})
+        ligne = self.safe_fetchone(cursor)
         if ligne is None:
             return None
         return ligne[0]
@@ -275,10 +675,28 @@ class Database:
             id_enrol = self.get_id_enrol_max()
         if id_enrol:
             # Enrolement de l'utilisateur dans le cours
-            s = "INSERT IGNORE INTO {entete}user_enrolments(enrolid, userid)" \
-                " VALUES (%(id_enrol)s, %(id_user)s)" \
-                .format(entete=self.entete)
-            self.mark.execute(s, params={'id_enrol': id_enrol, 'id_user': id_user})
+            self.execute_statement('insert_user_enrolment', {'id_enrol': id_enrol, 'id_user': id_user})
+
+    def get_course_enrolment_rows(self, ids_users, ids_courses):
+        """
+        Fonction permettant de recuperer en une seule requête les inscriptions manuelles (roleid, courseid, userid)
+        d'une liste d'utilisateurs, restreintes à une liste de cours.
+        :param ids_users:
+        :param ids_courses:
+        :return:
+        """
+        if not ids_users or not ids_courses:
+            return set()
+        users_list, users_list_params = array_to_safe_sql_list(ids_users, 'users_list')
+        courses_list, courses_list_params = array_to_safe_sql_list(ids_courses, 'courses_list')
+        s = "SELECT e.roleid, e.courseid, ue.userid FROM {entete}enrol AS e" \
+            " INNER JOIN {entete}user_enrolments AS ue ON ue.enrolid = e.id" \
+            " WHERE e.enrol = %(enrol_method)s" \
+            " AND e.courseid IN ({courses_list})" \
+            " AND ue.userid IN ({users_list})" \
+            .format(entete=self.entete, users_list=users_list, courses_list=courses_list)
+        self.mark.execute(s, params={'enrol_method': ENROL_METHOD_MANUAL, **users_list_params, **courses_list_params})
+        return {tuple(ligne) for ligne in self.mark.fetchall()}
 
     def get_id_enrol_max(self):
         """
@@ -298,6 +716,7 @@ class Database:
         """
         Fonction permettant de creer une nouvelle cohorte pour
         un contexte donne.
+        Retourne l'id de la cohorte créée
         :param id_context:
         :param name:
         :param id_number:
@@ -312,6 +731,10 @@ class Database:
             .format(entete=self.entete)
         self.mark.execute(s, params={'id_context': id_context, 'name': name, 'id_number': id_number,
                                      'description': description, 'time_created': time_created})
+        id_cohort = self.mark.lastrowid
+        if self.cohorts_ids is not None and id_context in self.cohorts_ids:
+            self.cohorts_ids[id_context][name] = id_cohort
+        return id_cohort
 
     def disenroll_user_from_username_and_cohortname(self, username, cohortname):
         """
@@ -340,38 +763,87 @@ class Database:
         s = "DELETE FROM {entete}cohort WHERE id NOT IN (SELECT cohortid FROM {entete}cohort_members)" \
             .format(entete=self.entete)
         self.mark.execute(s)
+        self.cohorts_ids = None
+
+    def load_cohorts_ids(self, ids_contexts):
+        """
+        Charge en une seule requête l'index des ids des cohortes, par nom, des contextes qui ne sont pas encore indexés.
+        :param ids_contexts:
+        :return:
+        """
+        if self.cohorts_ids is None:
+            self.cohorts_ids = {}
+        ids_contexts = [id_context for id_context in ids_contexts if id_context not in self.cohorts_ids]
+        if not ids_contexts:
+            return
+        ids_list, ids_list_params = array_to_safe_sql_list(ids_contexts, 'ids_list')
+        s = "SELECT id, contextid, name FROM {entete}cohort" \
+            " WHERE contextid IN ({ids_list})" \
+            .format(entete=self.entete, ids_list=ids_list)
+        self.mark.execute(s, params={**ids_list_params})
+        for id_context in ids_contexts:
+            self.cohorts_ids[id_context] = {}
+        for id_cohort, id_context, name in self.mark.fetchall():
+            self.cohorts_ids[id_context][name] = id_cohort
 
     def get_id_cohort(self, id_context, cohort_name):
         """
         Fonction permettant de recuperer l'id d'une cohorte
         par son nom et son contexte de rattachement.
+        L'id est lu dans l'index chargé par load_cohorts_ids, et recherché en base en son absence.
         :param id_context:
         :param cohort_name:
         :return:
         """
-        s = "SELECT id" \
-            " FROM {entete}cohort" \
-            " WHERE contextid = %(id_context)s" \
-            " AND name = %(cohort_name)s" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'id_context': id_context, 'cohort_name': cohort_name})
-        ligne = self.safe_fetchone()
+        if self.cohorts_ids is not None and cohort_name in self.cohorts_ids.get(id_context, ()):
+            return self.cohorts_ids[id_context][cohort_name]
+        cursor = self.execute_statement('get_id_cohort', {'id_context': id_context, 'cohort_name': cohort_name})
+        ligne = self.safe_fetchone(cursor)
         if ligne is None:
             return None
+        if self.cohorts_ids is not None and id_context in self.cohorts_ids:
+            self.cohorts_ids[id_context][cohort_name] = ligne[0]
         return ligne[0]
 
+    def load_users_ids(self):
+        """
+        Charge en une seule requête l'index des ids des utilisateurs moodle non supprimés, par username.
+        Les lignes sont lues au fil de l'eau, sans mise en mémoire du résultat complet par le curseur.
+        :return:
+        """
+        self.flush()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("SELECT id, username FROM {entete}user WHERE deleted = 0".format(entete=self.entete))
+            self.users_ids = {username: id_user for id_user, username in cursor}
+        finally:
+            cursor.close()
+
+    def has_user(self, username) -> bool:
+        """
+        Indique si un utilisateur moodle non supprimé existe, d'après le seul index chargé par load_users_ids.
+        :param username: str
+        :return: True si l'utilisateur est présent dans l'index
+        """
+        if self.users_ids is None:
+            self.load_users_ids()
+        return username.lower() in self.users_ids
+
     def get_user_id(self, username):
         """
         Fonction permettant de recuperer l'id d'un
         utilisateur moodle via son username.
+        L'id est lu dans l'index chargé par load_users_ids, et recherché en base en son absence.
         :param username: str
         :return:
         """
-        s = "SELECT id FROM {entete}user " \
-            "WHERE username = %(username)s" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'username': username.lower()})
-        ligne = self.safe_fetchone()
+        if self.users_ids is None:
+            self.load_users_ids()
+        user_id = self.users_ids.get(username.lower())
+        if user_id is not None:
+            return user_id
+        cursor = self.execute_statement('get_user_id', {'username': username.lower()})
+        ligne = self.safe_fetchone(cursor)
         if ligne is None:
             return None
         return ligne[0]
@@ -385,11 +857,8 @@ class Database:
         :param time_added:
         :return:
         """
-        s = "INSERT IGNORE" \
-            " INTO {entete}cohort_members(cohortid, userid, timeadded)" \
-            " VALUES (%(id_cohort)s, %(id_user)s, %(time_added)s)" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'id_cohort': id_cohort, 'id_user': id_user, 'time_added': time_added})
+        self.execute_statement('enroll_user_in_cohort',
+                               {'id_cohort': id_cohort, 'id_user': id_user, 'time_added': time_added})
 
     def purge_cohort_profs(self, id_cohort, list_profs):
         """
@@ -519,13 +988,9 @@ class Database:
         :param id_course:
         :return:
         """
-        s = "SELECT e.id FROM {entete}enrol AS e" \
-            " WHERE e.enrol = %(enrol_method)s" \
-            " AND e.courseid = %(id_course)s" \
-            " AND e.roleid = %(role_id)s" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'enrol_method': enrol_method, 'id_course': id_course, 'role_id': role_id})
-        ligne = self.safe_fetchone()
+        cursor = self.execute_statement('get_id_enrol',
+                                        {'enrol_method': enrol_method, 'id_course': id_course, 'role_id': role_id})
+        ligne = self.safe_fetchone(cursor)
         if ligne is None:
             return None
         return ligne[0]
@@ -865,13 +1330,8 @@ class Database:
         :param id_field:
         :return:
         """
-        s = "SELECT id" \
-            " FROM {entete}user_info_data " \
-            " WHERE userid = %(id_user)s" \
-            " AND fieldid = %(id_field)s" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'id_user': id_user, 'id_field': id_field})
-        ligne = self.safe_fetchone()
+        cursor = self.execute_statement('get_id_user_info_data', {'id_user': id_user, 'id_field': id_field})
+        ligne = self.safe_fetchone(cursor)
         if ligne is None:
             return None
         return ligne[0]
@@ -1008,6 +1468,60 @@ class Database:
                           " FROM {entete}user WHERE deleted = 0".format(entete=self.entete))
         return self.mark.fetchall()
 
+    def get_valid_users_absent_from(self, usernames) -> Iterator[tuple]:
+        """
+        Parcourt au fil de l'eau les utilisateurs de la base de données qui ne sont pas marqués comme "supprimés" et
+        dont le username est absent de la liste, par jointure sur une table temporaire. La table temporaire est
+        chargée sur la connexion dédiée à la lecture, seule à la voir. Les écritures de la connexion principale doivent
+        être validées au préalable.
+        :param usernames:
+        :return:
+        """
+        table = '{entete}staging_usernames'.format(entete=self.entete)
+
+        def setup(cursor: MySQLCursor):
+            self.create_staging_table('usernames', 'user', ('username',), cursor)
+            self.stage_rows(table, ('username',), ((username.lower(),) for username in usernames), cursor)
+
+        return self.stream("SELECT"
+                           " u.id AS id,"
+                           " u.username AS username,"
+                           " u.lastlogin AS lastlogin"
+                           " FROM {entete}user AS u"
+                           " LEFT JOIN {table} AS s ON s.username = u.username"
+                           " WHERE u.deleted = 0 AND s.username IS NULL"
+                           .format(entete=self.entete, table=table), setup=setup)
+
+    def iter_all_valid_users(self) -> Iterator[tuple]:
+        """
+        Parcourt au fil de l'eau, sur une connexion dédiée, les utilisateurs de la base de données qui ne sont pas
+        marqués comme "supprimés". Les écritures de la connexion principale doivent être validées au préalable.
+        :return:
+        """
+        return self.stream("SELECT"
+                           " id AS id,"
+                           " username AS username,"
+                           " lastlogin AS lastlogin"
+                           " FROM {entete}user WHERE deleted = 0".format(entete=self.entete))
+
+    def get_valid_users_by_usernames(self, usernames):
+        """
+        Retourne les utilisateurs de la base de données qui ne sont pas marqués comme "supprimés", parmi une liste
+        de usernames
+        :param usernames:
+        :return:
+        """
+        if not usernames:
+            return []
+        usernames_list, usernames_list_params = array_to_safe_sql_list(usernames, 'usernames_list')
+        self.mark.execute("SELECT"
+                          " id AS id,"
+                          " username AS username,"
+                          " lastlogin AS lastlogin"
+                          " FROM {entete}user WHERE deleted = 0 AND username IN ({usernames_list})"
+                          .format(entete=self.entete, usernames_list=usernames_list), params=usernames_list_params)
+        return self.mark.fetchall()
+
     def delete_users(self, user_ids, safe_mode=False):
         """
         Supprime des utilisateurs de la BDD
@@ -1016,6 +1530,11 @@ class Database:
         :return:
         """
         ids_list, ids_list_params = array_to_safe_sql_list(user_ids, 'ids_list')
+        if self.users_ids:
+            # Les utilisateurs supprimés ne doivent plus être servis par l'index
+            user_ids = set(user_ids)
+            self.users_ids = {username: id_user for username, id_user in self.users_ids.items()
+                              if id_user not in user_ids}
         s = "DELETE FROM {entete}user WHERE id IN ({ids_list})".format(entete=self.entete, ids_list=ids_list)
         if safe_mode:
             s += " AND deleted = 1"
@@ -1216,15 +1735,10 @@ class Database:
         :return:
         """
         id_role_admin_local = self.get_id_role_admin_local()
-        sql = "SELECT COUNT(id) FROM {entete}role_assignments" \
-              " WHERE roleid = %(id_role_admin_local)s" \
-              " AND contextid = %(id_context_categorie)s" \
-              " AND userid = %(id_user)s" \
-            .format(entete=self.entete)
-        params = {'id_role_admin_local': id_role_admin_local, 'id_context_categorie': id_context_categorie,
-                  'id_user': id_user}
-        self.mark.execute(sql, params=params)
-        result = self.safe_fetchone()
+        cursor = self.execute_statement('count_role_assignments', {'role_id': id_role_admin_local,
+                                                                   'id_context': id_context_categorie,
+                                                                   'id_user': id_user})
+        result = self.safe_fetchone(cursor)
         is_local_admin = result[0] > 0
         return is_local_admin
 
@@ -1248,9 +1762,335 @@ class Database:
         self.mark.execute(s, params=params)
         return True
 
+    def insert_moodle_local_admins(self, id_context_categorie, ids_users):
+        """
+        Fonction permettant d'inserer en une fois les admins locaux d'un contexte donne.
+        Retourne les ids des utilisateurs pour lesquels l'insertion a été réalisée
+        :param id_context_categorie:
+        :param ids_users:
+        :return:
+        """
+        id_role_admin_local = self.get_id_role_admin_local()
+        ids_admins = self.get_users_with_role(id_role_admin_local, ids_users, id_context_categorie)
+        ids_inserts = sorted(set(ids_users) - ids_admins)
+        self.insert_role_assignments(id_role_admin_local, id_context_categorie, ids_inserts)
+        return ids_inserts
+
+    def get_users_with_role(self, role_id, ids_users, id_context=None):
+        """
+        Fonction permettant de recuperer, parmi une liste d'utilisateurs, ceux possédant un role,
+        dans un contexte donne ou dans n'importe quel contexte.
+        :param role_id:
+        :param ids_users:
+        :param id_context:
+        :return:
+        """
+        if not ids_users:
+            return set()
+        ids_list, ids_list_params = array_to_safe_sql_list(ids_users, 'ids_list')
+        sql = "SELECT DISTINCT userid FROM {entete}role_assignments" \
+              " WHERE roleid = %(role_id)s" \
+              " AND userid IN ({ids_list})" \
+            .format(entete=self.entete, ids_list=ids_list)
+        params = {'role_id': role_id, **ids_list_params}
+        if id_context is not None:
+            sql += " AND contextid = %(id_context)s"
+            params['id_context'] = id_context
+        self.mark.execute(sql, params=params)
+        return {ligne[0] for ligne in self.mark.fetchall()}
+
+    def insert_role_assignments(self, role_id, id_context, ids_users):
+        """
+        Fonction permettant d'ajouter en une seule requête un role a plusieurs utilisateurs
+        pour un contexte donne
+        :param role_id:
+        :param id_context:
+        :param ids_users:
+        :return:
+        """
+        self.insert_role_assignment_rows([(role_id, id_context, id_user) for id_user in ids_users])
+
+    def get_role_assignment_rows(self, ids_users, ids_roles):
+        """
+        Fonction permettant de recuperer en une seule requête les affectations de roles
+        (roleid, contextid, userid) d'une liste d'utilisateurs, restreintes à une liste de roles.
+        :param ids_users:
+        :param ids_roles:
+        :return:
+        """
+        if not ids_users or not ids_roles:
+            return set()
+        users_list, users_list_params = array_to_safe_sql_list(ids_users, 'users_list')
+        roles_list, roles_list_params = array_to_safe_sql_list(ids_roles, 'roles_list')
+        s = "SELECT roleid, contextid, userid FROM {entete}role_assignments" \
+            " WHERE userid IN ({users_list})" \
+            " AND roleid IN ({roles_list})" \
+            .format(entete=self.entete, users_list=users_list, roles_list=roles_list)
+        self.mark.execute(s, params={**users_list_params, **roles_list_params})
+        return {tuple(ligne) for ligne in self.mark.fetchall()}
+
+    def insert_role_assignment_rows(self, rows):
+        """
+        Fonction permettant d'ajouter en une seule requête des affectations de roles (roleid, contextid, userid)
+        :param rows:
+        :return:
+        """
+        if not rows:
+            return
+        values, params = rows_to_safe_sql_values(rows, ('role_id', 'id_context', 'id_user'))
+        s = "INSERT INTO {entete}role_assignments(roleid, contextid, userid)" \
+            " VALUES {values}" \
+            .format(entete=self.entete, values=values)
+        self.mark.execute(s, params=params)
+
+    def delete_role_assignment_rows(self, rows):
+        """
+        Fonction permettant de supprimer en une seule requête des affectations de roles (roleid, contextid, userid)
+        :param rows:
+        :return:
+        """
+        if not rows:
+            return
+        values, params = rows_to_safe_sql_values(rows, ('role_id', 'id_context', 'id_user'))
+        s = "DELETE FROM {entete}role_assignments" \
+            " WHERE (roleid, contextid, userid) IN ({values})" \
+            .format(entete=self.entete, values=values)
+        self.mark.execute(s, params=params)
+
+    def get_user_info_data_rows(self, ids_users, ids_fields):
+        """
+        Fonction permettant de recuperer en une seule requête les valeurs des champs de profil d'une liste
+        d'utilisateurs, restreintes à une liste de champs.
+        :param ids_users:
+        :param ids_fields:
+        :return: Valeurs par couple (userid, fieldid)
+        """
+        if not ids_users or not ids_fields:
+            return {}
+        users_list, users_list_params = array_to_safe_sql_list(ids_users, 'users_list')
+        fields_list, fields_list_params = array_to_safe_sql_list(ids_fields, 'fields_list')
+        s = "SELECT userid, fieldid, data FROM {entete}user_info_data" \
+            " WHERE userid IN ({users_list})" \
+            " AND fieldid IN ({fields_list})" \
+            .format(entete=self.entete, users_list=users_list, fields_list=fields_list)
+        self.mark.execute(s, params={**users_list_params, **fields_list_params})
+        return {(ligne[0], ligne[1]): ligne[2] for ligne in self.mark.fetchall()}
+
+    def get_user_rows(self, ids_users):
+        """
+        Fonction permettant de recuperer en une seule requête les valeurs synchronisées d'une liste d'utilisateurs.
+        Les utilisateurs dont les valeurs constantes (auth, ville, pays, langue, hôte MNet) diffèrent de celles de la
+        synchronisation sont omis, pour être mis à jour.
+        :param ids_users:
+        :return: Valeurs (firstname, lastname, email, maildisplay, theme) par id d'utilisateur
+        """
+        if not ids_users:
+            return {}
+        ids_list, ids_list_params = array_to_safe_sql_list(ids_users, 'ids_list')
+        s = "SELECT id, firstname, lastname, email, maildisplay, theme FROM {entete}user" \
+            " WHERE id IN ({ids_list})" \
+            " AND auth = %(USER_AUTH)s AND city = %(USER_CITY)s AND country = %(USER_COUNTRY)s" \
+            " AND lang = %(USER_LANG)s AND mnethostid = %(USER_MNET_HOST_ID)s" \
+            .format(entete=self.entete, ids_list=ids_list)
+        self.mark.execute(s, params={'USER_AUTH': USER_AUTH,
+                                     'USER_CITY': USER_CITY,
+                                     'USER_COUNTRY': USER_COUNTRY,
+                                     'USER_LANG': USER_LANG,
+                                     'USER_MNET_HOST_ID': USER_MNET_HOST_ID,
+                                     **ids_list_params})
+        return {ligne[0]: tuple(ligne[1:]) for ligne in self.mark.fetchall()}
+
+    def update_moodle_user_rows(self, rows):
+        """
+        Fonction permettant de mettre a jour des utilisateurs (id, firstname, lastname, email, maildisplay, theme).
+        Les mises à jour sont regroupées par le curseur d'écritures.
+        :param rows:
+        :return:
+        """
+        for id_user, first_name, last_name, email, mail_display, theme in rows:
+            self.update_moodle_user(id_user, first_name, last_name, email, mail_display, theme)
+
+    def upsert_user_info_data_rows(self, rows):
+        """
+        Fonction permettant d'inserer ou de mettre à jour en une seule requête des valeurs de champs de profil
+        (userid, fieldid, data)
+        :param rows:
+        :return:
+        """
+        if not rows:
+            return
+        values, params = rows_to_safe_sql_values(rows, ('id_user', 'id_field', 'data'))
+        s = "INSERT INTO {entete}user_info_data (userid, fieldid, data)" \
+            " VALUES {values}" \
+            " ON DUPLICATE KEY UPDATE data = VALUES(data)" \
+            .format(entete=self.entete, values=values)
+        self.mark.execute(s, params=params)
+
+    def create_staging_table(self, name, source, columns, cursor=None):
+        """
+        Crée, ou recrée vide, une table temporaire de session dont les colonnes reprennent le type et la collation
+        des colonnes d'une table moodle. Toutes les colonnes forment la clé primaire.
+        :param name: nom de la table temporaire, sans entête
+        :param source: table moodle d'origine des colonnes, sans entête
+        :param columns: noms des colonnes
+        :param cursor: curseur de la session portant la table (curseur principal par défaut)
+        :return: Nom complet de la table temporaire
+        """
+        cursor = cursor or self.mark
+        table = '{entete}staging_{name}'.format(entete=self.entete, name=name)
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS {table}".format(table=table))
+        cursor.execute("CREATE TEMPORARY TABLE {table} (PRIMARY KEY ({columns}))"
+                       " SELECT {columns} FROM {entete}{source} LIMIT 0"
+                       .format(table=table, columns=', '.join(columns), entete=self.entete, source=source))
+        return table
+
+    def stage_rows(self, table, columns, rows, cursor=None) -> int:
+        """
+        Charge des lignes dans une table temporaire, via LOAD DATA LOCAL INFILE si infile est activé, et par INSERT
+        multi-lignes de STAGING_CHUNK_SIZE lignes sinon. Les doublons sont ignorés.
+        :param table: nom complet de la table temporaire
+        :param columns: noms des colonnes
+        :param rows: lignes à charger
+        :param cursor: curseur de la session portant la table (curseur principal par défaut)
+        :return: Nombre de lignes lues
+        """
+        cursor = cursor or self.mark
+        count = 0
+        if self.config.infile:
+            fd, path = tempfile.mkstemp(suffix='.tsv')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as infile:
+                    for row in rows:
+                        infile.write(infile_line(row))
+                        count += 1
+                cursor.execute("LOAD DATA LOCAL INFILE %(path)s IGNORE INTO TABLE {table}"
+                               " CHARACTER SET utf8mb4 ({columns})"
+                               .format(table=table, columns=', '.join(columns)), params={'path': path})
+            finally:
+                os.remove(path)
+            return count
+        chunk = []
+        for row in rows:
+            chunk.append(tuple(row))
+            count += 1
+            if len(chunk) >= STAGING_CHUNK_SIZE:
+                self._insert_staging_rows(table, columns, chunk, cursor)
+                chunk = []
+        self._insert_staging_rows(table, columns, chunk, cursor)
+        return count
+
+    def _insert_staging_rows(self, table, columns, rows, cursor):  # pylint: disable=no-self-use
+        if not rows:
+            return
+        values, params = rows_to_safe_sql_values(rows, columns)
+        cursor.execute("INSERT IGNORE INTO {table} ({columns}) VALUES {values}"
+                       .format(table=table, columns=', '.join(columns), values=values), params=params)
+
+    def reconcile_cohort_members(self, added, kept, time_added):
+        """
+        Réconcilie côté serveur les inscriptions aux cohortes, via des tables temporaires: les inscriptions
+        demandées absentes sont ajoutées par un seul INSERT ... SELECT, et les inscriptions des utilisateurs restreints
+        qui ne sont pas conservées sont supprimées par un seul DELETE ... JOIN.
+        :param added: inscriptions (cohortid, userid) demandées
+        :param kept: ids des cohortes conservées, par utilisateur dont les autres inscriptions sont supprimées
+        :param time_added:
+        :return: Nombre d'inscriptions ajoutées et supprimées, par cohorte
+        """
+        added_table = self.create_staging_table('cohort_members_added', 'cohort_members', ('cohortid', 'userid'))
+        self.stage_rows(added_table, ('cohortid', 'userid'), added)
+        kept_table = self.create_staging_table('cohort_members_kept', 'cohort_members', ('cohortid', 'userid'))
+        self.stage_rows(kept_table, ('cohortid', 'userid'),
+                        [(id_cohort, id_user) for id_user, ids_cohorts in kept.items() for id_cohort in ids_cohorts] +
+                        [row for row in added if row[1] in kept])
+        users_table = self.create_staging_table('cohort_users', 'cohort_members', ('userid',))
+        self.stage_rows(users_table, ('userid',), ((id_user,) for id_user in kept))
+
+        counts = {}  # type: Dict[int, List[int]]
+        self.mark.execute("SELECT a.cohortid, COUNT(*) FROM {added} AS a"
+                          " LEFT JOIN {entete}cohort_members AS cm ON cm.cohortid = a.cohortid AND cm.userid = a.userid"
+                          " WHERE cm.id IS NULL GROUP BY a.cohortid"
+                          .format(added=added_table, entete=self.entete))
+        for id_cohort, count in self.mark.fetchall():
+            counts.setdefault(id_cohort, [0, 0])[0] = count
+        self.mark.execute("SELECT cm.cohortid, COUNT(*) FROM {entete}cohort_members AS cm"
+                          " INNER JOIN {users} AS u ON u.userid = cm.userid"
+                          " LEFT JOIN {kept} AS k ON k.cohortid = cm.cohortid AND k.userid = cm.userid"
+                          " WHERE k.cohortid IS NULL GROUP BY cm.cohortid"
+                          .format(entete=self.entete, users=users_table, kept=kept_table))
+        for id_cohort, count in self.mark.fetchall():
+            counts.setdefault(id_cohort, [0, 0])[1] = count
+
+        self.mark.execute("INSERT IGNORE INTO {entete}cohort_members (cohortid, userid, timeadded)"
+                          " SELECT a.cohortid, a.userid, %(time_added)s FROM {added} AS a"
+                          .format(entete=self.entete, added=added_table), params={'time_added': time_added})
+        self.mark.execute("DELETE cm FROM {entete}cohort_members AS cm"
+                          " INNER JOIN {users} AS u ON u.userid = cm.userid"
+                          " LEFT JOIN {kept} AS k ON k.cohortid = cm.cohortid AND k.userid = cm.userid"
+                          " WHERE k.cohortid IS NULL"
+                          .format(entete=self.entete, users=users_table, kept=kept_table))
+        return counts
+
+    def get_cohort_member_rows(self, ids_cohorts, ids_users):
+        """
+        Fonction permettant de recuperer en une seule requête les inscriptions (cohortid, userid) d'une liste de
+        cohortes et de toutes les cohortes d'une liste d'utilisateurs.
+        :param ids_cohorts:
+        :param ids_users:
+        :return:
+        """
+        conditions = []
+        params = {}
+        if ids_cohorts:
+            cohorts_list, cohorts_list_params = array_to_safe_sql_list(ids_cohorts, 'cohorts_list')
+            conditions.append("cohortid IN ({cohorts_list})".format(cohorts_list=cohorts_list))
+            params.update(cohorts_list_params)
+        if ids_users:
+            users_list, users_list_params = array_to_safe_sql_list(ids_users, 'users_list')
+            conditions.append("userid IN ({users_list})".format(users_list=users_list))
+            params.update(users_list_params)
+        if not conditions:
+            return set()
+        s = "SELECT cohortid, userid FROM {entete}cohort_members" \
+            " WHERE {conditions}" \
+            .format(entete=self.entete, conditions=" OR ".join(conditions))
+        self.mark.execute(s, params=params)
+        return {tuple(ligne) for ligne in self.mark.fetchall()}
+
+    def insert_cohort_member_rows(self, rows, time_added):
+        """
+        Fonction permettant d'inscrire en une seule requête des utilisateurs dans des cohortes (cohortid, userid)
+        :param rows:
+        :param time_added:
+        :return:
+        """
+        if not rows:
+            return
+        values, params = rows_to_safe_sql_values([row + (time_added,) for row in rows],
+                                                 ('id_cohort', 'id_user', 'time_added'))
+        s = "INSERT IGNORE" \
+            " INTO {entete}cohort_members(cohortid, userid, timeadded)" \
+            " VALUES {values}" \
+            .format(entete=self.entete, values=values)
+        self.mark.execute(s, params=params)
+
+    def delete_cohort_member_rows(self, rows):
+        """
+        Fonction permettant de désinscrire en une seule requête des utilisateurs de cohortes (cohortid, userid)
+        :param rows:
+        :return:
+        """
+        if not rows:
+            return
+        values, params = rows_to_safe_sql_values(rows, ('id_cohort', 'id_user'))
+        s = "DELETE FROM {entete}cohort_members" \
+            " WHERE (cohortid, userid) IN ({values})" \
+            .format(entete=self.entete, values=values)
+        self.mark.execute(s, params=params)
+
     def insert_moodle_user(self, username, first_name, last_name, email, mail_display, theme):
         """
         Fonction permettant d'inserer un utilisateur dans Moodle.
+        Retourne l'id de l'utilisateur, inséré ou existant, y compris s'il vient d'être inséré par un autre processus
         :param username:
         :param first_name:
         :param last_name:
@@ -1262,25 +2102,21 @@ class Database:
         user_id = self.get_user_id(username)
         username = username.lower()
         if user_id is None:
-            s = "INSERT INTO {entete}user" \
-                " (auth, confirmed, username, firstname, lastname, email, maildisplay, city, country, lang," \
-                " mnethostid, theme )" \
-                " VALUES (%(auth)s, %(confirmed)s, %(username)s, %(firstname)s, %(lastname)s, %(email)s," \
-                " %(maildisplay)s, %(city)s, %(country)s, %(lang)s, %(mnethostid)s, %(theme)s)" \
-                .format(entete=self.entete)
-
-            self.mark.execute(s, params={'auth': USER_AUTH,
-                                         'confirmed': 1,
-                                         'username': username,
-                                         'firstname': first_name,
-                                         'lastname': last_name,
-                                         'email': email,
-                                         'maildisplay': mail_display,
-                                         'city': USER_CITY,
-                                         'country': USER_COUNTRY,
-                                         'lang': USER_LANG,
-                                         'mnethostid': USER_MNET_HOST_ID,
-                                         'theme': theme})
+            cursor = self.execute_statement('insert_moodle_user', {'auth': USER_AUTH,
+                                                                   'confirmed': 1,
+                                                                   'username': username,
+                                                                   'firstname': first_name,
+                                                                   'lastname': last_name,
+                                                                   'email': email,
+                                                                   'maildisplay': mail_display,
+                                                                   'city': USER_CITY,
+                                                                   'country': USER_COUNTRY,
+                                                                   'lang': USER_LANG,
+                                                                   'mnethostid': USER_MNET_HOST_ID,
+                                                                   'theme': theme})
+            user_id = cursor.lastrowid
+            self.users_ids[username] = user_id
+        return user_id
 
     def insert_moodle_user_info_data(self, id_user, id_field, data):
         """
@@ -1290,10 +2126,7 @@ class Database:
         :param data:
         :return:
         """
-        s = "INSERT INTO {entete}user_info_data (userid, fieldid, data)" \
-            " VALUES (%(id_user)s, %(id_field)s, %(data)s)" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'id_user': id_user, 'id_field': id_field, 'data': data})
+        self.execute_statement('insert_user_info_data', {'id_user': id_user, 'id_field': id_field, 'data': data})
 
     def insert_moodle_user_info_field(self, short_name, name, data_type, id_category, param1, param2, locked, visible):
         """
@@ -1415,6 +2248,26 @@ class Database:
                           })
         return map(lambda r: r[0], self.mark.fetchall())
 
+    def iter_filtered_cohorts_members(self, contextid, cohortname_pattern) -> Iterator[tuple]:
+        """
+        Parcourt au fil de l'eau, en une seule requête sur la connexion principale, les membres des cohortes d'un
+        contexte dont le nom correspond au motif, y compris les modifications non validées de la transaction en cours.
+        Les cohortes sans membre sont retournées avec un nom d'utilisateur None.
+        :param contextid:
+        :param cohortname_pattern:
+        :return: Générateur des couples (nom de la cohorte, nom d'utilisateur)
+        """
+        return self.iter_rows("SELECT cohort.name, {entete}user.username FROM {entete}cohort AS cohort"
+                              " LEFT JOIN {entete}cohort_members AS cohort_members"
+                              " ON cohort_members.cohortid = cohort.id"
+                              " LEFT JOIN {entete}user ON cohort_members.userid = {entete}user.id"
+                              " WHERE cohort.contextid = %(contextid)s AND cohort.name LIKE %(like)s"
+                              .format(entete=self.entete),
+                              params={
+                                  'contextid': contextid,
+                                  'like': cohortname_pattern
+                              })
+
     def update_context_path(self, id_context, new_path):
         """
         Fonction permettant de mettre a jour le path d'un contexte.
@@ -1481,23 +2334,17 @@ class Database:
         :param theme:
         :return:
         """
-        s = "UPDATE {entete}user" \
-            " SET auth = %(USER_AUTH)s, firstname = %(first_name)s, lastname = %(last_name)s, email = %(email)s," \
-            " maildisplay = %(mail_display)s, city = %(USER_CITY)s, country = %(USER_COUNTRY)s, lang = %(USER_LANG)s," \
-            " mnethostid = %(USER_MNET_HOST_ID)s, theme = %(theme)s" \
-            " WHERE id = %(id_user)s" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'USER_AUTH': USER_AUTH,
-                                     'first_name': first_name,
-                                     'last_name': last_name,
-                                     'email': email,
-                                     'mail_display': mail_display,
-                                     'USER_CITY': USER_CITY,
-                                     'USER_COUNTRY': USER_COUNTRY,
-                                     'USER_LANG': USER_LANG,
-                                     'USER_MNET_HOST_ID': USER_MNET_HOST_ID,
-                                     'theme': theme,
-                                     'id_user': id_user})
+        self.execute_statement('update_moodle_user', {'USER_AUTH': USER_AUTH,
+                                                      'first_name': first_name,
+                                                      'last_name': last_name,
+                                                      'email': email,
+                                                      'mail_display': mail_display,
+                                                      'USER_CITY': USER_CITY,
+                                                      'USER_COUNTRY': USER_COUNTRY,
+                                                      'USER_LANG': USER_LANG,
+                                                      'USER_MNET_HOST_ID': USER_MNET_HOST_ID,
+                                                      'theme': theme,
+                                                      'id_user': id_user})
 
     def update_user_info_data(self, id_user, id_field, new_data):
         """
@@ -1508,12 +2355,7 @@ class Database:
         :param new_data:
         :return:
         """
-        s = "UPDATE {entete}user_info_data" \
-            " SET data = %(new_data)s " \
-            " WHERE userid = %(id_user)s" \
-            " AND fieldid = %(id_field)s" \
-            .format(entete=self.entete)
-        self.mark.execute(s, params={'new_data': new_data, 'id_user': id_user, 'id_field': id_field})
+        self.execute_statement('update_user_info_data', {'data': new_data, 'id_user': id_user, 'id_field': id_field})
 
     def get_field_domaine(self):
         """
@@ -1560,34 +2402,7 @@ class Database:
         :param user_domain:
         :return:
         """
-        # pour un utilisateur qui est déjà dans la table "user_info_data" mais sur un autre domaine que
-        # le domaine "user_domain",
-        # le script va essayer de créer une nouvelle ligne (INSERT) avec le nouveau domaine => erreur !
-        # la requête doit donc être modifiée :
-        # sql = "SELECT id FROM %suser_info_data WHERE userid = %s AND fieldid = %s AND data = '%s'"
-        sql = "SELECT id" \
-              " FROM {entete}user_info_data" \
-              " WHERE userid = %(id_user)s" \
-              " AND fieldid = %(id_field_domaine)s" \
-              " LIMIT 1" \
-            .format(entete=self.entete)
-        self.mark.execute(sql, params={'id_user': id_user, 'id_field_domaine': id_field_domaine})
-
-        result = self.safe_fetchone()
-        if result:
-            sql = "REPLACE INTO {entete}user_info_data " \
-                  "(id, userid, fieldid, data)" \
-                  " VALUES (%(id)s, %(id_user)s, %(id_field_domaine)s, %(user_domain)s)" \
-                .format(entete=self.entete)
-            self.mark.execute(sql, params={'id': result[0],
-                                           'id_user': id_user,
-                                           'id_field_domaine': id_field_domaine,
-                                           'user_domain': user_domain})
-        else:
-            sql = "INSERT INTO {entete}user_info_data " \
-                  "(userid, fieldid, data)" \
-                  " VALUES (%(id_user)s, %(id_field_domaine)s, %(user_domain)s)" \
-                .format(entete=self.entete)
-            self.mark.execute(sql, params={'id_user': id_user,
-                                           'id_field_domaine': id_field_domaine,
-                                           'user_domain': user_domain})
+        # Une seule requête, que l'utilisateur ait déjà un domaine ou non (clé unique userid, fieldid)
+        self.execute_statement('upsert_user_info_data', {'id_user': id_user,
+                                                         'id_field': id_field_domaine,
+                                                         'data': user_domain})
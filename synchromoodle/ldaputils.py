@@ -3,18 +3,65 @@
 Accès LDAP
 """
 import datetime
+import queue
+import threading
+import time
 from collections.abc import Iterable
-from typing import List, Dict, Union
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from sys import intern
+from typing import List, Dict, Union, Iterator, Callable, TypeVar, Set, Tuple, Any
 
-from ldap3 import Server, Connection, LEVEL
+from ldap3 import Server, Connection, LEVEL, Entry
 
 from synchromoodle.config import LdapConfig
+from synchromoodle.syncrepl import SyncResult, sync_search, get_paged_cookie
+
+# Profils de projection: attributs récupérés selon le chemin d'appel. L'annuaire ne renvoie ainsi que les
+# attributs utilisés, sans les attributs opérationnels ('+').
+PROFILS_ATTRIBUTS = {
+    'uid-only': ['uid'],
+    'personne': ['uid', 'sn', 'givenName', 'mail', 'ESCODomaines', 'ESCOUAICourant', 'isMemberOf'],
+    'eleve-sync': ['uid', 'sn', 'givenName', 'mail', 'ENTEleveClasses', 'ENTEleveNivFormation', 'ESCODomaines',
+                   'ESCOUAI', 'ESCOUAICourant'],
+    'enseignant-sync': ['uid', 'sn', 'givenName', 'mail', 'ESCOUAI', 'ESCODomaines', 'ESCOUAICourant',
+                        'ENTPersonStructRattach', 'ENTPersonProfils', 'isMemberOf', 'ENTAuxEnsClasses'],
+    'structure': ['ou', 'ENTStructureSIREN', 'ENTStructureTypeStruct', 'postalCode', 'ENTStructureUAI',
+                  'ESCODomaines'],
+    'classes-index': ['objectClass', 'uid', 'ENTEleveClasses', 'ENTEleveNivFormation', 'ENTAuxEnsClasses'],
+}  # type: Dict[str, List[str]]
+
+# Attributs opérationnels, à ne demander explicitement que lorsqu'ils sont exploités
+ATTRIBUTS_OPERATIONNELS = ['modifyTimeStamp', 'entryCSN']
+
+
+def get_attributs(profil: str, operationnels: bool = False) -> List[str]:
+    """
+    Obtient la liste des attributs à récupérer pour un profil de projection.
+    :param profil: nom du profil (clé de PROFILS_ATTRIBUTS)
+    :param operationnels: Si True, ajoute les attributs opérationnels modifyTimeStamp et entryCSN
+    :return: Liste des attributs
+    """
+    attributs = PROFILS_ATTRIBUTS[profil]
+    return attributs + ATTRIBUTS_OPERATIONNELS if operationnels else attributs
+
+
+T = TypeVar('T')
+
+log = getLogger('ldap')
 
 class ClasseLdap:
+    """
+    Représente une classe issue du LDAP.
+    """
+
+    __slots__ = ('etab_dn', 'classe')
+
     def __init__(self, etab_dn: str, classe: str):
         self.etab_dn = etab_dn
         self.classe = classe
 
+
 def extraire_classes_ldap(classes_ldap: List[str]):
     """
     Extrait le nom des classes à partir de l'entrée issue de l'annuaire ldap.
@@ -26,10 +73,25 @@ def extraire_classes_ldap(classes_ldap: List[str]):
     for classe_ldap in classes_ldap:
         split = classe_ldap.split("$")
         if len(split) > 1:
-            classes.append(ClasseLdap(split[0], split[-1]))
+            classes.append(ClasseLdap(intern(split[0]), intern(split[-1])))
     return classes
 
 
+def _interned_values(values: List[str]) -> Tuple[str, ...]:
+    return tuple(intern(value) for value in values)
+
+
+def _get_value(data: Entry, attribute: str, interned=False) -> str:
+    if attribute not in data:
+        return None
+    value = data[attribute].value
+    return intern(value) if interned and value else value
+
+
+def _get_values(data: Entry, attribute: str) -> Tuple[str, ...]:
+    return _interned_values(data[attribute].values) if attribute in data else None
+
+
 def ldap_escape(ldapstr: str) -> str:
     """
     Echappe les caractères specifiques pour les filtres LDAP
@@ -69,26 +131,101 @@ class StructureLdap:
         return "[%s] %s" % (self.__class__.__name__, str(self))
 
 
-class PersonneLdap:
+class _RecordLdap:
+    """
+    Enregistrement immuable issu du LDAP.
+
+    Les attributs sont stockés dans des slots, et ne peuvent être modifiés qu'au travers de evolve() qui renvoie une
+    copie.
+    """
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s est immuable, utiliser evolve()" % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s est immuable" % self.__class__.__name__)
+
+    @classmethod
+    def _slots(cls) -> Iterator[str]:
+        for klass in cls.__mro__:
+            yield from getattr(klass, '__slots__', ())
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._slots() if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def evolve(self, **changes):
+        """
+        Renvoie une copie de l'enregistrement, en remplaçant les attributs donnés.
+        :param changes: nouvelles valeurs des attributs
+        :return: copie de l'enregistrement
+        """
+        state = self.__getstate__()
+        for name, value in changes.items():
+            if name not in state and name not in self._slots():
+                raise AttributeError("%s n'a pas d'attribut %s" % (self.__class__.__name__, name))
+            state[name] = value
+        record = object.__new__(self.__class__)
+        record.__setstate__(state)
+        return record
+
+
+class PersonneLdap(_RecordLdap):
     """
     Représente une personne issue du LDAP.
     """
 
-    def __init__(self, data):
-        self.uid = data.uid.value
-        self.sn = data.sn.value
-        self.given_name = data.givenName.value
-        self.domaine = data.ESCODomaines.value
-        self.domaines = data.ESCODomaines.values
-        self.uai_courant = data.ESCOUAICourant.value
-        self.mail = None
-        self.classes = None  # type: List[ClasseLdap]
-        if 'mail' in data:
-            self.mail = data.mail.value
+    __slots__ = ('uid', 'sn', 'given_name', 'domaine', 'domaines', 'uai_courant', 'uais', 'mail', 'is_member_of',
+                 '_classes_ldap', '_classes')
 
-        self.is_member_of = None
-        if 'isMemberOf' in data:
-            self.is_member_of = data.isMemberOf.values
+    def __init__(self, data):
+        _set = object.__setattr__
+        _set(self, 'uid', data.uid.value)
+        _set(self, 'sn', _get_value(data, 'sn'))
+        _set(self, 'given_name', _get_value(data, 'givenName'))
+        domaines = _get_values(data, 'ESCODomaines') or ()
+        _set(self, 'domaine', domaines[0] if domaines else None)
+        _set(self, 'domaines', domaines)
+        _set(self, 'uai_courant', _get_value(data, 'ESCOUAICourant', interned=True))
+        _set(self, 'uais', _get_values(data, 'ESCOUAI'))
+        _set(self, 'mail', _get_value(data, 'mail'))
+        _set(self, 'is_member_of', _get_values(data, 'isMemberOf'))
+        # Les classes ne sont extraites qu'au premier accès
+        _set(self, '_classes_ldap', None)
+
+    @property
+    def classes(self) -> List[ClasseLdap]:
+        """
+        Classes de la personne, extraites à la demande.
+        """
+        try:
+            return self._classes
+        except AttributeError:
+            classes = extraire_classes_ldap(self._classes_ldap) if self._classes_ldap is not None else None
+            object.__setattr__(self, '_classes', classes)
+            return classes
+
+    def fingerprint_values(self) -> Dict[str, Any]:
+        """
+        Valeurs des attributs LDAP de la personne, servant au calcul de son empreinte. Les classes sont reprises
+        telles que lues dans l'annuaire.
+        :return: valeur par attribut
+        """
+        return {'uid': self.uid,
+                'sn': self.sn,
+                'given_name': self.given_name,
+                'domaine': self.domaine,
+                'domaines': self.domaines,
+                'uai_courant': self.uai_courant,
+                'uais': self.uais,
+                'mail': self.mail,
+                'is_member_of': self.is_member_of,
+                'classes': self._classes_ldap}
 
     def __str__(self):
         return "uid=%s, given_name=%s, sn=%s" % (self.uid, self.given_name, self.sn)
@@ -102,16 +239,24 @@ class EleveLdap(PersonneLdap):
     Représente un élève issu du LDAP.
     """
 
+    __slots__ = ('niveau_formation',)
+
     def __init__(self, data):
         super().__init__(data)
-        self.niveau_formation = data.ENTEleveNivFormation.value
+        object.__setattr__(self, 'niveau_formation', _get_value(data, 'ENTEleveNivFormation', interned=True))
+        object.__setattr__(self, '_classes_ldap', _get_values(data, 'ENTEleveClasses'))
 
-        self.classe = None  # type: ClasseLdap
+    def fingerprint_values(self) -> Dict[str, Any]:
+        values = super().fingerprint_values()
+        values['niveau_formation'] = self.niveau_formation
+        return values
 
-        if 'ENTEleveClasses' in data:
-            self.classes = extraire_classes_ldap(data.ENTEleveClasses.values)
-            if self.classes:
-                self.classe = self.classes[0]
+    @property
+    def classe(self) -> ClasseLdap:
+        """
+        Première classe de l'élève.
+        """
+        return self.classes[0] if self.classes else None
 
 
 class EnseignantLdap(PersonneLdap):
@@ -119,20 +264,213 @@ class EnseignantLdap(PersonneLdap):
     Représente un enseignant issu du LDAP.
     """
 
+    __slots__ = ('structure_rattachement', 'profils')
+
     def __init__(self, data):
         super().__init__(data)
-        self.structure_rattachement = data.ENTPersonStructRattach.value
+        object.__setattr__(self, 'structure_rattachement',
+                           _get_value(data, 'ENTPersonStructRattach', interned=True))
+        object.__setattr__(self, 'profils', _get_values(data, 'ENTPersonProfils'))
+        object.__setattr__(self, '_classes_ldap', _get_values(data, 'ENTAuxEnsClasses'))
+
+    def fingerprint_values(self) -> Dict[str, Any]:
+        values = super().fingerprint_values()
+        values['structure_rattachement'] = self.structure_rattachement
+        values['profils'] = self.profils
+        return values
+
+
+class ClassesIndex:
+    """
+    Index des membres des classes d'un établissement, issu du LDAP.
+    Les uid sont stockés en minuscules, comme les username Moodle.
+    """
+
+    def __init__(self):
+        self.eleves_by_classe = {}  # type: Dict[str, Set[str]]
+        self.eleves_by_niveau_formation = {}  # type: Dict[str, Set[str]]
+        self.enseignants_by_classe = {}  # type: Dict[str, Set[str]]
+        self.enseignants = set()  # type: Set[str]
+
+    def add_entry(self, data, etab_dn: str):
+        """
+        Ajoute une entrée LDAP (élève ou enseignant) à l'index.
+        :param data: entrée LDAP
+        :param etab_dn: DN de la structure de l'établissement
+        """
+        uid = data.uid.value.lower()
+        object_classes = data.objectClass.values
+        if 'ENTEleve' in object_classes:
+            if 'ENTEleveClasses' in data:
+                for classe in extraire_classes_ldap(data.ENTEleveClasses.values):
+                    if classe.etab_dn == etab_dn:
+                        self.eleves_by_classe.setdefault(classe.classe, set()).add(uid)
+            if 'ENTEleveNivFormation' in data and data.ENTEleveNivFormation.value:
+                self.eleves_by_niveau_formation.setdefault(data.ENTEleveNivFormation.value, set()).add(uid)
+        if 'ENTAuxEnseignant' in object_classes and uid != 'adm00000':
+            self.enseignants.add(uid)
+            if 'ENTAuxEnsClasses' in data:
+                for classe in extraire_classes_ldap(data.ENTAuxEnsClasses.values):
+                    if classe.etab_dn == etab_dn:
+                        self.enseignants_by_classe.setdefault(classe.classe, set()).add(uid)
+
+
+class StructuresCache:
+    """
+    Cache des structures LDAP, partagé par toutes les actions d'une même exécution.
+
+    L'ensemble des structures est lu par une seule recherche, puis servi depuis la mémoire jusqu'à invalidation
+    explicite ou expiration de la durée de vie.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._structures = {}  # type: Dict[str, Dict[str, StructureLdap]]
+        self._loaded_at = {}  # type: Dict[str, float]
+
+    def get(self, key: str, loader: Callable[[], List[StructureLdap]], ttl: float = 0) -> Dict[str, StructureLdap]:
+        """
+        Obtient les structures, chargées à l'aide de loader si nécessaire.
+        :param key: clé identifiant l'annuaire
+        :param loader: fonction de chargement de l'ensemble des structures
+        :param ttl: durée de vie en secondes (0 pour aucune expiration)
+        :return: Structures par UAI
+        """
+        with self._lock:
+            loaded_at = self._loaded_at.get(key)
+            if loaded_at is None or (ttl and time.monotonic() - loaded_at > ttl):
+                self._structures[key] = {structure.uai.upper(): structure for structure in loader()}
+                self._loaded_at[key] = time.monotonic()
+            return self._structures[key]
+
+    def invalidate(self):
+        """
+        Invalide le cache: les structures seront relues au prochain accès.
+        """
+        with self._lock:
+            self._structures.clear()
+            self._loaded_at.clear()
+
+
+# Cache des structures de l'exécution courante
+STRUCTURES_CACHE = StructuresCache()
+
+
+def invalidate_structures_cache():
+    """
+    Invalide le cache des structures partagé par les actions.
+    """
+    STRUCTURES_CACHE.invalidate()
+
+
+class EtablissementsIndex:
+    """
+    Index en mémoire, par UAI, des structures, élèves et enseignants issus du LDAP.
+    """
+
+    def __init__(self, uais: List[str]):
+        self.uais = [uai.upper() for uai in uais]  # type: List[str]
+        self.structures = {}  # type: Dict[str, StructureLdap]
+        self.eleves = {uai: [] for uai in self.uais}  # type: Dict[str, List[EleveLdap]]
+        self.enseignants = {uai: [] for uai in self.uais}  # type: Dict[str, List[EnseignantLdap]]
+
+    def __contains__(self, uai: str):
+        return uai.upper() in self.eleves
+
+    def add_structure(self, structure: StructureLdap):
+        """
+        Ajoute une structure à l'index.
+        :param structure:
+        """
+        self.structures[structure.uai.upper()] = structure
 
-        self.profils = None
-        if 'ENTPersonProfils' in data:
-            self.profils = data.ENTPersonProfils.values
+    def add_eleve(self, eleve: EleveLdap, uais: List[str]):
+        """
+        Ajoute un élève à l'index pour chacun des UAI de la liste auxquels il est rattaché.
+        :param eleve:
+        :param uais: codes établissement concernés par la recherche
+        """
+        for uai in _uais_rattaches(eleve, uais):
+            self.eleves[uai].append(eleve)
+
+    def add_enseignant(self, enseignant: EnseignantLdap, uais: List[str]):
+        """
+        Ajoute un enseignant à l'index pour chacun des UAI de la liste auxquels il est rattaché.
+        :param enseignant:
+        :param uais: codes établissement concernés par la recherche
+        """
+        for uai in _uais_rattaches(enseignant, uais):
+            self.enseignants[uai].append(enseignant)
+
+    def get_structure(self, uai: str) -> StructureLdap:
+        """
+        Obtient la structure d'un établissement.
+        :param uai: code établissement
+        :return: La structure, ou None si non trouvée.
+        """
+        return self.structures.get(uai.upper())
+
+    def get_eleves(self, uai: str) -> List[EleveLdap]:
+        """
+        Obtient les élèves d'un établissement.
+        :param uai: code établissement
+        :return: Liste des élèves
+        """
+        return self.eleves.get(uai.upper(), [])
+
+    def get_enseignants(self, uai: str) -> List[EnseignantLdap]:
+        """
+        Obtient les enseignants d'un établissement.
+        :param uai: code établissement
+        :return: Liste des enseignants
+        """
+        return self.enseignants.get(uai.upper(), [])
 
-        self.uais = None
-        if 'ESCOUAI' in data:
-            self.uais = data.ESCOUAI.values
+    def release(self, uai: str):
+        """
+        Libère la structure, les élèves et enseignants d'un établissement une fois celui-ci traité: l'établissement ne
+        figure plus dans l'index.
+        :param uai: code établissement
+        """
+        self.structures.pop(uai.upper(), None)
+        self.eleves.pop(uai.upper(), None)
+        self.enseignants.pop(uai.upper(), None)
+
+    def update(self, other: 'EtablissementsIndex'):
+        """
+        Ajoute à l'index les établissements d'un autre index, préchargés à nouveau.
+        :param other: index des établissements ajoutés
+        """
+        self.uais.extend(uai for uai in other.uais if uai not in self.uais)
+        self.structures.update(other.structures)
+        self.eleves.update(other.eleves)
+        self.enseignants.update(other.enseignants)
 
-        if 'ENTAuxEnsClasses' in data:
-            self.classes = extraire_classes_ldap(data.ENTAuxEnsClasses.values)
+
+def _uais_rattaches(personne: PersonneLdap, uais: List[str]) -> List[str]:
+    """
+    Filtre une liste d'UAI en ne conservant que ceux auxquels la personne est rattachée.
+    :param personne:
+    :param uais:
+    :return: UAI en majuscule
+    """
+    if not personne.uais:
+        return []
+    uais_personne = {uai.upper() for uai in personne.uais}
+    return [uai.upper() for uai in uais if uai.upper() in uais_personne]
+
+
+def _batches(items: List[T], size: int) -> Iterator[List[T]]:
+    """
+    Découpe une liste en lots.
+    :param items:
+    :param size: Taille maximale d'un lot (0 pour un seul lot)
+    :return: Générateur des lots
+    """
+    if not size or size <= 0:
+        size = max(len(items), 1)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 class Ldap:
@@ -144,113 +482,295 @@ class Ldap:
 
     def __init__(self, config: LdapConfig):
         self.config = config
+        self._pool = None  # type: queue.Queue
+        self._local = threading.local()
 
     def connect(self):
         """
-        Etablit la connection au LDAP.
+        Etablit la connection au LDAP, ainsi que le pool de connexions si pool_size est supérieur à 1.
         """
+        self.connection = self._open_connection()
+        if self.config.pool_size and self.config.pool_size > 1:
+            self._pool = queue.Queue()
+            for _ in range(self.config.pool_size):
+                self._pool.put(self._open_connection())
+
+    def _open_connection(self) -> Connection:
         server = Server(host=self.config.uri)
-        self.connection = Connection(server,
-                                     user=self.config.username,
-                                     password=self.config.password,
-                                     auto_bind=True,
-                                     raise_exceptions=True)
+        return Connection(server,
+                          user=self.config.username,
+                          password=self.config.password,
+                          auto_bind=True,
+                          raise_exceptions=True)
 
     def disconnect(self):
         """
-        Ferme la connection au LDAP.
+        Ferme la connection au LDAP, ainsi que les connexions du pool.
         """
+        if self._pool:
+            while not self._pool.empty():
+                self._pool.get_nowait().unbind()
+            self._pool = None
         if self.connection:
             self.connection.unbind()
             self.connection = None
 
+    def _current_connection(self) -> Connection:
+        """
+        Connexion à utiliser par le thread courant: celle empruntée au pool dans un thread de travail, la connexion
+        principale sinon.
+        """
+        return getattr(self._local, 'connection', None) or self.connection
+
+    def _run_pooled(self, task: Callable[[], T]) -> T:
+        connection = self._pool.get()
+        self._local.connection = connection
+        try:
+            return task()
+        finally:
+            self._local.connection = None
+            self._pool.put(connection)
+
+    def _run_parallel(self, tasks: List[Callable[[], T]]) -> List[T]:
+        """
+        Exécute des recherches en parallèle sur le pool de connexions, ou séquentiellement en l'absence de pool.
+        :param tasks: fonctions à exécuter
+        :return: résultats des fonctions, dans l'ordre des tâches
+        """
+        if not self._pool or len(tasks) < 2:
+            return [task() for task in tasks]
+        with ThreadPoolExecutor(max_workers=self.config.pool_size) as executor:
+            return list(executor.map(self._run_pooled, tasks))
+
     def get_structure(self, uai: str) -> StructureLdap:
         """
         Recherche de structures.
         :param uai: code établissement
         :return: L'établissement trouvé, ou None si non trouvé.
         """
+        if self.config.structures_cache:
+            return self.get_structures().get(uai.upper())
         structures = self.search_structure(uai)
         return structures[0] if structures else None
 
-    def search_structure(self, uai: str = None) -> List[StructureLdap]:
+    def get_structures(self) -> Dict[str, StructureLdap]:
+        """
+        Obtient l'ensemble des structures par UAI, depuis le cache partagé par les actions si celui-ci est activé.
+        :return: Structures par UAI
+        """
+        if not self.config.structures_cache:
+            return {structure.uai.upper(): structure for structure in self.search_structure()}
+        return STRUCTURES_CACHE.get(self.config.uri + '/' + self.config.structuresDN, self.search_structure,
+                                    self.config.structures_ttl)
+
+    def search_structure(self, uai: Union[str, List[str]] = None) -> List[StructureLdap]:
         """
         Recherche de structures.
-        :param uai: code établissement
+        :param uai: code établissement, ou liste de codes établissement
         :return: Liste des structures trouvées
         """
         ldap_filter = _get_filtre_etablissement(uai)
-        self.connection.search(self.config.structuresDN, ldap_filter,
-                               search_scope=LEVEL, attributes=
-                               ['ou', 'ENTStructureSIREN', 'ENTStructureTypeStruct', 'postalCode', 'ENTStructureUAI',
-                                'ESCODomaines', '+'])
-        return [StructureLdap(entry) for entry in self.connection.entries]
+        return list(self._search_paged(self.config.structuresDN, ldap_filter, StructureLdap,
+                                       attributes=get_attributs('structure')))
 
-    def search_personne(self, since_timestamp: datetime.datetime = None, **filters) -> List[PersonneLdap]:
+    def search_personne(self, since_timestamp: datetime.datetime = None, profil: str = 'personne',
+                        **filters) -> Iterator[PersonneLdap]:
         """
         Recherche de personnes.
         :param since_timestamp: datetime.datetime
+        :param profil: profil de projection des attributs ('uid-only' si seul l'uid est exploité)
         :param filters: Filtres à appliquer
-        :return: Liste des personnes
+        :return: Générateur des personnes
         """
         ldap_filter = _get_filtre_personnes(since_timestamp, **filters)
-        self.connection.search(self.config.personnesDN, ldap_filter,
-                               search_scope=LEVEL, attributes=
-                               ['objectClass', 'uid', 'sn', 'givenName', 'mail', 'ESCODomaines', 'ESCOUAICourant',
-                                'ENTPersonStructRattach', 'isMemberOf', '+'])
-        return [PersonneLdap(entry) for entry in self.connection.entries]
+        return self._search_paged(self.config.personnesDN, ldap_filter, PersonneLdap,
+                                  attributes=get_attributs(profil))
 
-    def search_eleve(self, since_timestamp: datetime.datetime = None, uai: str = None) -> List[EleveLdap]:
+    def search_eleve(self, since_timestamp: datetime.datetime = None, uai: Union[str, List[str]] = None) \
+            -> Iterator[EleveLdap]:
         """
         Recherche d'étudiants.
         :param since_timestamp: datetime.datetime
-        :param uai: code établissement
-        :return: Liste des étudiants correspondant
+        :param uai: code établissement, ou liste de codes établissement
+        :return: Générateur des étudiants correspondant
         """
         ldap_filter = _get_filtre_eleves(since_timestamp, uai)
-        self.connection.search(self.config.personnesDN, ldap_filter,
-                               search_scope=LEVEL, attributes=
-                               ['uid', 'sn', 'givenName', 'mail', 'ENTEleveClasses', 'ENTEleveNivFormation',
-                                'ESCODomaines', 'ESCOUAICourant', '+'])
-        return [EleveLdap(entry) for entry in self.connection.entries]
+        return self._search_paged(self.config.personnesDN, ldap_filter, EleveLdap,
+                                  attributes=get_attributs('eleve-sync'))
 
-    def search_eleves_in_classe(self, classe, uai):
+    def sync_eleve(self, uai: str, cookie: bytes = None) -> SyncResult:
+        """
+        Synchronisation incrémentale (RFC 4533) des étudiants d'un établissement.
+        :param uai: code établissement
+        :param cookie: cookie de la synchronisation précédente
+        :return: Résultat de la synchronisation
+        """
+        return self._sync(_get_filtre_eleves(uai=uai), EleveLdap, get_attributs('eleve-sync'), cookie)
+
+    def search_eleves_in_classe(self, classe, uai) -> Iterator[EleveLdap]:
         """
         Recherche les élèves dans une classe.
         :param classe:
         :param uai:
-        :return:
+        :return: Générateur des élèves de la classe
         """
         ldap_filter = '(&(ENTEleveClasses=*$%s)(ESCOUAI=%s))' % (ldap_escape(classe), ldap_escape(uai))
-        self.connection.search(self.config.personnesDN, ldap_filter,
-                               search_scope=LEVEL, attributes=
-                               ['uid', 'sn', 'givenName', 'mail', 'ENTEleveClasses', 'ENTEleveNivFormation',
-                                'ESCODomaines', 'ESCOUAICourant', '+'])
-        return [EleveLdap(entry) for entry in self.connection.entries]
+        return self._search_paged(self.config.personnesDN, ldap_filter, EleveLdap,
+                                  attributes=get_attributs('eleve-sync'))
 
-    def search_enseignant(self, since_timestamp: datetime.datetime = None, uai=None, tous=False) \
-            -> List[EnseignantLdap]:
+    def search_classes_index(self, uai: str, etab_dn: str) -> ClassesIndex:
+        """
+        Construit en une seule recherche l'index des membres des classes d'un établissement.
+        :param uai: code établissement
+        :param etab_dn: DN de la structure de l'établissement
+        :return: Index des membres des classes
+        """
+        ldap_filter = "(&(|(objectClass=ENTEleve)(objectClass=ENTAuxEnseignant)){uais})" \
+            .format(uais=_get_filtre_uais("ESCOUAI", uai))
+        index = ClassesIndex()
+        for entry in self._search_paged(self.config.personnesDN, ldap_filter, lambda entry: entry,
+                                        attributes=get_attributs('classes-index')):
+            index.add_entry(entry, etab_dn)
+        return index
+
+    def search_enseignant(self, since_timestamp: datetime.datetime = None, uai: Union[str, List[str]] = None,
+                          tous=False) -> Iterator[EnseignantLdap]:
         """
         Recherche d'enseignants.
         :param since_timestamp: datetime.datetime
-        :param uai: code etablissement
+        :param uai: code etablissement, ou liste de codes établissement
         :param tous: Si True, retourne également le personnel non enseignant
-        :return: Liste des enseignants
+        :return: Générateur des enseignants
         """
         ldap_filter = get_filtre_enseignants(since_timestamp, uai, tous)
-        self.connection.search(self.config.personnesDN,
-                               ldap_filter, LEVEL, attributes=
-                               ['objectClass', 'uid', 'sn', 'givenName', 'mail', 'ESCOUAI', 'ESCODomaines',
-                                'ESCOUAICourant', 'ENTPersonStructRattach', 'ENTPersonProfils', 'isMemberOf', '+',
-                                'ENTAuxEnsClasses'])
-        return [EnseignantLdap(entry) for entry in self.connection.entries]
+        return self._search_paged(self.config.personnesDN, ldap_filter, EnseignantLdap,
+                                  attributes=get_attributs('enseignant-sync'))
+
+    def sync_enseignant(self, uai: str, cookie: bytes = None) -> SyncResult:
+        """
+        Synchronisation incrémentale (RFC 4533) des enseignants d'un établissement.
+        :param uai: code établissement
+        :param cookie: cookie de la synchronisation précédente
+        :return: Résultat de la synchronisation
+        """
+        return self._sync(get_filtre_enseignants(uai=uai), EnseignantLdap, get_attributs('enseignant-sync'), cookie)
+
+    def _sync(self, ldap_filter: str, factory: Callable[[Entry], T], attributes: List[str],
+              cookie: bytes = None) -> SyncResult:
+        page_size = self.config.page_size if self.config.page_size and self.config.page_size > 0 else None
+        connection = self._current_connection()
+        result = sync_search(connection, self.config.personnesDN, ldap_filter, factory, attributes, cookie,
+                             page_size=page_size)
+        if result.refresh_required:
+            # Le cookie n'est plus valide côté serveur: rafraîchissement complet
+            log.warning("Cookie de synchronisation expiré, rafraîchissement complet (filtre=%s)", ldap_filter)
+            result = sync_search(connection, self.config.personnesDN, ldap_filter, factory, attributes,
+                                 page_size=page_size)
+        return result
+
+    def prefetch(self, uais: List[str], since_timestamps: Dict[str, datetime.datetime] = None) \
+            -> EtablissementsIndex:
+        """
+        Précharge les structures, élèves et enseignants d'une liste d'établissements.
+
+        Plutôt que trois recherches par établissement, les UAI sont regroupés par date de dernier traitement puis par
+        lots de prefetch_batch_size au sein d'un même filtre OU sur ESCOUAI.
+        :param uais: codes établissement
+        :param since_timestamps: date de dernier traitement par code établissement
+        :return: Index des données par UAI
+        """
+        index = EtablissementsIndex(uais)
+
+        uais_by_timestamp = {}  # type: Dict[datetime.datetime, List[str]]
+        for uai in uais:
+            since_timestamp = since_timestamps.get(uai) if since_timestamps else None
+            uais_by_timestamp.setdefault(since_timestamp, []).append(uai)
+
+        # Chaque lot fait l'objet d'une recherche, exécutée en parallèle si un pool de connexions est configuré
+        tasks = []  # type: List[Callable[[], Tuple[Callable, List]]]
+        if self.config.structures_cache:
+            structures = self.get_structures()
+            for uai in index.uais:
+                if uai in structures:
+                    index.add_structure(structures[uai])
+        else:
+            for batch in _batches(index.uais, self.config.prefetch_batch_size):
+                tasks.append(_prefetch_task(index.add_structure, self.search_structure, batch))
+        for since_timestamp, timestamp_uais in uais_by_timestamp.items():
+            for batch in _batches(timestamp_uais, self.config.prefetch_batch_size):
+                tasks.append(_prefetch_task(lambda eleve, uais=batch: index.add_eleve(eleve, uais),
+                                            self.search_eleve, since_timestamp, batch))
+                tasks.append(_prefetch_task(lambda enseignant, uais=batch: index.add_enseignant(enseignant, uais),
+                                            self.search_enseignant, since_timestamp, batch))
+
+        # L'index est alimenté depuis le thread principal
+        for add, items in self._run_parallel(tasks):
+            for item in items:
+                add(item)
+
+        return index
+
+    def _search_paged(self, search_base: str, ldap_filter: str, factory: Callable[[Entry], T],
+                      attributes: List[str]) -> Iterator[T]:
+        """
+        Effectue une recherche paginée via le contrôle Simple Paged Results (RFC 2696).
+
+        Les entrées de chaque page sont converties à l'aide de factory puis libérées avant la récupération de la
+        page suivante, ce qui permet de parcourir l'annuaire sans en conserver l'intégralité en mémoire.
+        :param search_base: DN de base de la recherche
+        :param ldap_filter: Filtre LDAP
+        :param factory: Fonction de construction des objets à partir des entrées LDAP
+        :param attributes: Attributs à récupérer
+        :return: Générateur des objets construits
+        """
+        page_size = self.config.page_size if self.config.page_size and self.config.page_size > 0 else None
+        connection = self._current_connection()
+        cookie = None
+        while True:
+            connection.search(search_base, ldap_filter, search_scope=LEVEL, attributes=attributes,
+                              paged_size=page_size, paged_cookie=cookie)
+            entries = connection.entries
+            cookie = get_paged_cookie(connection.result) if page_size else None
+            for entry in entries:
+                yield factory(entry)
+            del entries
+            if not cookie:
+                break
+
+    def dump(self, uais: List[str] = None, personnes: bool = False, **filters: Union[str, List[str]]) \
+            -> Iterator[Tuple[str, Dict[str, List[bytes]]]]:
+        """
+        Parcourt les entrées brutes consommées par la synchronisation: structures, élèves et enseignants des
+        établissements, et personnes correspondant aux filtres.
+        :param uais: codes établissement
+        :param personnes: parcourt l'ensemble des personnes plutôt que celles correspondant aux filtres
+        :param filters: Filtres de recherche de personnes
+        :return: Générateur des couples (DN, attributs bruts), sans doublon
+        """
+        attributes = sorted({attribute for profil in PROFILS_ATTRIBUTS.values() for attribute in profil} |
+                            {'objectClass'} | set(filters.keys()) | set(ATTRIBUTS_OPERATIONNELS))
+        searches = [(self.config.structuresDN, _get_filtre_etablissement())]
+        for batch in _batches(uais or [], self.config.prefetch_batch_size):
+            searches.append((self.config.personnesDN, _get_filtre_eleves(uai=batch)))
+            searches.append((self.config.personnesDN, get_filtre_enseignants(uai=batch, tous=True)))
+        if personnes:
+            searches.append((self.config.personnesDN, _get_filtre_personnes()))
+        elif filters:
+            searches.append((self.config.personnesDN, _get_filtre_personnes(**filters)))
+
+        dns = set()  # type: Set[str]
+        for search_base, ldap_filter in searches:
+            for dn, raw_attributes in self._search_paged(search_base, ldap_filter, _raw_entry, attributes=attributes):
+                if dn not in dns:
+                    dns.add(dn)
+                    yield dn, raw_attributes
 
     def get_domaines_etabs(self) -> Dict[str, List[str]]:
         """
         Obtient la liste des "ESCOUAICourant : Domaine" des établissements
         :return: Dictionnaire uai/list de domaines
         """
-        structures = self.search_structure()
+        structures = self.get_structures().values()
 
         etabs_ldap = {}
 
@@ -259,17 +779,48 @@ class Ldap:
         return etabs_ldap
 
 
-def _get_filtre_eleves(since_timestamp: datetime.datetime = None, uai: str = None) -> str:
+def _prefetch_task(add: Callable[[T], None], search: Callable[..., Iterable], *args) \
+        -> Callable[[], Tuple[Callable[[T], None], List[T]]]:
+    """
+    Construit une tâche de préchargement: la recherche est entièrement lue dans le thread qui l'exécute.
+    :param add: fonction d'ajout des résultats à l'index
+    :param search: méthode de recherche
+    :param args: arguments de la recherche
+    :return: tâche renvoyant la fonction d'ajout et les résultats
+    """
+    return lambda: (add, list(search(*args)))
+
+
+def _raw_entry(entry: Entry) -> Tuple[str, Dict[str, List[bytes]]]:
+    return entry.entry_dn, entry.entry_raw_attributes
+
+
+def _get_filtre_uais(attribute: str, uai: Union[str, List[str]]) -> str:
+    """
+    Construit le filtre sur un ou plusieurs codes établissement.
+
+    :param attribute: attribut portant le code établissement
+    :param uai: code établissement, ou liste de codes établissement
+    :return: Le filtre
+    """
+    uais = [uai] if isinstance(uai, str) else uai
+    filtre = "".join("({attribute}={uai})".format(attribute=attribute, uai=ldap_escape(item)) for item in uais)
+    if len(uais) > 1:
+        filtre = "(|" + filtre + ")"
+    return filtre
+
+
+def _get_filtre_eleves(since_timestamp: datetime.datetime = None, uai: Union[str, List[str]] = None) -> str:
     """
     Construit le filtre pour récupérer les élèves au sein du LDAP
 
     :param since_timestamp:
-    :param uai: code établissement
+    :param uai: code établissement, ou liste de codes établissement
     :return: Le filtre
     """
     filtre = "(&(objectClass=ENTEleve)"
     if uai:
-        filtre += "(ESCOUAI={uai})".format(uai=ldap_escape(uai))
+        filtre += _get_filtre_uais("ESCOUAI", uai)
     if since_timestamp:
         filtre += "(modifyTimeStamp>={since_timestamp})" \
             .format(since_timestamp=since_timestamp.strftime("%Y%m%d%H%M%SZ"))
@@ -277,12 +828,13 @@ def _get_filtre_eleves(since_timestamp: datetime.datetime = None, uai: str = Non
     return filtre
 
 
-def get_filtre_enseignants(since_timestamp: datetime.datetime = None, uai=None, tous=False) -> str:
+def get_filtre_enseignants(since_timestamp: datetime.datetime = None, uai: Union[str, List[str]] = None,
+                           tous=False) -> str:
     """
     Construit le filtre pour récupérer les enseignants au sein du LDAP.
 
     :param since_timestamp:
-    :param uai: code établissement
+    :param uai: code établissement, ou liste de codes établissement
     :param tous:
     :return: Le filtre
     """
@@ -298,7 +850,7 @@ def get_filtre_enseignants(since_timestamp: datetime.datetime = None, uai=None,
     filtre += "(!(uid=ADM00000))"
 
     if uai:
-        filtre += "(ESCOUAI={uai})".format(uai=ldap_escape(uai))
+        filtre += _get_filtre_uais("ESCOUAI", uai)
     if since_timestamp:
         filtre += "(modifyTimeStamp>={since_timestamp})" \
             .format(since_timestamp=since_timestamp.strftime("%Y%m%d%H%M%SZ"))
@@ -335,13 +887,13 @@ def _get_filtre_personnes(since_timestamp: datetime.datetime = None, **filters:
     return filtre
 
 
-def _get_filtre_etablissement(uai=None):
+def _get_filtre_etablissement(uai: Union[str, List[str]] = None):
     """Construit le filtre pour les établissements."""
     filtre = "(&(ObjectClass=ENTEtablissement)" \
              "(!(ENTStructureSiren=0000000000000A))"
 
     if uai:
-        filtre += "(ENTStructureUAI={uai})".format(uai=ldap_escape(uai))
+        filtre += _get_filtre_uais("ENTStructureUAI", uai)
 
     filtre += ")"
 
@@ -0,0 +1,90 @@
+# coding: utf-8
+"""
+Instantanés LDAP, pour rejouer une synchronisation sans annuaire
+"""
+
+import gzip
+import json
+from typing import Dict, List, Iterator, Iterable, Tuple, Union
+
+from ldap3 import Server, Connection, MOCK_SYNC
+
+from synchromoodle.config import LdapConfig
+from synchromoodle.ldaputils import Ldap
+
+
+def _open(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _decode(value: Union[bytes, str]) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def write_snapshot(path: str, entries: Iterable[Tuple[str, Dict[str, List[bytes]]]]) -> int:
+    """
+    Ecrit un instantané au format JSON lines, compressé si le nom du fichier se termine par .gz.
+    :param path: chemin du fichier
+    :param entries: couples (DN, attributs bruts)
+    :return: Nombre d'entrées écrites
+    """
+    count = 0
+    with _open(path, 'w') as snapshot_file:
+        for dn, attributes in entries:
+            attributes = {attribute: [_decode(value) for value in values]
+                          for attribute, values in attributes.items() if values}
+            snapshot_file.write(json.dumps({'dn': dn, 'attributes': attributes}, ensure_ascii=False))
+            snapshot_file.write('\n')
+            count += 1
+    return count
+
+
+def read_snapshot(path: str) -> Iterator[Tuple[str, Dict[str, List[str]]]]:
+    """
+    Lit un instantané écrit par write_snapshot.
+    :param path: chemin du fichier
+    :return: Générateur des couples (DN, attributs)
+    """
+    with _open(path, 'r') as snapshot_file:
+        for line in snapshot_file:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry['dn'], entry['attributes']
+
+
+class SnapshotLdap(Ldap):
+    """
+    Couche d'accès aux données du LDAP rejouant un instantané en mémoire, via la stratégie MOCK_SYNC de ldap3.
+
+    L'instantané est chargé une seule fois: toutes les connexions, y compris celles du pool, partagent le même
+    serveur simulé.
+    """
+
+    def __init__(self, config: LdapConfig, path: str = None):
+        super().__init__(config)
+        self.path = path or config.snapshot
+        self._server = None  # type: Server
+
+    def _open_connection(self) -> Connection:
+        if self._server is None:
+            server = Server('snapshot')
+            connection = Connection(server, client_strategy=MOCK_SYNC, raise_exceptions=True)
+            for dn, attributes in read_snapshot(self.path):
+                connection.strategy.add_entry(dn, attributes, validate=False)
+            self._server = server
+        connection = Connection(self._server, client_strategy=MOCK_SYNC, raise_exceptions=True)
+        connection.bind()
+        return connection
+
+
+def open_ldap(config: LdapConfig) -> Ldap:
+    """
+    Construit la couche d'accès au LDAP: l'annuaire configuré, ou l'instantané à rejouer s'il est renseigné.
+    :param config: Configuration LDAP
+    :return: Couche d'accès aux données du LDAP
+    """
+    if config.snapshot:
+        return SnapshotLdap(config)
+    return Ldap(config)
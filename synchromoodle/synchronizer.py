@@ -3,11 +3,13 @@
 Synchronizer
 """
 
+import copy
 import datetime
 import re
 import subprocess
+from collections import OrderedDict
 from logging import getLogger
-from typing import Dict, List
+from typing import Any, Dict, List, Iterable, Set, Tuple
 
 from synchromoodle.arguments import DEFAULT_ARGS
 from synchromoodle.config import EtablissementsConfig, Config, ActionConfig
@@ -15,7 +17,8 @@ from synchromoodle.dbutils import Database, PROFONDEUR_CTX_ETAB, COURSE_MODULES_
     PROFONDEUR_CTX_MODULE_ZONE_PRIVEE, \
     PROFONDEUR_CTX_BLOCK_ZONE_PRIVEE
 from synchromoodle.ldaputils import Ldap, EleveLdap, EnseignantLdap, PersonneLdap
-from synchromoodle.ldaputils import StructureLdap
+from synchromoodle.ldaputils import StructureLdap, EtablissementsIndex, ClassesIndex
+from synchromoodle.timestamp import FingerprintStore, fingerprint_fields
 
 #######################################
 # FORUM
@@ -74,6 +77,413 @@ def est_grp_etab(uai: str, etablissements_config: EtablissementsConfig):
     return False
 
 
+class AdminsLocauxIndex:
+    """
+    Index des groupes (isMemberOf) vers les utilisateurs, permettant de déterminer en une fois les administrateurs
+    locaux d'un contexte: chaque groupe distinct n'est testé qu'une seule fois.
+    """
+
+    def __init__(self, pattern: str):
+        self.matcher = re.compile(pattern, flags=re.IGNORECASE)
+        self.users_by_groupe = {}  # type: Dict[str, Set[int]]
+        self.infos_by_user = {}  # type: Dict[int, str]
+
+    def add(self, id_user: int, groupes: Iterable[str], infos: str = None):
+        """
+        Ajoute les groupes d'un utilisateur à l'index.
+        :param id_user: id de l'utilisateur
+        :param groupes: groupes de l'utilisateur
+        :param infos: informations de l'utilisateur, pour la journalisation
+        """
+        for groupe in groupes or ():
+            self.users_by_groupe.setdefault(groupe, set()).add(id_user)
+        if groupes:
+            self.infos_by_user[id_user] = infos
+
+    def admins(self) -> Set[int]:
+        """
+        :return: ids des utilisateurs membres d'un groupe d'administration
+        """
+        admins = set()  # type: Set[int]
+        for groupe, users in self.users_by_groupe.items():
+            if self.matcher.match(groupe):
+                admins.update(users)
+        return admins
+
+    def non_admins(self, admins: Set[int] = None) -> Set[int]:
+        """
+        :param admins: ids des utilisateurs membres d'un groupe d'administration, s'ils sont déjà calculés
+        :return: ids des utilisateurs membres d'au moins un groupe, mais d'aucun groupe d'administration
+        """
+        return self.infos_by_user.keys() - (self.admins() if admins is None else admins)
+
+    def resolve(self, planned_ids: 'PlannedIds') -> 'AdminsLocauxIndex':
+        """
+        :param planned_ids: ids provisoires des objets créés
+        :return: Copie de l'index dont les ids provisoires des utilisateurs créés sont remplacés par leur id réel
+        """
+        index = AdminsLocauxIndex(self.matcher.pattern)
+        for groupe, users in self.users_by_groupe.items():
+            index.users_by_groupe[groupe] = {planned_ids.resolve(id_user) for id_user in users}
+        for id_user, infos in self.infos_by_user.items():
+            index.infos_by_user[planned_ids.resolve(id_user)] = infos
+        return index
+
+
+class PlannedIds:
+    """
+    Ids provisoires, négatifs, des objets dont la création est demandée par le plan d'un établissement. Ils sont
+    remplacés par les ids réels lors de l'application du plan, et restent provisoires en mode simulation.
+    """
+
+    def __init__(self):
+        self.ids = {}  # type: Dict[int, int]
+        self.last_id = 0  # type: int
+
+    def allocate(self) -> int:
+        """
+        :return: Nouvel id provisoire
+        """
+        self.last_id -= 1
+        return self.last_id
+
+    @staticmethod
+    def planned(id_object: int) -> bool:
+        """
+        :param id_object: id réel ou provisoire
+        :return: True s'il s'agit d'un id provisoire
+        """
+        return id_object is not None and id_object < 0
+
+    def bind(self, planned_id: int, id_object: int):
+        """
+        Associe l'id réel d'un objet créé à son id provisoire.
+        :param planned_id: id provisoire
+        :param id_object: id réel
+        """
+        self.ids[planned_id] = id_object
+
+    def resolve(self, id_object: int) -> int:
+        """
+        :param id_object: id réel ou provisoire
+        :return: Id réel si l'objet a été créé, id inchangé sinon
+        """
+        return self.ids.get(id_object, id_object)
+
+    def resolve_row(self, row: tuple) -> tuple:
+        """
+        :param row: ligne de valeurs
+        :return: Ligne dont les ids provisoires des objets créés sont remplacés par leur id réel
+        """
+        return tuple(self.resolve(value) for value in row)
+
+
+class UserChanges:
+    """
+    Valeurs (firstname, lastname, email, maildisplay, theme) souhaitées pour les utilisateurs existants d'un
+    établissement, appliquées en une fois pour les seuls utilisateurs modifiés, et utilisateurs à créer.
+    """
+
+    def __init__(self):
+        self.values = OrderedDict()  # type: Dict[int, Tuple[str, str, str, int, str]]
+        self.usernames = {}  # type: Dict[int, str]
+        self.inserts = OrderedDict()  # type: Dict[str, Tuple[int, str, str, str, str, int, str]]
+
+    def insert(self, id_user: int, username: str, first_name: str, last_name: str, email: str, mail_display: int,
+               theme: str):
+        """
+        Demande la création d'un utilisateur.
+        :param id_user: id provisoire
+        :param username:
+        :param first_name:
+        :param last_name:
+        :param email:
+        :param mail_display:
+        :param theme:
+        """
+        self.inserts[username.lower()] = (id_user, username, first_name, last_name, email, mail_display, theme)
+
+    def get_inserted_id(self, username: str) -> int:
+        """
+        :param username:
+        :return: Id provisoire de l'utilisateur si sa création est demandée, None sinon
+        """
+        insert = self.inserts.get(username.lower())
+        return insert[0] if insert else None
+
+    def set(self, id_user: int, username: str, first_name: str, last_name: str, email: str, mail_display: int,
+            theme: str):
+        """
+        Demande les valeurs d'un utilisateur.
+        :param id_user:
+        :param username:
+        :param first_name:
+        :param last_name:
+        :param email:
+        :param mail_display:
+        :param theme:
+        """
+        self.values[id_user] = (first_name, last_name, email, mail_display, theme)
+        self.usernames[id_user] = username.lower()
+
+    def diff(self, existing: Dict[int, Tuple[str, str, str, int, str]]) -> List[Tuple[int, str, str, str, int, str]]:
+        """
+        :param existing: valeurs existantes
+        :return: Utilisateurs (id, firstname, lastname, email, maildisplay, theme) modifiés
+        """
+        return [(id_user,) + values for id_user, values in self.values.items() if existing.get(id_user) != values]
+
+
+class RoleAssignments:
+    """
+    Affectations de roles (roleid, contextid, userid) souhaitées pour les utilisateurs d'un établissement, appliquées
+    en une fois par différence avec les affectations existantes.
+    """
+
+    def __init__(self):
+        self.added = OrderedDict()  # type: Dict[Tuple[int, int, int], None]
+        self.removed = OrderedDict()  # type: Dict[Tuple[int, int, int], None]
+
+    def add(self, role_id: int, id_context: int, id_user: int):
+        """
+        Demande l'ajout d'un role à un utilisateur pour un contexte donné.
+        :param role_id:
+        :param id_context:
+        :param id_user:
+        """
+        row = (role_id, id_context, id_user)
+        self.removed.pop(row, None)
+        self.added[row] = None
+
+    def remove(self, role_id: int, id_context: int, id_user: int):
+        """
+        Demande la suppression d'un role à un utilisateur pour un contexte donné.
+        :param role_id:
+        :param id_context:
+        :param id_user:
+        """
+        row = (role_id, id_context, id_user)
+        self.added.pop(row, None)
+        self.removed[row] = None
+
+    def users(self) -> Set[int]:
+        """
+        :return: ids des utilisateurs concernés
+        """
+        return {row[2] for row in self.added} | {row[2] for row in self.removed}
+
+    def roles(self) -> Set[int]:
+        """
+        :return: ids des roles concernés
+        """
+        return {row[0] for row in self.added} | {row[0] for row in self.removed}
+
+    def resolve(self, planned_ids: PlannedIds) -> 'RoleAssignments':
+        """
+        :param planned_ids: ids provisoires des objets créés
+        :return: Copie des affectations dont les ids provisoires des objets créés sont remplacés par leur id réel
+        """
+        role_assignments = RoleAssignments()
+        for row in self.added:
+            role_assignments.added[planned_ids.resolve_row(row)] = None
+        for row in self.removed:
+            role_assignments.removed[planned_ids.resolve_row(row)] = None
+        return role_assignments
+
+
+class CohortMemberships:
+    """
+    Inscriptions (cohortid, userid) souhaitées pour les utilisateurs d'un établissement, appliquées en une fois par
+    différence avec les inscriptions existantes.
+    """
+
+    def __init__(self):
+        self.added = OrderedDict()  # type: Dict[Tuple[int, int], None]
+        self.cohorts_by_user = {}  # type: Dict[int, Set[int]]
+
+    def add(self, id_cohort: int, id_user: int):
+        """
+        Demande l'inscription d'un utilisateur dans une cohorte.
+        :param id_cohort:
+        :param id_user:
+        """
+        self.added[(id_cohort, id_user)] = None
+
+    def restrict(self, id_user: int, ids_cohorts: Iterable[int]):
+        """
+        Demande la désinscription d'un utilisateur de toutes les cohortes autres que celles données.
+        :param id_user:
+        :param ids_cohorts: ids des cohortes conservées
+        """
+        self.cohorts_by_user[id_user] = set(ids_cohorts)
+
+    def cohorts(self) -> Set[int]:
+        """
+        :return: ids des cohortes concernées par une inscription
+        """
+        return {row[0] for row in self.added}
+
+    def resolve(self, planned_ids: PlannedIds) -> 'CohortMemberships':
+        """
+        :param planned_ids: ids provisoires des objets créés
+        :return: Copie des inscriptions dont les ids provisoires des objets créés sont remplacés par leur id réel
+        """
+        cohort_memberships = CohortMemberships()
+        for row in self.added:
+            cohort_memberships.added[planned_ids.resolve_row(row)] = None
+        for id_user, ids_cohorts in self.cohorts_by_user.items():
+            cohort_memberships.restrict(planned_ids.resolve(id_user),
+                                        (planned_ids.resolve(id_cohort) for id_cohort in ids_cohorts))
+        return cohort_memberships
+
+    def diff(self, existing: Set[Tuple[int, int]]) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+        """
+        Calcule les inscriptions à ajouter et à supprimer.
+        :param existing: inscriptions existantes
+        :return: inscriptions à ajouter, inscriptions à supprimer
+        """
+        inserts = [row for row in self.added if row not in existing]
+        deletes = sorted(row for row in existing
+                         if row[1] in self.cohorts_by_user and row[0] not in self.cohorts_by_user[row[1]]
+                         and row not in self.added)
+        return inserts, deletes
+
+
+class ProfileFields:
+    """
+    Valeurs (userid, fieldid) -> data souhaitées pour les champs de profil des utilisateurs d'un établissement,
+    appliquées en une fois pour les seules valeurs modifiées.
+    """
+
+    def __init__(self):
+        self.values = OrderedDict()  # type: Dict[Tuple[int, int], str]
+
+    def set(self, id_user: int, id_field: int, data: str):
+        """
+        Demande la valeur d'un champ de profil d'un utilisateur.
+        :param id_user:
+        :param id_field:
+        :param data:
+        """
+        self.values[(id_user, id_field)] = data
+
+    def users(self) -> Set[int]:
+        """
+        :return: ids des utilisateurs concernés
+        """
+        return {key[0] for key in self.values}
+
+    def fields(self) -> Set[int]:
+        """
+        :return: ids des champs concernés
+        """
+        return {key[1] for key in self.values}
+
+    def diff(self, existing: Dict[Tuple[int, int], str]) -> List[Tuple[int, int, str]]:
+        """
+        :param existing: valeurs existantes
+        :return: Valeurs (userid, fieldid, data) absentes ou modifiées
+        """
+        return [key + (data,) for key, data in self.values.items() if existing.get(key) != data]
+
+    def resolve(self, planned_ids: PlannedIds) -> 'ProfileFields':
+        """
+        :param planned_ids: ids provisoires des objets créés
+        :return: Copie des valeurs dont les ids provisoires des utilisateurs créés sont remplacés par leur id réel
+        """
+        profile_fields = ProfileFields()
+        for (id_user, id_field), data in self.values.items():
+            profile_fields.set(planned_ids.resolve(id_user), id_field, data)
+        return profile_fields
+
+
+class CohortCreations:
+    """
+    Cohortes (contextid, name) dont la création est demandée pour un établissement, créées avant les inscriptions.
+    """
+
+    def __init__(self):
+        self.cohorts = OrderedDict()  # type: Dict[Tuple[int, str], Tuple[int, str, str, int]]
+
+    def add(self, id_cohort: int, id_context: int, name: str, id_number: str, description: str, time_created: int):
+        """
+        Demande la création d'une cohorte.
+        :param id_cohort: id provisoire
+        :param id_context:
+        :param name:
+        :param id_number:
+        :param description:
+        :param time_created:
+        """
+        self.cohorts[(id_context, name)] = (id_cohort, id_number, description, time_created)
+
+    def get(self, id_context: int, name: str) -> int:
+        """
+        :param id_context:
+        :param name:
+        :return: Id provisoire de la cohorte si sa création est demandée, None sinon
+        """
+        cohort = self.cohorts.get((id_context, name))
+        return cohort[0] if cohort else None
+
+
+class StructureChanges:
+    """
+    Créations et mises à jour de la catégorie, de la zone privée et du contexte du forum d'un établissement,
+    appliquées avant les autres modifications.
+    """
+
+    def __init__(self):
+        self.categorie = None  # type: Tuple[int, int, Any, str, str, str, str, str]
+        self.description = None  # type: Tuple[int, str, str]
+        self.zone_privee = None  # type: Tuple[int, int, str, str]
+        self.forum = None  # type: int
+
+    def names(self) -> List[str]:
+        """
+        :return: Noms des modifications demandées
+        """
+        return [name for name in ('categorie', 'description', 'zone_privee', 'forum') if getattr(self, name)]
+
+
+class ChangePlan:
+    """
+    Plan des modifications d'un établissement, calculé par différence entre l'état souhaité issu du LDAP et l'état
+    existant du Moodle. En mode simulation, il est écrit sans être appliqué: les objets à créer y figurent alors avec
+    un id provisoire négatif.
+    """
+
+    FIELDS = ('uai', 'structure_changes', 'users_inserted', 'users_updated', 'cohorts_created', 'role_grants',
+              'role_revocations', 'role_deletions', 'cohort_adds', 'cohort_removes', 'course_enrolments',
+              'field_updates')
+
+    def __init__(self, uai: str):
+        self.uai = uai  # type: str
+        self.structure_changes = []  # type: List[str]
+        self.users_inserted = []  # type: List[str]
+        self.users_updated = []  # type: List[str]
+        self.cohorts_created = []  # type: List[str]
+        self.role_grants = []  # type: List[Tuple[int, int, int]]
+        self.role_revocations = []  # type: List[Tuple[int, int, int]]
+        self.role_deletions = []  # type: List[int]
+        self.cohort_adds = []  # type: List[Tuple[int, int]]
+        self.cohort_removes = []  # type: List[Tuple[int, int]]
+        self.course_enrolments = []  # type: List[Tuple[int, int, int]]
+        self.field_updates = []  # type: List[Tuple[int, int, str]]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        :return: Plan sérialisable en JSON
+        """
+        return OrderedDict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def counts(self) -> Dict[str, int]:
+        """
+        :return: Nombre de modifications par type
+        """
+        return OrderedDict((name, len(getattr(self, name))) for name in self.FIELDS[1:])
+
+
 class SyncContext:
     """
     Contexte global de synchronisation
@@ -89,6 +499,8 @@ class SyncContext:
         self.id_field_classe = None  # type: int
         self.id_field_domaine = None  # type: int
         self.utilisateurs_by_cohortes = {}
+        self.etablissements_index = None  # type: EtablissementsIndex
+        self.admins_interetab = None  # type: AdminsLocauxIndex
 
 
 class EtablissementContext:
@@ -105,6 +517,17 @@ class EtablissementContext:
         self.gere_admin_local = None  # type: bool
         self.regexp_admin_moodle = None  # type: str
         self.regexp_admin_local = None  # type: str
+        self.admins_locaux = None  # type: AdminsLocauxIndex
+        self.plan = ChangePlan(uai)  # type: ChangePlan
+        self.planned_ids = PlannedIds()  # type: PlannedIds
+        self.structure = StructureChanges()  # type: StructureChanges
+        self.cohorts = CohortCreations()  # type: CohortCreations
+        self.role_deletions = OrderedDict()  # type: Dict[int, None]
+        self.course_enrolments = OrderedDict()  # type: Dict[Tuple[int, int, int], None]
+        self.users = UserChanges()  # type: UserChanges
+        self.role_assignments = RoleAssignments()  # type: RoleAssignments
+        self.cohort_memberships = CohortMemberships()  # type: CohortMemberships
+        self.profile_fields = ProfileFields()  # type: ProfileFields
         self.id_zone_privee = None  # type: int
         self.etablissement_theme = None  # type: str
         self.eleves_by_cohortes = {}
@@ -117,7 +540,7 @@ class Synchronizer:
     """
 
     def __init__(self, ldap: Ldap, db: Database, config: Config, action_config: ActionConfig = None,
-                 arguments=DEFAULT_ARGS):
+                 arguments=DEFAULT_ARGS, fingerprint_store: FingerprintStore = None):
         self.__webservice = WebService(config.webservice)  # type: WebService
         self.__ldap = ldap  # type: Ldap
         self.__db = db  # type: Database
@@ -125,6 +548,7 @@ class Synchronizer:
         self.__action_config = action_config if action_config \
             else next(iter(config.actions), ActionConfig())  # type: ActionConfig
         self.__arguments = arguments
+        self.__fingerprint_store = fingerprint_store  # type: FingerprintStore
         self.context = None  # type: SyncContext
 
     def initialize(self):
@@ -153,15 +577,80 @@ class Synchronizer:
         self.context.id_role_extended_teacher = self.__db.get_id_role_by_shortname('extendedteacher')
         self.context.id_role_advanced_teacher = self.__db.get_id_role_by_shortname('advancedteacher')
 
+        # Index des administrateurs inter-etablissements
+        self.context.admins_interetab = AdminsLocauxIndex(
+            self.__action_config.inter_etablissements.ldap_valeur_attribut_admin)
+
         # Recuperation de l'id du user info field pour la classe
         self.context.id_field_classe = self.__db.get_id_user_info_field_by_shortname('classe')
 
         # Recuperation de l'id du champ personnalisé Domaine
         self.context.id_field_domaine = self.__db.get_id_user_info_field_by_shortname('Domaine')
 
+    def prefetch(self, uais: List[str], since_timestamps: Dict[str, datetime.datetime] = None, log=getLogger()):
+        """
+        Précharge depuis l'annuaire les structures, élèves et enseignants des établissements à traiter.
+        :param uais: codes établissement
+        :param since_timestamps: date de dernier traitement par code établissement
+        :param log:
+        :return:
+        """
+        log.debug("Préchargement des données LDAP de %d établissements", len(uais))
+        self.context.etablissements_index = self.__ldap.prefetch(uais, since_timestamps)
+
+    def ensure_prefetched(self, uai: str, since_timestamp: datetime.datetime = None, log=getLogger()):
+        """
+        Précharge à nouveau un établissement qui ne figure plus dans l'index de préchargement, avant qu'il soit traité
+        une nouvelle fois.
+        :param uai: code établissement
+        :param since_timestamp: date de dernier traitement
+        :param log:
+        :return:
+        """
+        index = self.context.etablissements_index
+        if index is not None and uai not in index:
+            log.debug("Nouveau préchargement des données LDAP de l'établissement %s", uai)
+            index.update(self.__ldap.prefetch([uai], {uai: since_timestamp}))
+
+    def get_structure(self, uai: str) -> StructureLdap:
+        """
+        Obtient la structure d'un établissement, depuis l'index de préchargement si l'établissement y figure.
+        :param uai: code établissement
+        :return: La structure, ou None si non trouvée.
+        """
+        index = self.context.etablissements_index if self.context else None
+        if index is not None and uai in index:
+            return index.get_structure(uai)
+        return self.__ldap.get_structure(uai)
+
+    def get_eleves(self, uai: str, since_timestamp: datetime.datetime = None) -> Iterable[EleveLdap]:
+        """
+        Obtient les élèves d'un établissement, depuis l'index de préchargement si l'établissement y figure.
+        :param uai: code établissement
+        :param since_timestamp: date de dernier traitement
+        :return: Élèves de l'établissement
+        """
+        index = self.context.etablissements_index if self.context else None
+        if index is not None and uai in index:
+            return index.get_eleves(uai)
+        return self.__ldap.search_eleve(since_timestamp, uai)
+
+    def get_enseignants(self, uai: str, since_timestamp: datetime.datetime = None) -> Iterable[EnseignantLdap]:
+        """
+        Obtient les enseignants d'un établissement, depuis l'index de préchargement si l'établissement y figure.
+        :param uai: code établissement
+        :param since_timestamp: date de dernier traitement
+        :return: Enseignants de l'établissement
+        """
+        index = self.context.etablissements_index if self.context else None
+        if index is not None and uai in index:
+            return index.get_enseignants(uai)
+        return self.__ldap.search_enseignant(since_timestamp, uai)
+
     def handle_etablissement(self, uai, log=getLogger(), readonly=False) -> EtablissementContext:
         """
-        Synchronise un établissement
+        Synchronise un établissement. Aucune écriture n'est réalisée: la création de la catégorie, de la zone privée et
+        du contexte du forum est demandée au plan, avec des ids provisoires, et appliquée par handle_structure.
         :return: EtabContext
         """
         context = EtablissementContext(uai)
@@ -171,15 +660,19 @@ class Synchronizer:
         context.regexp_admin_moodle = self.__action_config.etablissements.prefixAdminMoodleLocal + ".*_%s$" % uai
         # Regex pour savoir si l'utilisateur est administrateur local
         context.regexp_admin_local = self.__action_config.etablissements.prefixAdminLocal + ".*_%s$" % uai
+        if context.gere_admin_local:
+            context.admins_locaux = AdminsLocauxIndex(context.regexp_admin_moodle)
 
         log.debug("Recherche de la structure dans l'annuaire")
-        structure_ldap = self.__ldap.get_structure(uai)
+        structure_ldap = self.get_structure(uai)
         if structure_ldap:
             log.debug("La structure a été trouvée")
             etablissement_path = "/1"
 
             # Si l'etablissement fait partie d'un groupement
             if context.etablissement_regroupe:
+                # La structure peut être partagée par l'index de préchargement
+                structure_ldap = copy.copy(structure_ldap)
                 etablissement_ou = context.etablissement_regroupe["nom"]
                 structure_ldap.uai = context.etablissement_regroupe["uais"][0]
                 log.debug("L'établissement fait partie d'un groupement: ou=%s, uai=%s",
@@ -191,46 +684,122 @@ class Synchronizer:
             # Recuperation du bon theme
             context.etablissement_theme = structure_ldap.uai.lower()
 
-            # Creation de la structure si elle n'existe pas encore
+            # Creation de la structure si elle n'existe pas encore, appliquée par handle_structure
+            planned_ids = context.planned_ids
             id_etab_categorie = self.__db.get_id_course_category_by_theme(context.etablissement_theme)
             if id_etab_categorie is None and not readonly:
-                log.info("Création de la structure")
-                self.insert_moodle_structure(context.etablissement_regroupe, structure_ldap.nom,
-                                             etablissement_path, etablissement_ou,
-                                             structure_ldap.siren, context.etablissement_theme)
-                id_etab_categorie = self.__db.get_id_course_category_by_id_number(structure_ldap.siren)
+                log.info("Création de la structure demandée")
+                id_etab_categorie = planned_ids.allocate()
+                context.id_context_categorie = planned_ids.allocate()
+                context.structure.categorie = (id_etab_categorie, context.id_context_categorie,
+                                               context.etablissement_regroupe, structure_ldap.nom, etablissement_path,
+                                               etablissement_ou, structure_ldap.siren, context.etablissement_theme)
 
             # Mise a jour de la description dans la cas d'un groupement d'etablissement
-            if context.etablissement_regroupe and not readonly:
+            if context.etablissement_regroupe and not readonly and not planned_ids.planned(id_etab_categorie):
                 description = self.__db.get_description_course_category(id_etab_categorie)
                 if description.find(structure_ldap.siren) == -1:
-                    log.info("Mise à jour de la description")
+                    log.info("Mise à jour de la description demandée")
                     description = "%s$%s@%s" % (description, structure_ldap.siren, structure_ldap.nom)
-                    self.__db.update_course_category_description(id_etab_categorie, description)
-                    self.__db.update_course_category_name(id_etab_categorie, etablissement_ou)
+                    context.structure.description = (id_etab_categorie, description, etablissement_ou)
 
             # Recuperation de l'id du contexte correspondant à l'etablissement
-            if id_etab_categorie is not None:
+            if id_etab_categorie is not None and not planned_ids.planned(id_etab_categorie):
                 context.id_context_categorie = self.__db.get_id_context_categorie(id_etab_categorie)
+                self.__db.load_cohorts_ids([context.id_context_categorie])
 
             context.id_zone_privee = self.__db.get_id_course_by_id_number("ZONE-PRIVEE-" + structure_ldap.siren)
 
             # Recreation de la zone privee si celle-ci n'existe plus
             if context.id_zone_privee is None and not readonly:
-                log.info("Création de la zone privée")
-                context.id_zone_privee = self.__db.insert_zone_privee(id_etab_categorie, structure_ldap.siren,
-                                                                      etablissement_ou, self.context.timestamp_now_sql)
+                log.info("Création de la zone privée demandée")
+                context.id_zone_privee = planned_ids.allocate()
+                context.structure.zone_privee = (context.id_zone_privee, id_etab_categorie, structure_ldap.siren,
+                                                 etablissement_ou)
 
-            if context.id_zone_privee is not None:
+            if context.id_zone_privee is not None and not planned_ids.planned(context.id_zone_privee):
                 context.id_context_course_forum = self.__db.get_id_context(self.__config.constantes.niveau_ctx_cours, 3,
                                                                            context.id_zone_privee)
             if context.id_context_course_forum is None and not readonly:
-                log.info("Création du cours associé à la zone privée")
-                context.id_context_course_forum = self.__db.insert_zone_privee_context(context.id_zone_privee)
+                log.info("Création du cours associé à la zone privée demandée")
+                context.id_context_course_forum = planned_ids.allocate()
+                context.structure.forum = context.id_context_course_forum
 
             context.structure_ldap = structure_ldap
         return context
 
+    def get_fingerprint_values(self, etablissement_context: EtablissementContext,
+                               personne_ldap: PersonneLdap) -> Dict[str, Any]:
+        """
+        Valeurs utilisées par Moodle d'une personne au sein d'un établissement: attributs LDAP, complétés du contexte
+        de l'établissement.
+        :param etablissement_context:
+        :param personne_ldap:
+        :return: valeur par champ
+        """
+        values = personne_ldap.fingerprint_values()
+        groupes = values.pop('is_member_of', None) or ()
+        # Seuls les groupes d'administration locale des enseignants sont utilisés
+        if isinstance(personne_ldap, EnseignantLdap) and etablissement_context.admins_locaux:
+            matcher = etablissement_context.admins_locaux.matcher
+            values['admin_local'] = sorted(groupe for groupe in groupes if matcher.match(groupe))
+        values['etablissement'] = [type(personne_ldap).__name__, etablissement_context.structure_ldap.type,
+                                   etablissement_context.etablissement_regroupe,
+                                   etablissement_context.etablissement_theme,
+                                   etablissement_context.id_context_categorie,
+                                   etablissement_context.id_context_course_forum,
+                                   etablissement_context.id_zone_privee,
+                                   etablissement_context.gere_admin_local]
+        values['domaine_etablissement'] = self.context.map_etab_domaine.get(personne_ldap.uai_courant) \
+            if personne_ldap.uai_courant else None
+        return values
+
+    def skip_unchanged(self, etablissement_context: EtablissementContext, personne_ldap: PersonneLdap,
+                       log=getLogger()) -> bool:
+        """
+        Compare l'empreinte d'une personne à celle enregistrée lors du dernier traitement de l'établissement.
+        :param etablissement_context:
+        :param personne_ldap:
+        :param log:
+        :return: True si la personne est inchangée et déjà présente dans Moodle, et peut donc être ignorée
+        """
+        if not self.__fingerprint_store:
+            return False
+        fields = fingerprint_fields(self.get_fingerprint_values(etablissement_context, personne_ldap))
+        changed = self.__fingerprint_store.changed_fields(etablissement_context.uai, personne_ldap.uid, fields)
+        if not changed and self.__db.has_user(personne_ldap.uid):
+            log.info("Utilisateur inchangé depuis le dernier traitement: %s", personne_ldap)
+            return True
+        log.info("Champs modifiés depuis le dernier traitement: %s", ", ".join(changed) or "aucun")
+        self.__fingerprint_store.stage(etablissement_context.uai, personne_ldap.uid, fields)
+        return False
+
+    def plan_user(self, etablissement_context: EtablissementContext, personne_ldap: PersonneLdap, mail_display: int,
+                  theme: str = None, log=getLogger()) -> int:
+        """
+        Demande la création ou la mise à jour d'un utilisateur au sein d'un établissement.
+        :param etablissement_context:
+        :param personne_ldap:
+        :param mail_display:
+        :param theme: theme de l'utilisateur, celui de l'établissement par défaut
+        :param log:
+        :return: Id de l'utilisateur, provisoire si sa création est demandée
+        """
+        if theme is None:
+            theme = etablissement_context.etablissement_theme
+        id_user = self.__db.get_user_id(personne_ldap.uid)
+        if id_user:
+            log.info("Mise à jour de l'utilisateur: %s", personne_ldap)
+            etablissement_context.users.set(id_user, personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn,
+                                            personne_ldap.mail, mail_display, theme)
+            return id_user
+        log.info("Ajout de l'utilisateur: %s", personne_ldap)
+        id_user = etablissement_context.users.get_inserted_id(personne_ldap.uid) \
+            or etablissement_context.planned_ids.allocate()
+        etablissement_context.users.insert(id_user, personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn,
+                                           personne_ldap.mail, mail_display, theme)
+        return id_user
+
     def handle_eleve(self, etablissement_context: EtablissementContext, eleve_ldap: EleveLdap, log=getLogger()):
         """
         Synchronise un élève au sein d'un établissement
@@ -241,31 +810,23 @@ class Synchronizer:
         """
         mail_display = self.__config.constantes.default_mail_display
         if not eleve_ldap.mail:
-            eleve_ldap.mail = self.__config.constantes.default_mail
+            eleve_ldap = eleve_ldap.evolve(mail=self.__config.constantes.default_mail)
             log.info("Le mail de l'élève n'est pas défini dans l'annuaire, "
                      "utilisation de la valeur par défault: %s", eleve_ldap.mail)
 
-        eleve_id = self.__db.get_user_id(eleve_ldap.uid)
-        if not eleve_id:
-            log.info("Ajout de l'utilisateur: %s", eleve_ldap)
-            self.__db.insert_moodle_user(eleve_ldap.uid, eleve_ldap.given_name,
-                                         eleve_ldap.sn, eleve_ldap.mail,
-                                         mail_display, etablissement_context.etablissement_theme)
-            eleve_id = self.__db.get_user_id(eleve_ldap.uid)
-        else:
-            log.info("Mise à jour de l'utilisateur: %s", eleve_ldap)
-            self.__db.update_moodle_user(eleve_id, eleve_ldap.given_name,
-                                         eleve_ldap.sn, eleve_ldap.mail, mail_display,
-                                         etablissement_context.etablissement_theme)
+        if self.skip_unchanged(etablissement_context, eleve_ldap, log=log):
+            return
+
+        eleve_id = self.plan_user(etablissement_context, eleve_ldap, mail_display, log=log)
 
         # Ajout ou suppression du role d'utilisateur avec droits limités Pour les eleves de college
         if etablissement_context.structure_ldap.type == self.__config.constantes.type_structure_clg:
             log.info("Ajout du rôle droit limités à l'utilisateur: %s", eleve_ldap)
-            self.__db.add_role_to_user(self.__config.constantes.id_role_utilisateur_limite,
-                                       self.__config.constantes.id_instance_moodle, eleve_id)
+            etablissement_context.role_assignments.add(self.__config.constantes.id_role_utilisateur_limite,
+                                                       self.__config.constantes.id_instance_moodle, eleve_id)
         else:
-            self.__db.remove_role_to_user(self.__config.constantes.id_role_utilisateur_limite,
-                                          self.__config.constantes.id_instance_moodle, eleve_id)
+            etablissement_context.role_assignments.remove(self.__config.constantes.id_role_utilisateur_limite,
+                                                          self.__config.constantes.id_instance_moodle, eleve_id)
             log.info(
                 "Suppression du role d'utilisateur avec des droits limites à l'utilisateur %s %s %s (id = %s)"
                 , eleve_ldap.given_name, eleve_ldap.sn, eleve_ldap.uid, str(eleve_id))
@@ -279,12 +840,9 @@ class Synchronizer:
         if eleve_classes_for_etab:
             log.info("Inscription de l'élève %s "
                      "dans les cohortes de classes %s", eleve_ldap, eleve_classes_for_etab)
-            ids_classes_cohorts = self.get_or_create_classes_cohorts(etablissement_context.id_context_categorie,
-                                                                     eleve_classes_for_etab,
-                                                                     self.context.timestamp_now_sql,
-                                                                     log=log)
+            ids_classes_cohorts = self.plan_classes_cohorts(etablissement_context, eleve_classes_for_etab, log=log)
             for ids_classe_cohorts in ids_classes_cohorts:
-                self.__db.enroll_user_in_cohort(ids_classe_cohorts, eleve_id, self.context.timestamp_now_sql)
+                etablissement_context.cohort_memberships.add(ids_classe_cohorts, eleve_id)
 
             eleve_cohorts.extend(ids_classes_cohorts)
 
@@ -292,15 +850,13 @@ class Synchronizer:
         if eleve_ldap.niveau_formation:
             log.info("Inscription de l'élève %s "
                      "dans la cohorte de niveau de formation %s", eleve_ldap, eleve_ldap.niveau_formation)
-            id_formation_cohort = self.get_or_create_formation_cohort(etablissement_context.id_context_categorie,
-                                                                      eleve_ldap.niveau_formation,
-                                                                      self.context.timestamp_now_sql,
-                                                                      log=log)
-            self.__db.enroll_user_in_cohort(id_formation_cohort, eleve_id, self.context.timestamp_now_sql)
+            id_formation_cohort = self.plan_formation_cohort(etablissement_context, eleve_ldap.niveau_formation,
+                                                             log=log)
+            etablissement_context.cohort_memberships.add(id_formation_cohort, eleve_id)
             eleve_cohorts.append(id_formation_cohort)
 
         log.info("Désinscription de l'élève %s des anciennes cohortes", eleve_ldap)
-        self.__db.disenroll_user_from_cohorts(eleve_cohorts, eleve_id)
+        etablissement_context.cohort_memberships.restrict(eleve_id, eleve_cohorts)
 
         # Mise a jour des dictionnaires concernant les cohortes
         for cohort_id in eleve_cohorts:
@@ -312,13 +868,7 @@ class Synchronizer:
                 etablissement_context.eleves_by_cohortes[cohort_id] = [eleve_id]
 
         # Mise a jour de la classe
-        id_user_info_data = self.__db.get_id_user_info_data(eleve_id, self.context.id_field_classe)
-        if id_user_info_data is not None:
-            self.__db.update_user_info_data(eleve_id, self.context.id_field_classe, eleve_ldap.classe.classe)
-            log.debug("Mise à jour user_info_data")
-        else:
-            self.__db.insert_moodle_user_info_data(eleve_id, self.context.id_field_classe, eleve_ldap.classe.classe)
-            log.debug("Insertion user_info_data")
+        etablissement_context.profile_fields.set(eleve_id, self.context.id_field_classe, eleve_ldap.classe.classe)
 
         # Mise a jour du Domaine
         user_domain = self.__config.constantes.default_domain
@@ -327,8 +877,7 @@ class Synchronizer:
         else:
             if eleve_ldap.uai_courant and eleve_ldap.uai_courant in self.context.map_etab_domaine:
                 user_domain = self.context.map_etab_domaine[eleve_ldap.uai_courant][0]
-        log.debug("Insertion du Domaine")
-        self.__db.set_user_domain(eleve_id, self.context.id_field_domaine, user_domain)
+        etablissement_context.profile_fields.set(eleve_id, self.context.id_field_domaine, user_domain)
 
     def handle_enseignant(self, etablissement_context: EtablissementContext, enseignant_ldap: EnseignantLdap,
                           log=getLogger()):
@@ -341,11 +890,17 @@ class Synchronizer:
         """
         enseignant_infos = "%s %s %s" % (enseignant_ldap.uid, enseignant_ldap.given_name, enseignant_ldap.sn)
 
+        # Theme de l'établissement courant de l'enseignant, sans modifier celui du contexte partagé par les
+        # enseignants suivants
+        theme = etablissement_context.etablissement_theme
         if enseignant_ldap.uai_courant and not etablissement_context.etablissement_regroupe:
-            etablissement_context.etablissement_theme = enseignant_ldap.uai_courant.lower()
+            theme = enseignant_ldap.uai_courant.lower()
 
         if not enseignant_ldap.mail:
-            enseignant_ldap.mail = self.__config.constantes.default_mail
+            enseignant_ldap = enseignant_ldap.evolve(mail=self.__config.constantes.default_mail)
+
+        if self.skip_unchanged(etablissement_context, enseignant_ldap, log=log):
+            return
 
         # Affichage du mail reserve aux membres de cours
         mail_display = self.__config.constantes.default_mail_display
@@ -354,73 +909,55 @@ class Synchronizer:
             mail_display = 0
 
         # Insertion de l'enseignant
-        id_user = self.__db.get_user_id(enseignant_ldap.uid)
-        if not id_user:
-            self.__db.insert_moodle_user(enseignant_ldap.uid, enseignant_ldap.given_name, enseignant_ldap.sn,
-                                         enseignant_ldap.mail,
-                                         mail_display, etablissement_context.etablissement_theme)
-            id_user = self.__db.get_user_id(enseignant_ldap.uid)
-        else:
-            self.__db.update_moodle_user(id_user, enseignant_ldap.given_name, enseignant_ldap.sn, enseignant_ldap.mail,
-                                         mail_display, etablissement_context.etablissement_theme)
+        id_user = self.plan_user(etablissement_context, enseignant_ldap, mail_display, theme=theme, log=log)
 
-        # Mise à jour des droits sur les anciens etablissement
-        if enseignant_ldap.uais is not None and not etablissement_context.etablissement_regroupe:
+        # Mise à jour des droits sur les anciens etablissement, sans objet pour un utilisateur à créer
+        if enseignant_ldap.uais is not None and not etablissement_context.etablissement_regroupe \
+                and not etablissement_context.planned_ids.planned(id_user):
             # Recuperation des uais des etablissements dans lesquels l'enseignant est autorise
-            self.mettre_a_jour_droits_enseignant(enseignant_infos, id_user, enseignant_ldap.uais, log=log)
+            self.mettre_a_jour_droits_enseignant(etablissement_context, enseignant_infos, id_user,
+                                                 enseignant_ldap.uais, log=log)
+
+        # Les roles sont appliqués par handle_role_assignments
+        role_assignments = etablissement_context.role_assignments
 
         # Ajout du role de createur de cours au niveau de la categorie inter-etablissement Moodle
-        self.__db.add_role_to_user(self.__config.constantes.id_role_createur_cours,
-                                   self.context.id_context_categorie_inter_etabs, id_user)
+        role_assignments.add(self.__config.constantes.id_role_createur_cours,
+                             self.context.id_context_categorie_inter_etabs, id_user)
         log.info("Ajout du role de createur de cours dans la categorie inter-etablissements")
 
         # Si l'enseignant fait partie d'un CFA
         # Ajout du role createur de cours au niveau de la categorie inter-cfa
         if etablissement_context.structure_ldap.type == self.__config.constantes.type_structure_cfa:
-            self.__db.add_role_to_user(self.__config.constantes.id_role_createur_cours,
-                                       self.context.id_context_categorie_inter_cfa, id_user)
+            role_assignments.add(self.__config.constantes.id_role_createur_cours,
+                                 self.context.id_context_categorie_inter_cfa, id_user)
             log.info("Ajout du role de createur de cours dans la categorie inter-cfa")
 
         # ajout du role de createur de cours dans l'etablissement
-        self.__db.add_role_to_user(self.__config.constantes.id_role_createur_cours,
-                                   etablissement_context.id_context_categorie, id_user)
+        role_assignments.add(self.__config.constantes.id_role_createur_cours,
+                             etablissement_context.id_context_categorie, id_user)
 
         # Ajouts des autres roles pour le personnel établissement
         if set(enseignant_ldap.profils).intersection(['National_ENS', 'National_DIR', 'National_EVS', 'National_ETA']):
             # Ajout des roles sur le contexte forum
-            self.__db.add_role_to_user(self.__config.constantes.id_role_eleve,
-                                       etablissement_context.id_context_course_forum, id_user)
-            # Inscription à la Zone Privée
-            self.__db.enroll_user_in_course(self.__config.constantes.id_role_eleve,
-                                            etablissement_context.id_zone_privee, id_user)
+            role_assignments.add(self.__config.constantes.id_role_eleve,
+                                 etablissement_context.id_context_course_forum, id_user)
+            # Inscription à la Zone Privée, appliquée par handle_course_enrolments
+            etablissement_context.course_enrolments[(self.__config.constantes.id_role_eleve,
+                                                     etablissement_context.id_zone_privee, id_user)] = None
 
             if set(enseignant_ldap.profils).intersection(['National_ENS', 'National_EVS', 'National_ETA']):
                 if not etablissement_context.gere_admin_local:
-                    self.__db.add_role_to_user(self.context.id_role_extended_teacher,
-                                               etablissement_context.id_context_categorie,
-                                               id_user)
+                    role_assignments.add(self.context.id_role_extended_teacher,
+                                         etablissement_context.id_context_categorie,
+                                         id_user)
             elif 'National_DIR' in enseignant_ldap.profils:
-                self.__db.add_role_to_user(self.__config.constantes.id_role_directeur,
-                                           etablissement_context.id_context_categorie, id_user)
+                role_assignments.add(self.__config.constantes.id_role_directeur,
+                                     etablissement_context.id_context_categorie, id_user)
 
-        # Ajout des droits d'administration locale pour l'etablissement
+        # Droits d'administration locale pour l'etablissement, appliqués par handle_admins_locaux
         if etablissement_context.gere_admin_local:
-            for member in enseignant_ldap.is_member_of:
-                # L'enseignant est il administrateur Moodle ?
-                admin_moodle = re.match(etablissement_context.regexp_admin_moodle, member, flags=re.IGNORECASE)
-                if admin_moodle:
-                    self.__db.insert_moodle_local_admin(etablissement_context.id_context_categorie, id_user)
-                    log.info("Insertion d'un admin  local %s %s %s",
-                             enseignant_ldap.uid, enseignant_ldap.given_name, enseignant_ldap.sn)
-                    # Si il est admin local on en fait un utilisateur avancé par default
-                    if not self.__db.is_enseignant_avance(id_user, self.context.id_role_advanced_teacher):
-                        self.__db.add_role_to_user(self.context.id_role_advanced_teacher, 1, id_user)
-                    break
-                else:
-                    delete = self.__db.delete_moodle_local_admin(self.context.id_context_categorie_inter_etabs, id_user)
-                    if delete:
-                        log.info("Suppression d'un admin local %s %s %s",
-                                 enseignant_ldap.uid, enseignant_ldap.given_name, enseignant_ldap.sn)
+            etablissement_context.admins_locaux.add(id_user, enseignant_ldap.is_member_of, enseignant_infos)
 
         # Inscription dans les cohortes associees aux classes
         enseignant_cohorts = []
@@ -433,22 +970,18 @@ class Synchronizer:
                      enseignant_ldap, enseignant_classes_for_etab)
             name_pattern = "Profs de la Classe %s"
             desc_pattern = "Profs de la Classe %s"
-            ids_classes_cohorts = self.get_or_create_classes_cohorts(etablissement_context.id_context_categorie,
-                                                                     enseignant_classes_for_etab,
-                                                                     self.context.timestamp_now_sql,
-                                                                     name_pattern=name_pattern,
-                                                                     desc_pattern=desc_pattern,
-                                                                     log=log)
+            ids_classes_cohorts = self.plan_classes_cohorts(etablissement_context, enseignant_classes_for_etab,
+                                                            name_pattern=name_pattern, desc_pattern=desc_pattern,
+                                                            log=log)
             for ids_classe_cohorts in ids_classes_cohorts:
-                self.__db.enroll_user_in_cohort(ids_classe_cohorts, id_user, self.context.timestamp_now_sql)
+                etablissement_context.cohort_memberships.add(ids_classe_cohorts, id_user)
 
             enseignant_cohorts.extend(ids_classes_cohorts)
 
         log.info("Inscription de l'enseignant %s dans la cohorte d'enseignants de l'établissement", enseignant_ldap)
-        id_prof_etabs_cohort = self.get_or_create_profs_etab_cohort(etablissement_context, log)
+        id_prof_etabs_cohort = self.plan_profs_etab_cohort(etablissement_context, log)
 
-        id_user = self.__db.get_user_id(enseignant_ldap.uid)
-        self.__db.enroll_user_in_cohort(id_prof_etabs_cohort, id_user, self.context.timestamp_now_sql)
+        etablissement_context.cohort_memberships.add(id_prof_etabs_cohort, id_user)
 
         # Mise a jour des dictionnaires concernant les cohortes
         for cohort_id in enseignant_cohorts:
@@ -466,8 +999,7 @@ class Synchronizer:
         else:
             if enseignant_ldap.uai_courant and enseignant_ldap.uai_courant in self.context.map_etab_domaine:
                 user_domain = self.context.map_etab_domaine[enseignant_ldap.uai_courant][0]
-        log.debug("Insertion du Domaine")
-        self.__db.set_user_domain(id_user, self.context.id_field_domaine, user_domain)
+        etablissement_context.profile_fields.set(id_user, self.context.id_field_domaine, user_domain)
 
     def handle_user_interetab(self, personne_ldap: PersonneLdap, log=getLogger()):
         """
@@ -477,16 +1009,15 @@ class Synchronizer:
         :return:
         """
         if not personne_ldap.mail:
-            personne_ldap.mail = self.__config.constantes.default_mail
+            personne_ldap = personne_ldap.evolve(mail=self.__config.constantes.default_mail)
 
         # Creation de l'utilisateur
         id_user = self.__db.get_user_id(personne_ldap.uid)
         if not id_user:
-            self.__db.insert_moodle_user(personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn,
-                                         personne_ldap.mail,
-                                         self.__config.constantes.default_mail_display,
-                                         self.__config.constantes.default_moodle_theme)
-            id_user = self.__db.get_user_id(personne_ldap.uid)
+            id_user = self.__db.insert_moodle_user(personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn,
+                                                   personne_ldap.mail,
+                                                   self.__config.constantes.default_mail_display,
+                                                   self.__config.constantes.default_moodle_theme)
         else:
             self.__db.update_moodle_user(id_user, personne_ldap.given_name, personne_ldap.sn, personne_ldap.mail,
                                          self.__config.constantes.default_mail_display,
@@ -496,21 +1027,270 @@ class Synchronizer:
         self.__db.add_role_to_user(self.__config.constantes.id_role_createur_cours,
                                    self.context.id_context_categorie_inter_etabs, id_user)
 
-        # Attribution du role admin local si necessaire
-        for member in personne_ldap.is_member_of:
-            admin = re.match(self.__action_config.inter_etablissements.ldap_valeur_attribut_admin, member,
-                             flags=re.IGNORECASE)
-            if admin:
-                insert = self.__db.insert_moodle_local_admin(self.context.id_context_categorie_inter_etabs, id_user)
-                if insert:
-                    log.info("Insertion d'un admin local %s %s %s",
-                             personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn)
-                break
-            else:
-                delete = self.__db.delete_moodle_local_admin(self.context.id_context_categorie_inter_etabs, id_user)
-                if delete:
-                    log.info("Suppression d'un admin local %s %s %s",
-                             personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn)
+        # Attribution du role admin local si necessaire, appliquée par handle_admins_interetab
+        self.context.admins_interetab.add(id_user, personne_ldap.is_member_of, "%s %s %s" % (
+            personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn))
+
+    @property
+    def dry_run(self) -> bool:
+        """
+        Mode simulation: les plans des établissements sont calculés sans être appliqués.
+        """
+        return bool(getattr(self.__arguments, 'dry_run', None))
+
+    def apply_plan(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Applique le plan d'un établissement calculé par handle_etablissement, handle_eleve et handle_enseignant: les
+        objets à créer le sont en premier, et leurs ids provisoires sont remplacés par leur id réel dans les
+        modifications suivantes. En mode simulation, le plan est complété sans qu'aucune écriture ne soit réalisée.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        self.handle_structure(etablissement_context, log=log)
+        self.handle_users(etablissement_context, log=log)
+        self.handle_cohorts(etablissement_context, log=log)
+        self.handle_role_deletions(etablissement_context, log=log)
+        self.handle_role_assignments(etablissement_context, log=log)
+        self.handle_cohort_memberships(etablissement_context, log=log)
+        self.handle_course_enrolments(etablissement_context, log=log)
+        self.handle_profile_fields(etablissement_context, log=log)
+        self.handle_admins_locaux(etablissement_context, log=log)
+
+    def handle_structure(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Crée ou met à jour la catégorie, la zone privée et le contexte du forum demandés par handle_etablissement.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        structure = etablissement_context.structure
+        planned_ids = etablissement_context.planned_ids
+        etablissement_context.plan.structure_changes.extend(structure.names())
+        if not self.dry_run:
+            if structure.categorie:
+                log.info("Création de la structure")
+                id_categorie, id_context, grp, nom, path, ou, siren, theme = structure.categorie
+                self.insert_moodle_structure(grp, nom, path, ou, siren, theme)
+                id_etab_categorie = self.__db.get_id_course_category_by_id_number(siren)
+                planned_ids.bind(id_categorie, id_etab_categorie)
+                planned_ids.bind(id_context, self.__db.get_id_context_categorie(id_etab_categorie))
+            if structure.description:
+                log.info("Mise à jour de la description")
+                id_categorie, description, ou = structure.description
+                self.__db.update_course_category_description(id_categorie, description)
+                self.__db.update_course_category_name(id_categorie, ou)
+            if structure.zone_privee:
+                log.info("Création de la zone privée")
+                id_zone_privee, id_categorie, siren, ou = structure.zone_privee
+                planned_ids.bind(id_zone_privee, self.__db.insert_zone_privee(planned_ids.resolve(id_categorie), siren,
+                                                                              ou, self.context.timestamp_now_sql))
+            if structure.forum:
+                log.info("Création du cours associé à la zone privée")
+                id_zone_privee = planned_ids.resolve(etablissement_context.id_zone_privee)
+                planned_ids.bind(structure.forum, self.__db.insert_zone_privee_context(id_zone_privee))
+        etablissement_context.id_context_categorie = planned_ids.resolve(etablissement_context.id_context_categorie)
+        etablissement_context.id_zone_privee = planned_ids.resolve(etablissement_context.id_zone_privee)
+        etablissement_context.id_context_course_forum = planned_ids.resolve(
+            etablissement_context.id_context_course_forum)
+        etablissement_context.structure = StructureChanges()
+
+    def handle_users(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Applique en une fois les créations et mises à jour d'utilisateurs demandées par handle_eleve et
+        handle_enseignant: les valeurs existantes sont lues en une seule requête, et seuls les utilisateurs modifiés
+        sont écrits.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        users = etablissement_context.users
+        for username, (id_user, _, first_name, last_name, email, mail_display, theme) in users.inserts.items():
+            etablissement_context.plan.users_inserted.append(username)
+            if not self.dry_run:
+                etablissement_context.planned_ids.bind(id_user, self.__db.insert_moodle_user(
+                    username, first_name, last_name, email, mail_display, theme))
+        rows = users.diff(self.__db.get_user_rows(sorted(users.values)))
+        etablissement_context.plan.users_updated.extend(users.usernames[row[0]] for row in rows)
+        if not self.dry_run:
+            self.__db.update_moodle_user_rows(rows)
+        log.info("Mise à jour des utilisateurs: %d ajout(s), %d modification(s)", len(users.inserts), len(rows))
+        etablissement_context.users = UserChanges()
+
+    def handle_cohorts(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Crée les cohortes demandées par handle_eleve et handle_enseignant, avant les inscriptions.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        planned_ids = etablissement_context.planned_ids
+        for (id_context, name), (id_cohort, id_number, description, time_created) \
+                in etablissement_context.cohorts.cohorts.items():
+            etablissement_context.plan.cohorts_created.append(name)
+            if not self.dry_run:
+                planned_ids.bind(id_cohort, self.get_or_create_cohort(planned_ids.resolve(id_context), name, id_number,
+                                                                      description, time_created, log=log))
+        etablissement_context.cohorts = CohortCreations()
+
+    def handle_role_deletions(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Supprime en une fois les roles non autorisés relevés par mettre_a_jour_droits_enseignant.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        ids_roles = list(etablissement_context.role_deletions)
+        etablissement_context.plan.role_deletions.extend(ids_roles)
+        if ids_roles and not self.dry_run:
+            self.__db.delete_roles(ids_roles)
+        log.info("Suppression des roles non autorisés: %d suppression(s)", len(ids_roles))
+        etablissement_context.role_deletions = OrderedDict()
+
+    def handle_role_assignments(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Applique en une fois les roles demandés par handle_eleve et handle_enseignant: les affectations existantes
+        des utilisateurs sont lues en une seule requête, et seule la différence est écrite.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        role_assignments = etablissement_context.role_assignments.resolve(etablissement_context.planned_ids)
+        existing = self.__db.get_role_assignment_rows(sorted(role_assignments.users()),
+                                                      sorted(role_assignments.roles()))
+        inserts = [row for row in role_assignments.added if row not in existing]
+        deletes = [row for row in role_assignments.removed if row in existing]
+        etablissement_context.plan.role_grants.extend(inserts)
+        etablissement_context.plan.role_revocations.extend(deletes)
+        if not self.dry_run:
+            self.__db.insert_role_assignment_rows(inserts)
+            self.__db.delete_role_assignment_rows(deletes)
+        log.info("Mise à jour des roles: %d ajout(s), %d suppression(s)", len(inserts), len(deletes))
+        etablissement_context.role_assignments = RoleAssignments()
+
+    def handle_cohort_memberships(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Applique en une fois les inscriptions aux cohortes demandées par handle_eleve et handle_enseignant: les
+        inscriptions existantes sont lues en une seule requête, et seule la différence est écrite.
+        :param etablissement_context:
+        :param log:
+        :return: Nombre d'inscriptions ajoutées et supprimées, par cohorte
+        """
+        cohort_memberships = etablissement_context.cohort_memberships.resolve(etablissement_context.planned_ids)
+        # La réconciliation côté serveur ne détaille pas les inscriptions: elle n'est pas utilisée en simulation
+        staging = self.__config.database.staging if not self.dry_run else 0
+        if staging and len(cohort_memberships.added) + len(cohort_memberships.cohorts_by_user) >= staging:
+            # Ecart important: réconciliation côté serveur via des tables temporaires
+            counts = self.__db.reconcile_cohort_members(list(cohort_memberships.added),
+                                                        cohort_memberships.cohorts_by_user,
+                                                        self.context.timestamp_now_sql)
+        else:
+            existing = self.__db.get_cohort_member_rows(sorted(cohort_memberships.cohorts()),
+                                                        sorted(cohort_memberships.cohorts_by_user))
+            inserts, deletes = cohort_memberships.diff(existing)
+            etablissement_context.plan.cohort_adds.extend(inserts)
+            etablissement_context.plan.cohort_removes.extend(deletes)
+            if not self.dry_run:
+                self.__db.insert_cohort_member_rows(inserts, self.context.timestamp_now_sql)
+                self.__db.delete_cohort_member_rows(deletes)
+
+            counts = {}  # type: Dict[int, List[int]]
+            for id_cohort, _ in inserts:
+                counts.setdefault(id_cohort, [0, 0])[0] += 1
+            for id_cohort, _ in deletes:
+                counts.setdefault(id_cohort, [0, 0])[1] += 1
+        for id_cohort, (added, removed) in sorted(counts.items()):
+            log.info("Mise à jour de la cohorte %s: %d inscription(s), %d désinscription(s)", id_cohort, added, removed)
+        etablissement_context.cohort_memberships = CohortMemberships()
+        return counts
+
+    def handle_profile_fields(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Applique en une fois les champs de profil (classe, Domaine) demandés par handle_eleve et handle_enseignant: les
+        valeurs existantes sont lues en une seule requête, et seules les valeurs modifiées sont écrites.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        profile_fields = etablissement_context.profile_fields.resolve(etablissement_context.planned_ids)
+        existing = self.__db.get_user_info_data_rows(sorted(profile_fields.users()), sorted(profile_fields.fields()))
+        rows = profile_fields.diff(existing)
+        etablissement_context.plan.field_updates.extend(rows)
+        if not self.dry_run:
+            self.__db.upsert_user_info_data_rows(rows)
+        log.info("Mise à jour des champs de profil: %d valeur(s) modifiée(s)", len(rows))
+        etablissement_context.profile_fields = ProfileFields()
+
+    def handle_course_enrolments(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Applique en une fois les inscriptions aux zones privées demandées par handle_enseignant: les inscriptions
+        existantes sont lues en une seule requête, et seules les inscriptions absentes sont écrites.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        planned_ids = etablissement_context.planned_ids
+        rows = [planned_ids.resolve_row(row) for row in etablissement_context.course_enrolments]
+        existing = self.__db.get_course_enrolment_rows(sorted({row[2] for row in rows}),
+                                                       sorted({row[1] for row in rows}))
+        inserts = [row for row in rows if row not in existing]
+        etablissement_context.plan.course_enrolments.extend(inserts)
+        if not self.dry_run:
+            for role_id, id_course, id_user in inserts:
+                self.__db.enroll_user_in_course(role_id, id_course, id_user)
+        log.info("Inscription aux zones privées: %d inscription(s)", len(inserts))
+        etablissement_context.course_enrolments = OrderedDict()
+
+    def handle_admins_locaux(self, etablissement_context: EtablissementContext, log=getLogger()):
+        """
+        Met à jour en une fois les administrateurs locaux d'un établissement, à partir des groupes des enseignants
+        traités par handle_enseignant. Les affectations ajoutées et supprimées sont enregistrées dans le plan.
+        :param etablissement_context:
+        :param log:
+        :return:
+        """
+        index = etablissement_context.admins_locaux
+        if not index:
+            return
+        index = index.resolve(etablissement_context.planned_ids)
+        admins = index.admins()
+        id_role_admin_local = self.__db.get_id_role_admin_local()
+        ids_admins = self.__db.get_users_with_role(id_role_admin_local, admins,
+                                                   etablissement_context.id_context_categorie)
+        grants = [(id_role_admin_local, etablissement_context.id_context_categorie, id_user)
+                  for id_user in sorted(admins - ids_admins)]
+        for _, _, id_user in grants:
+            log.info("Insertion d'un admin  local %s", index.infos_by_user[id_user])
+
+        # Les admins locaux sont utilisateurs avancés par défaut
+        ids_avances = self.__db.get_users_with_role(self.context.id_role_advanced_teacher, admins)
+        grants.extend((self.context.id_role_advanced_teacher, 1, id_user) for id_user in sorted(admins - ids_avances))
+
+        ids_non_admins = self.__db.get_users_with_role(id_role_admin_local, index.non_admins(admins),
+                                                       self.context.id_context_categorie_inter_etabs)
+        revocations = [(id_role_admin_local, self.context.id_context_categorie_inter_etabs, id_user)
+                       for id_user in sorted(ids_non_admins)]
+        etablissement_context.plan.role_grants.extend(grants)
+        etablissement_context.plan.role_revocations.extend(revocations)
+        if not self.dry_run:
+            self.__db.insert_role_assignment_rows(grants)
+            self.__db.delete_role_assignment_rows(revocations)
+        etablissement_context.admins_locaux = AdminsLocauxIndex(index.matcher.pattern)
+
+    def handle_admins_interetab(self, log=getLogger()):
+        """
+        Met à jour en une fois les administrateurs locaux de la catégorie inter-établissements, à partir des groupes
+        des utilisateurs traités par handle_user_interetab.
+        :param log:
+        :return:
+        """
+        index = self.context.admins_interetab
+        admins = index.admins()
+        for id_user in self.__db.insert_moodle_local_admins(self.context.id_context_categorie_inter_etabs, admins):
+            log.info("Insertion d'un admin local %s", index.infos_by_user[id_user])
+        self.__db.delete_moodle_local_admins(self.context.id_context_categorie_inter_etabs,
+                                             sorted(index.non_admins(admins)))
+        self.context.admins_interetab = AdminsLocauxIndex(index.matcher.pattern)
 
     def handle_inspecteur(self, personne_ldap: PersonneLdap, log=getLogger()):
         """
@@ -520,7 +1300,7 @@ class Synchronizer:
         :return:
         """
         if not personne_ldap.mail:
-            personne_ldap.mail = self.__config.constantes.default_mail
+            personne_ldap = personne_ldap.evolve(mail=self.__config.constantes.default_mail)
 
             # Creation de l'utilisateur
             self.__db.insert_moodle_user(personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn,
@@ -529,11 +1309,10 @@ class Synchronizer:
                                          self.__config.constantes.default_moodle_theme)
         id_user = self.__db.get_user_id(personne_ldap.uid)
         if not id_user:
-            self.__db.insert_moodle_user(personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn,
-                                         personne_ldap.mail,
-                                         self.__config.constantes.default_mail_display,
-                                         self.__config.constantes.default_moodle_theme)
-            id_user = self.__db.get_user_id(personne_ldap.uid)
+            id_user = self.__db.insert_moodle_user(personne_ldap.uid, personne_ldap.given_name, personne_ldap.sn,
+                                                   personne_ldap.mail,
+                                                   self.__config.constantes.default_mail_display,
+                                                   self.__config.constantes.default_moodle_theme)
         else:
             self.__db.update_moodle_user(id_user, personne_ldap.given_name, personne_ldap.sn, personne_ldap.mail,
                                          self.__config.constantes.default_mail_display,
@@ -554,12 +1333,14 @@ class Synchronizer:
         log.debug("Insertion du Domaine")
         self.__db.set_user_domain(id_user, self.context.id_field_domaine, user_domain)
 
-    def mettre_a_jour_droits_enseignant(self, enseignant_infos, id_enseignant, uais_autorises, log=getLogger()):
+    def mettre_a_jour_droits_enseignant(self, etablissement_context: EtablissementContext, enseignant_infos,
+                                        id_enseignant, uais_autorises, log=getLogger()):
         """
         Fonction permettant de mettre a jour les droits d'un enseignant.
         Cette mise a jour consiste a :
-          - Supprimer les roles non autorises
+          - Supprimer les roles non autorises, suppression appliquée par handle_role_deletions
           - ajouter les roles
+        :param etablissement_context:
         :param enseignant_infos:
         :param id_enseignant:
         :param uais_autorises:
@@ -580,7 +1361,7 @@ class Synchronizer:
 
         # Suppression des roles non autorises
         if ids_roles_non_autorises:
-            self.__db.delete_roles(ids_roles_non_autorises)
+            etablissement_context.role_deletions.update(dict.fromkeys(ids_roles_non_autorises))
             log.info("Suppression des rôles d'enseignant pour %s dans les établissements %s"
                      , enseignant_infos, str(ids_themes_non_autorises))
             log.info("Les seuls établissements autorisés pour cet enseignant sont %s", themes_autorises)
@@ -602,7 +1383,7 @@ class Synchronizer:
         # Suppression des roles non autorises
         if ids_roles_non_autorises:
             # Suppression des roles
-            self.__db.delete_roles(ids_roles_non_autorises)
+            etablissement_context.role_deletions.update(dict.fromkeys(ids_roles_non_autorises))
             log.info("Suppression des rôles d'enseignant pour %s sur les forum '%s' ",
                      enseignant_infos, str(forums_summaries))
             log.info("Les seuls établissements autorisés pour cet enseignant sont '%s'", themes_autorises)
@@ -619,33 +1400,52 @@ class Synchronizer:
         """
         id_cohort = self.__db.get_id_cohort(id_context, name)
         if id_cohort is None:
-            self.__db.create_cohort(id_context, name, id_number, description, time_created)
+            id_cohort = self.__db.create_cohort(id_context, name, id_number, description, time_created)
             log.info("Creation de la cohorte (name=%s)", name)
-            return self.__db.get_id_cohort(id_context, name)
         return id_cohort
 
-    def get_or_create_formation_cohort(self, id_context_etab, niveau_formation, timestamp_now_sql, log=getLogger()):
+    def plan_cohort(self, etablissement_context: EtablissementContext, id_context, name, id_number, description,
+                    log=getLogger()):
         """
-        Charge ou créer une cohorte de formation
-        :param id_context_etab:
+        Charge une cohorte d'un contexte, ou demande sa création, appliquée par handle_cohorts.
+        :param etablissement_context:
+        :param id_context:
+        :param name:
+        :param id_number:
+        :param description:
+        :param log:
+        :return: Id de la cohorte, provisoire si sa création est demandée
+        """
+        id_cohort = etablissement_context.cohorts.get(id_context, name)
+        if id_cohort is None and not etablissement_context.planned_ids.planned(id_context):
+            id_cohort = self.__db.get_id_cohort(id_context, name)
+        if id_cohort is None:
+            id_cohort = etablissement_context.planned_ids.allocate()
+            etablissement_context.cohorts.add(id_cohort, id_context, name, id_number, description,
+                                              self.context.timestamp_now_sql)
+            log.info("Création de la cohorte demandée (name=%s)", name)
+        return id_cohort
+
+    def plan_formation_cohort(self, etablissement_context: EtablissementContext, niveau_formation, log=getLogger()):
+        """
+        Charge la cohorte d'un niveau de formation, ou demande sa création
+        :param etablissement_context:
         :param niveau_formation:
-        :param timestamp_now_sql:
         :param log:
         :return:
         """
         cohort_name = 'Élèves du Niveau de formation %s' % niveau_formation
         cohort_description = 'Eleves avec le niveau de formation %s' % niveau_formation
-        id_cohort = self.get_or_create_cohort(id_context_etab, cohort_name, cohort_name, cohort_description,
-                                              timestamp_now_sql, log)
+        id_cohort = self.plan_cohort(etablissement_context, etablissement_context.id_context_categorie, cohort_name,
+                                     cohort_name, cohort_description, log)
         return id_cohort
 
-    def get_or_create_classes_cohorts(self, id_context_etab, classes_names, time_created, name_pattern=None,
-                                      desc_pattern=None, log=getLogger()):
+    def plan_classes_cohorts(self, etablissement_context: EtablissementContext, classes_names, name_pattern=None,
+                             desc_pattern=None, log=getLogger()):
         """
-        Charge ou crée des cohortes a partir de classes liées a un établissement.
-        :param id_context_etab:
+        Charge les cohortes de classes liées a un établissement, ou demande leur création.
+        :param etablissement_context:
         :param classes_names:
-        :param time_created:
         :param name_pattern:
         :param desc_pattern:
         :return:
@@ -656,76 +1456,80 @@ class Synchronizer:
         if desc_pattern is None:
             desc_pattern = "Élèves de la Classe %s"
 
+        # Toutes les cohortes du contexte sont résolues depuis l'index, chargé en une seule requête
+        if not etablissement_context.planned_ids.planned(etablissement_context.id_context_categorie):
+            self.__db.load_cohorts_ids([etablissement_context.id_context_categorie])
         ids_cohorts = []
         for class_name in classes_names:
             cohort_name = name_pattern % class_name
             cohort_description = desc_pattern % class_name
-            id_cohort = self.get_or_create_cohort(id_context_etab,
-                                                  cohort_name,
-                                                  cohort_name,
-                                                  cohort_description,
-                                                  time_created,
-                                                  log=log)
+            id_cohort = self.plan_cohort(etablissement_context,
+                                         etablissement_context.id_context_categorie,
+                                         cohort_name,
+                                         cohort_name,
+                                         cohort_description,
+                                         log=log)
             ids_cohorts.append(id_cohort)
         return ids_cohorts
 
-    def get_or_create_profs_etab_cohort(self, etab_context: EtablissementContext, log=getLogger()):
+    def plan_profs_etab_cohort(self, etab_context: EtablissementContext, log=getLogger()):
         """
-        Charge ou crée la cohorte d'enseignant de l'établissement.
+        Charge la cohorte d'enseignant de l'établissement, ou demande sa création.
         :param etab_context:
         :param log:
         :return:
         """
         cohort_name = 'Profs de l\'établissement (%s)' % etab_context.uai
         cohort_description = 'Enseignants de l\'établissement %s' % etab_context.uai
-        id_cohort_enseignants = self.get_or_create_cohort(etab_context.id_context_categorie,
-                                                          cohort_name,
-                                                          cohort_name,
-                                                          cohort_description,
-                                                          self.context.timestamp_now_sql,
-                                                          log=log)
+        id_cohort_enseignants = self.plan_cohort(etab_context,
+                                                 etab_context.id_context_categorie,
+                                                 cohort_name,
+                                                 cohort_name,
+                                                 cohort_description,
+                                                 log=log)
         return id_cohort_enseignants
 
+    def get_classes_index(self, etab_context: EtablissementContext) -> ClassesIndex:
+        """
+        Construit l'index LDAP des membres des classes de l'établissement.
+        :param etab_context: EtablissementContext
+        :return: Index des membres des classes
+        """
+        if not etab_context.structure_ldap:
+            return ClassesIndex()
+        return self.__ldap.search_classes_index(etab_context.uai, etab_context.structure_ldap.dn)
+
     def get_users_by_cohorts_comparators(self, etab_context: EtablissementContext, cohortname_pattern_re: str,
-                                         cohortname_pattern: str) -> (Dict[str, List[str]], Dict[str, List[str]]):
+                                         cohortname_pattern: str, users_by_keys_ldap: Dict[str, Set[str]] = None) \
+            -> (Dict[str, List[str]], Dict[str, Set[str]]):
         """
         Renvoie deux dictionnaires listant les utilisateurs (uid) dans chacune des classes.
         Le premier dictionnaire contient les valeurs de la BDD, le second celles du LDAP
         :param etab_context: EtablissementContext
         :param cohortname_pattern_re: str
         :param cohortname_pattern: str
+        :param users_by_keys_ldap: uid LDAP par clé de cohorte (élèves par classe de l'établissement par défaut)
         :return:
         """
-        classes_cohorts = self.__db.get_user_filtered_cohorts(etab_context.id_context_categorie, cohortname_pattern)
+        if users_by_keys_ldap is None:
+            users_by_keys_ldap = self.get_classes_index(etab_context).eleves_by_classe
 
+        # Membres de toutes les cohortes du contexte lus en une seule requête, au fil de l'eau
         eleves_by_cohorts_db = {}
-        for cohort in classes_cohorts:
-            matches = re.search(cohortname_pattern_re, cohort.name)
+        for cohort_name, username in self.__db.iter_filtered_cohorts_members(etab_context.id_context_categorie,
+                                                                             cohortname_pattern):
+            matches = re.search(cohortname_pattern_re, cohort_name)
             classe_name = matches.group(2)
-            eleves_by_cohorts_db[classe_name] = []
-            for username in self.__db.get_cohort_members(cohort.id):
-                eleves_by_cohorts_db[classe_name].append(username.lower())
+            eleves_by_cohort_db = eleves_by_cohorts_db.setdefault(classe_name, [])
+            if username is not None:
+                eleves_by_cohort_db.append(username.lower())
 
         eleves_by_cohorts_ldap = {}
         for classe in eleves_by_cohorts_db:
-            eleves_by_cohorts_ldap[classe] = []
-            for eleve in self.__ldap.search_eleves_in_classe(classe, etab_context.uai):
-                eleves_by_cohorts_ldap[classe].append(eleve.uid.lower())
+            eleves_by_cohorts_ldap[classe] = set(users_by_keys_ldap.get(classe, ()))
 
         return eleves_by_cohorts_db, eleves_by_cohorts_ldap
 
-    def list_contains_username(self, ldap_users: List[PersonneLdap], username: str):
-        """
-        Vérifie si une liste d'utilisateurs ldap contient un utilisateur via son username
-        :param ldap_users:
-        :param username:
-        :return:
-        """
-        for ldap_user in ldap_users:
-            if ldap_user.uid.lower() == username.lower():
-                return True
-        return False
-
     def backup_course(self, courseid, log=getLogger()):
         log.info("Backup du cours avec l'id %d", courseid)
         cmd = self.__config.webservice.backup_cmd.replace("%courseid%", str(courseid))
@@ -752,21 +1556,24 @@ class Synchronizer:
                     else:
                         log.error("La backup du cours %d a échouée", courseid)
 
-    def anonymize_or_delete_users(self, ldap_users: List[PersonneLdap], db_users: List, log=getLogger()):
+    def anonymize_or_delete_users(self, ldap_users: Iterable[PersonneLdap], db_users: Iterable, log=getLogger()):
         """
-        Anonymise ou Supprime les utilisateurs devenus inutiles
-        :param ldap_users:
-        :param db_users:
+        Anonymise ou Supprime les utilisateurs devenus inutiles.
+        Les uid de l'annuaire sont indexés une seule fois en minuscules: les utilisateurs moodle absents de l'annuaire
+        sont déterminés par différence, en temps constant par utilisateur.
+        :param ldap_users: utilisateurs de l'annuaire, éventuellement lus au fil de l'eau
+        :param db_users: utilisateurs moodle (id, username, lastlogin), éventuellement lus au fil de l'eau
         :param log:
         :return:
         """
+        uids_ldap = {ldap_user.uid.lower() for ldap_user in ldap_users}
         user_ids_to_delete = []
         user_ids_to_anonymize = []
         now = self.__db.get_timestamp_now()
         for db_user in db_users:
             if db_user[0] in self.__config.delete.ids_users_undeletable:
                 continue
-            if not self.list_contains_username(ldap_users, db_user[1]):
+            if db_user[1].lower() not in uids_ldap:
                 log.info("L'utilisateur %s n'est plus présent dans l'annuaire LDAP", db_user[1])
                 is_teacher = self.__db.user_has_role(db_user[0], self.__config.delete.ids_roles_teachers)
 
@@ -794,6 +1601,24 @@ class Synchronizer:
             self.__db.anonymize_users(user_ids_to_anonymize)
             log.info("%d utilisateurs anonymisés", len(user_ids_to_anonymize))
 
+    def handle_deleted_users(self, uids: Iterable[str], log=getLogger()):
+        """
+        Anonymise ou supprime les utilisateurs signalés comme supprimés par la synchronisation incrémentale LDAP.
+        Une entrée sortie du périmètre de la recherche (changement d'établissement) est également signalée comme
+        supprimée: seuls les utilisateurs réellement absents de l'annuaire sont traités.
+        :param uids: uid signalés comme supprimés
+        :param log:
+        :return:
+        """
+        uids = {uid.lower() for uid in uids}
+        if not uids:
+            return
+        personnes_ldap = self.__ldap.search_personne(profil='uid-only', uid=sorted(uids))
+        uids_ldap = {personne.uid.lower() for personne in personnes_ldap}
+        uids_absents = sorted(uids - uids_ldap)
+        if uids_absents:
+            self.anonymize_or_delete_users([], self.__db.get_valid_users_by_usernames(uids_absents), log=log)
+
     def delete_users(self, userids: List[int], pagesize=50, log=getLogger()) -> int:
         """
         Supprime les utilisateurs d'une liste en paginant les appels au webservice
@@ -860,9 +1685,8 @@ class Synchronizer:
         :return:
         """
         # Creation de la cohort si necessaire
-        self.get_or_create_cohort(self.context.id_context_categorie_inter_etabs, cohort_name, cohort_name,
-                                  cohort_name, self.context.timestamp_now_sql, log=log)
-        id_cohort = self.__db.get_id_cohort(self.context.id_context_categorie_inter_etabs, cohort_name)
+        id_cohort = self.get_or_create_cohort(self.context.id_context_categorie_inter_etabs, cohort_name,
+                                              cohort_name, cohort_name, self.context.timestamp_now_sql, log=log)
 
         # Liste permettant de sauvegarder les utilisateurs de la cohorte
         self.context.utilisateurs_by_cohortes[id_cohort] = []
@@ -873,7 +1697,7 @@ class Synchronizer:
         # Ajout des utilisateurs dans la cohorte
         for personne_ldap in self.__ldap.search_personne(
                 since_timestamp=since_timestamp if not self.__arguments.purge_cohortes else None,
-                isMemberOf=is_member_of_list):
+                profil='uid-only', isMemberOf=is_member_of_list):
             user_id = self.__db.get_user_id(personne_ldap.uid)
             if user_id:
                 self.__db.enroll_user_in_cohort(id_cohort, user_id, self.context.timestamp_now_sql)
@@ -0,0 +1,282 @@
+# coding: utf-8
+"""
+Synchronisation incrémentale LDAP (RFC 4533, content synchronization)
+"""
+
+import uuid
+from typing import List, Dict, Set, Tuple, Callable, Any
+
+from ldap3 import Connection, Entry, LEVEL
+from ldap3.core.exceptions import LDAPESyncRefreshRequiredResult
+from ldap3.core.results import RESULT_E_SYNC_REFRESH_REQUIRED
+from ldap3.utils.dn import parse_dn
+from pyasn1.codec.ber import encoder, decoder
+from pyasn1.type import univ, namedtype, namedval, tag
+
+# OID du contrôle Simple Paged Results (RFC 2696)
+PAGED_RESULTS_CONTROL_OID = '1.2.840.113556.1.4.319'
+
+SYNC_REQUEST_CONTROL_OID = '1.3.6.1.4.1.4203.1.9.1.1'
+SYNC_STATE_CONTROL_OID = '1.3.6.1.4.1.4203.1.9.1.2'
+SYNC_DONE_CONTROL_OID = '1.3.6.1.4.1.4203.1.9.1.3'
+SYNC_INFO_MESSAGE_OID = '1.3.6.1.4.1.4203.1.9.1.4'
+
+SYNC_STATE_PRESENT = 0
+SYNC_STATE_ADD = 1
+SYNC_STATE_MODIFY = 2
+SYNC_STATE_DELETE = 3
+
+
+class _SyncRequestValue(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('mode', univ.Enumerated(
+            namedValues=namedval.NamedValues(('refreshOnly', 1), ('refreshAndPersist', 3)))),
+        namedtype.OptionalNamedType('cookie', univ.OctetString()),
+        namedtype.DefaultedNamedType('reloadHint', univ.Boolean(False))
+    )
+
+
+class _SyncStateValue(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('state', univ.Enumerated(
+            namedValues=namedval.NamedValues(('present', 0), ('add', 1), ('modify', 2), ('delete', 3)))),
+        namedtype.NamedType('entryUUID', univ.OctetString()),
+        namedtype.OptionalNamedType('cookie', univ.OctetString())
+    )
+
+
+class _SyncDoneValue(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.OptionalNamedType('cookie', univ.OctetString()),
+        namedtype.DefaultedNamedType('refreshDeletes', univ.Boolean(False))
+    )
+
+
+class _RefreshPhaseValue(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.OptionalNamedType('cookie', univ.OctetString()),
+        namedtype.DefaultedNamedType('refreshDone', univ.Boolean(True))
+    )
+
+
+class _SyncIdSetValue(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.OptionalNamedType('cookie', univ.OctetString()),
+        namedtype.DefaultedNamedType('refreshDeletes', univ.Boolean(False)),
+        namedtype.NamedType('syncUUIDs', univ.SetOf(componentType=univ.OctetString()))
+    )
+
+
+class _SyncInfoValue(univ.Choice):
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('newcookie', univ.OctetString().subtype(
+            implicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 0))),
+        namedtype.NamedType('refreshDelete', _RefreshPhaseValue().subtype(
+            implicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatConstructed, 1))),
+        namedtype.NamedType('refreshPresent', _RefreshPhaseValue().subtype(
+            implicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatConstructed, 2))),
+        namedtype.NamedType('syncIdSet', _SyncIdSetValue().subtype(
+            implicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatConstructed, 3)))
+    )
+
+
+def encode_sync_request(cookie: bytes = None) -> bytes:
+    """
+    Encode la valeur du contrôle de requête de synchronisation en mode refreshOnly.
+    :param cookie: cookie de la synchronisation précédente
+    :return: valeur BER du contrôle
+    """
+    value = _SyncRequestValue()
+    value.setComponentByName('mode', 1)
+    if cookie:
+        value.setComponentByName('cookie', cookie)
+    return encoder.encode(value)
+
+
+def _optional_cookie(value) -> bytes:
+    cookie = value.getComponentByName('cookie')
+    return bytes(cookie) if cookie.isValue else None
+
+
+def decode_sync_state(raw: bytes) -> Tuple[int, str, bytes]:
+    """
+    Décode la valeur du contrôle d'état associé à une entrée.
+    :param raw: valeur BER du contrôle
+    :return: état, entryUUID et cookie éventuel
+    """
+    value, _ = decoder.decode(raw, asn1Spec=_SyncStateValue())
+    return int(value['state']), str(uuid.UUID(bytes=bytes(value['entryUUID']))), _optional_cookie(value)
+
+
+def decode_sync_done(raw: bytes) -> Tuple[bytes, bool]:
+    """
+    Décode la valeur du contrôle de fin de synchronisation.
+    :param raw: valeur BER du contrôle
+    :return: cookie éventuel et indicateur refreshDeletes
+    """
+    if not raw:
+        return None, False
+    value, _ = decoder.decode(raw, asn1Spec=_SyncDoneValue())
+    return _optional_cookie(value), bool(value['refreshDeletes'])
+
+
+def decode_sync_info(raw: bytes) -> Tuple[str, bytes, bool, List[str]]:
+    """
+    Décode un message intermédiaire Sync Info.
+    :param raw: valeur BER du message
+    :return: type de message, cookie éventuel, indicateur refreshDeletes et liste d'entryUUID
+    """
+    value, _ = decoder.decode(raw, asn1Spec=_SyncInfoValue())
+    name = value.getName()
+    component = value.getComponent()
+    if name == 'newcookie':
+        return name, bytes(component), False, []
+    if name == 'syncIdSet':
+        uuids = [str(uuid.UUID(bytes=bytes(entry_uuid))) for entry_uuid in component['syncUUIDs']]
+        return name, _optional_cookie(component), bool(component['refreshDeletes']), uuids
+    return name, _optional_cookie(component), False, []
+
+
+class SyncResult:
+    """
+    Résultat d'une recherche de synchronisation en mode refreshOnly.
+    """
+
+    def __init__(self):
+        self.cookie = None  # type: bytes
+        self.refresh_required = False  # type: bool
+        self.refresh_deletes = False  # type: bool
+        self.changed = []  # type: List[Tuple[str, Any]]
+        self.present = set()  # type: Set[str]
+        self.deleted = {}  # type: Dict[str, str]
+
+    def deleted_uids(self, known_uids: Dict[str, str]) -> Set[str]:
+        """
+        Détermine les uid des entrées supprimées depuis la synchronisation précédente.
+        :param known_uids: uid connus, par entryUUID
+        :return: uid supprimés
+        """
+        deleted = dict(self.deleted)
+        if not self.refresh_deletes:
+            # Phase present: les entrées connues non mentionnées ont été supprimées
+            changed = {entry_uuid for entry_uuid, _ in self.changed}
+            for entry_uuid in known_uids.keys() - self.present - changed:
+                deleted.setdefault(entry_uuid, None)
+        uids = set()
+        for entry_uuid, uid in deleted.items():
+            uid = known_uids.get(entry_uuid, uid)
+            if uid:
+                uids.add(uid.lower())
+        return uids
+
+    def known_uids(self, known_uids: Dict[str, str]) -> Dict[str, str]:
+        """
+        Calcule les uid connus après application de la synchronisation.
+        :param known_uids: uid connus avant synchronisation, par entryUUID
+        :return: uid connus, par entryUUID
+        """
+        uids = dict(known_uids)
+        if not self.refresh_deletes:
+            uids = {entry_uuid: uid for entry_uuid, uid in uids.items() if entry_uuid in self.present}
+        for entry_uuid in self.deleted:
+            uids.pop(entry_uuid, None)
+        for entry_uuid, personne in self.changed:
+            uids[entry_uuid] = personne.uid.lower()
+        return uids
+
+
+def _uid_from_dn(dn: str) -> str:
+    if not dn:
+        return None
+    attribute, value, _ = parse_dn(dn)[0]
+    return value if attribute.lower() == 'uid' else None
+
+
+def get_paged_cookie(result: dict) -> bytes:
+    """
+    Extrait le cookie de pagination du résultat d'une recherche paginée.
+    :param result: Résultat de la recherche
+    :return: Le cookie, ou None s'il s'agit de la dernière page
+    """
+    try:
+        return result['controls'][PAGED_RESULTS_CONTROL_OID]['value']['cookie']
+    except (KeyError, TypeError):
+        return None
+
+
+def sync_search(connection: Connection, search_base: str, ldap_filter: str, factory: Callable[[Entry], Any],
+                attributes: List[str], cookie: bytes = None, page_size: int = None) -> SyncResult:
+    """
+    Effectue une recherche de synchronisation en mode refreshOnly.
+
+    La recherche porte sur les entrées directement sous search_base, comme les recherches paginées complètes. Si
+    page_size est renseigné, le contrôle Simple Paged Results est ajouté au contrôle de synchronisation: les
+    messages de chaque page sont traités avant la récupération de la suivante, et le contrôle syncDone accompagne
+    la dernière page.
+    :param connection: connexion LDAP
+    :param search_base: DN de base de la recherche
+    :param ldap_filter: filtre LDAP
+    :param factory: fonction de construction des objets à partir des entrées ajoutées ou modifiées
+    :param attributes: attributs à récupérer
+    :param cookie: cookie de la synchronisation précédente
+    :param page_size: taille des pages, None pour une recherche non paginée
+    :return: Résultat de la synchronisation
+    """
+    result = SyncResult()
+    result.cookie = cookie
+    paged_cookie = None
+    while True:
+        try:
+            connection.search(search_base, ldap_filter, search_scope=LEVEL, attributes=attributes,
+                              paged_size=page_size, paged_cookie=paged_cookie,
+                              controls=[(SYNC_REQUEST_CONTROL_OID, True, encode_sync_request(cookie))])
+        except LDAPESyncRefreshRequiredResult:
+            # Connexion ouverte avec raise_exceptions=True
+            result.refresh_required = True
+            return result
+        if connection.result['result'] == RESULT_E_SYNC_REFRESH_REQUIRED:
+            result.refresh_required = True
+            return result
+        _read_sync_page(connection, factory, result)
+        paged_cookie = get_paged_cookie(connection.result) if page_size else None
+        if not paged_cookie:
+            break
+
+    controls = connection.result.get('controls') or {}
+    if SYNC_DONE_CONTROL_OID in controls:
+        done_cookie, result.refresh_deletes = decode_sync_done(controls[SYNC_DONE_CONTROL_OID]['value'])
+        result.cookie = done_cookie or result.cookie
+    return result
+
+
+def _read_sync_page(connection: Connection, factory: Callable[[Entry], Any], result: SyncResult):
+    """
+    Intègre au résultat les messages renvoyés par une page de la recherche de synchronisation.
+    :param connection: connexion LDAP
+    :param factory: fonction de construction des objets à partir des entrées ajoutées ou modifiées
+    :param result: Résultat de la synchronisation
+    """
+    entries = iter(connection.entries)
+    for response in connection.response or []:
+        if response['type'] == 'intermediateResponse':
+            if response.get('responseName') != SYNC_INFO_MESSAGE_OID:
+                continue
+            name, info_cookie, refresh_deletes, uuids = decode_sync_info(response['responseValue'])
+            if name == 'syncIdSet':
+                for entry_uuid in uuids:
+                    if refresh_deletes:
+                        result.deleted[entry_uuid] = None
+                    else:
+                        result.present.add(entry_uuid)
+            result.cookie = info_cookie or result.cookie
+        elif response['type'] == 'searchResEntry':
+            entry = next(entries)
+            state, entry_uuid, state_cookie = \
+                decode_sync_state(response['controls'][SYNC_STATE_CONTROL_OID]['value'])
+            if state == SYNC_STATE_PRESENT:
+                result.present.add(entry_uuid)
+            elif state == SYNC_STATE_DELETE:
+                result.deleted[entry_uuid] = _uid_from_dn(response['dn'])
+            else:
+                result.changed.append((entry_uuid, factory(entry)))
+            result.cookie = state_cookie or result.cookie
@@ -2,13 +2,17 @@
 Gestion des timestamps
 """
 
+import base64
 import datetime
+import hashlib
+import json
 import os
 import re
+import sqlite3
 from logging import getLogger
-from typing import Dict
+from typing import Dict, List, Any
 
-from synchromoodle.config import TimestampStoreConfig
+from synchromoodle.config import TimestampStoreConfig, SyncCookieStoreConfig, FingerprintStoreConfig
 
 date_format = '%Y%m%d%H%M%S'
 log = getLogger('timestamp')
@@ -77,3 +81,170 @@ class TimestampStore:
         :param uai: code établissement
         """
         self.timestamps[uai.upper()] = self.now
+
+
+class SyncCookieStore:
+    """
+    Stocker les cookies de synchronisation LDAP (RFC 4533) pour les établissements.
+    Équivalent de TimestampStore pour la synchronisation incrémentale: seules les entrées modifiées ou supprimées
+    depuis le cookie sont renvoyées par l'annuaire. Les uid connus sont conservés par entryUUID, afin de retrouver
+    les utilisateurs supprimés lorsque l'annuaire ne transmet que leur entryUUID.
+    """
+
+    def __init__(self, config: SyncCookieStoreConfig):
+        self.config = config
+        self.cookies = {}  # type: Dict[str, bytes]
+        self.uids = {}  # type: Dict[str, Dict[str, str]]
+        self.read()
+
+    def get_cookie(self, key: str) -> bytes:
+        """
+        Obtient le cookie de synchronisation
+        :param key: clé (code établissement et type de personne)
+        :return: cookie
+        """
+        return self.cookies.get(key.upper())
+
+    def get_uids(self, key: str) -> Dict[str, str]:
+        """
+        Obtient les uid connus lors de la synchronisation précédente
+        :param key: clé (code établissement et type de personne)
+        :return: uid par entryUUID
+        """
+        return self.uids.get(key.upper(), {})
+
+    def read(self):
+        """
+        Charge le fichier contenant les cookies de synchronisation
+        """
+        self.cookies.clear()
+        self.uids.clear()
+
+        try:
+            with open(self.config.file, 'r') as cookie_file:
+                content = cookie_file.read()
+            if content.strip():
+                for key, state in json.loads(content).items():
+                    if state.get('cookie'):
+                        self.cookies[key] = base64.b64decode(state['cookie'])
+                    self.uids[key] = state.get('uids', {})
+        except IOError:
+            log.warning("Impossible d'ouvrir le fichier : %s", self.config.file)
+
+    def write(self):
+        """
+        Ecrit le fichier contenant les cookies de synchronisation.
+        """
+        states = {}
+        for key in self.cookies.keys() | self.uids.keys():
+            cookie = self.cookies.get(key)
+            states[key] = {'cookie': base64.b64encode(cookie).decode('ascii') if cookie else None,
+                           'uids': self.uids.get(key, {})}
+        with open(self.config.file, 'w') as cookie_file:
+            json.dump(states, cookie_file)
+
+    def mark(self, key: str, cookie: bytes, uids: Dict[str, str]):
+        """
+        Enregistre le cookie et les uid connus à l'issue d'une synchronisation.
+        :param key: clé (code établissement et type de personne)
+        :param cookie: cookie renvoyé par l'annuaire
+        :param uids: uid connus, par entryUUID
+        """
+        self.cookies[key.upper()] = cookie
+        self.uids[key.upper()] = uids
+
+
+def fingerprint_fields(values: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Calcule l'empreinte de chacun des champs donnés.
+    :param values: valeurs des champs
+    :return: empreinte par champ
+    """
+    return {name: hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            for name, value in values.items()}
+
+
+class FingerprintStore:
+    """
+    Stocker les empreintes des attributs LDAP utilisés par Moodle, par établissement et par utilisateur, dans une base
+    SQLite.
+    Permet de ne pas traiter en base les utilisateurs inchangés depuis le dernier traitement, y compris lorsque les
+    timestamps ont été perdus.
+    """
+
+    def __init__(self, config: FingerprintStoreConfig):
+        self.config = config
+        self.connection = sqlite3.connect(config.file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fingerprints"
+                                " (uai TEXT NOT NULL, uid TEXT NOT NULL, fields TEXT NOT NULL, PRIMARY KEY (uai, uid))")
+        self.fingerprints = {}  # type: Dict[str, Dict[str, Dict[str, str]]]
+        self.pending = {}  # type: Dict[str, Dict[str, Dict[str, str]]]
+
+    def get_fields(self, uai: str, uid: str) -> Dict[str, str]:
+        """
+        Obtient les empreintes enregistrées d'un utilisateur. Les empreintes d'un établissement sont chargées en une
+        seule requête au premier appel.
+        :param uai: code établissement
+        :param uid: uid de l'utilisateur
+        :return: empreinte par champ
+        """
+        uai = uai.upper()
+        if uai not in self.fingerprints:
+            self.fingerprints[uai] = {uid: json.loads(fields) for uid, fields in self.connection.execute(
+                "SELECT uid, fields FROM fingerprints WHERE uai = ?", (uai,))}
+        return self.fingerprints[uai].get(uid.lower(), {})
+
+    def changed_fields(self, uai: str, uid: str, fields: Dict[str, str]) -> List[str]:
+        """
+        Détermine les champs modifiés d'un utilisateur depuis le dernier traitement.
+        :param uai: code établissement
+        :param uid: uid de l'utilisateur
+        :param fields: empreinte courante par champ
+        :return: noms des champs modifiés, tous les champs pour un utilisateur inconnu
+        """
+        previous = self.get_fields(uai, uid)
+        return sorted(name for name in fields.keys() | previous.keys() if fields.get(name) != previous.get(name))
+
+    def stage(self, uai: str, uid: str, fields: Dict[str, str]):
+        """
+        Met en attente l'empreinte d'un utilisateur traité, jusqu'à la validation de l'établissement par mark().
+        :param uai: code établissement
+        :param uid: uid de l'utilisateur
+        :param fields: empreinte par champ
+        """
+        self.pending.setdefault(uai.upper(), {})[uid.lower()] = fields
+
+    def take(self, uai: str) -> Dict[str, Dict[str, str]]:
+        """
+        Retire les empreintes en attente d'un établissement, pour qu'elles soient enregistrées par un autre stockage.
+        :param uai: code établissement
+        :return: empreinte par champ, par uid
+        """
+        return self.pending.pop(uai.upper(), {})
+
+    def mark(self, uai: str, fingerprints: Dict[str, Dict[str, str]] = None):
+        """
+        Enregistre les empreintes d'un établissement, une fois ses modifications validées en base.
+        :param uai: code établissement
+        :param fingerprints: empreintes à enregistrer, par défaut celles en attente
+        """
+        uai = uai.upper()
+        pending = self.pending.pop(uai, {})
+        if fingerprints is not None:
+            pending.update(fingerprints)
+        self.connection.executemany("INSERT OR REPLACE INTO fingerprints (uai, uid, fields) VALUES (?, ?, ?)",
+                                    [(uai, uid, json.dumps(fields, sort_keys=True)) for uid, fields in pending.items()])
+        if uai in self.fingerprints:
+            self.fingerprints[uai].update(pending)
+
+    def write(self):
+        """
+        Ecrit les empreintes enregistrées dans la base SQLite.
+        """
+        self.connection.commit()
+
+    def close(self):
+        """
+        Ferme la base SQLite, en abandonnant les empreintes non écrites.
+        """
+        self.connection.close()
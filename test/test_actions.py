@@ -0,0 +1,118 @@
+# coding: utf-8
+import os
+
+import pytest
+
+from synchromoodle import actions
+from synchromoodle.config import Config, ActionConfig, EtablissementsConfig
+from synchromoodle.dbutils import Database
+from synchromoodle.ldaputils import Ldap
+from test.utils import db_utils, ldap_utils
+
+
+@pytest.fixture(scope='function', name='db')
+def db(docker_config: Config):
+    db = Database(docker_config.database, docker_config.constantes)
+    db_utils.init(db)
+    return db
+
+
+@pytest.fixture(scope='function', name='ldap')
+def ldap(docker_config: Config):
+    ldap = Ldap(docker_config.ldap)
+    ldap_utils.reset(ldap)
+    return ldap
+
+
+def test_partition_etablissements():
+    etablissements = EtablissementsConfig()
+    etablissements.update(listeEtab=["0290009C", "0291595B", "0292164S", "0290036G"],
+                          etabRgp=[{'nom': "Groupe", 'uais': ["0291595B", "0290036G"]}])
+    assert actions.partition_etablissements(etablissements) == [["0290009C"], ["0291595B", "0290036G"], ["0292164S"]]
+
+
+def test_default_workers(ldap: Ldap, db: Database, docker_config: Config, tmpdir):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    eleves = [eleve.uid.lower() for uai in ["0290009C", "0291595B"] for eleve in ldap.search_eleve(None, uai)]
+    ldap.disconnect()
+    db_utils.run_script('data/default-context.sql', db)
+
+    action = ActionConfig()
+    action.update(workers=2,
+                  timestampStore={'file': os.path.join(str(tmpdir), 'timestamps.txt')},
+                  etablissements={'listeEtab': ["0290009C", "0291595B"]})
+    actions.default(docker_config, action)
+
+    db.connect()
+    try:
+        assert eleves and None not in db.get_users_ids(eleves)
+    finally:
+        db.disconnect()
+    assert len(open(os.path.join(str(tmpdir), 'timestamps.txt')).readlines()) == 2
+
+
+def test_default_workers_enseignant_partage(ldap: Ldap, db: Database, docker_config: Config, tmpdir):
+    # L'enseignant F1700jz1 est rattaché aux deux établissements, traités en parallèle par deux processus
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    ldap.disconnect()
+    db_utils.run_script('data/default-context.sql', db)
+
+    action = ActionConfig()
+    action.update(workers=2,
+                  timestampStore={'file': os.path.join(str(tmpdir), 'timestamps.txt')},
+                  etablissements={'listeEtab': ["0290009C", "0291595B"]})
+    actions.default(docker_config, action)
+
+    db.connect()
+    try:
+        db.mark.execute("SELECT id FROM {entete}user WHERE username = %(username)s".format(entete=db.entete),
+                        params={'username': "f1700jz1"})
+        ids_users = [ligne[0] for ligne in db.mark.fetchall()]
+        assert len(ids_users) == 1
+        db.mark.execute("SELECT c.name FROM {entete}cohort AS c"
+                        " INNER JOIN {entete}cohort_members AS cm ON cm.cohortid = c.id"
+                        " WHERE cm.userid = %(id_user)s".format(entete=db.entete),
+                        params={'id_user': ids_users[0]})
+        cohorts = {ligne[0] for ligne in db.mark.fetchall()}
+        assert {"Profs de l'établissement (0290009C)", "Profs de l'établissement (0291595B)"} <= cohorts
+        # Chaque processus relit les affectations validées par l'autre: aucune n'est dupliquée
+        db.mark.execute("SELECT roleid, contextid, COUNT(id) FROM {entete}role_assignments"
+                        " WHERE userid = %(id_user)s"
+                        " GROUP BY roleid, contextid HAVING COUNT(id) > 1".format(entete=db.entete),
+                        params={'id_user': ids_users[0]})
+        assert db.mark.fetchall() == []
+    finally:
+        db.disconnect()
+    assert len(open(os.path.join(str(tmpdir), 'timestamps.txt')).readlines()) == 2
+
+
+def test_default_pipeline(ldap: Ldap, db: Database, docker_config: Config, tmpdir):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    enseignants = [enseignant.uid.lower() for uai in ["0290009C", "0291595B"]
+                   for enseignant in ldap.search_enseignant(None, uai)]
+    ldap.disconnect()
+    db_utils.run_script('data/default-context.sql', db)
+
+    action = ActionConfig()
+    action.update(pipeline=1,
+                  timestampStore={'file': os.path.join(str(tmpdir), 'timestamps.txt')},
+                  etablissements={'listeEtab': ["0290009C", "0291595B"]})
+    prefetch_batch_size = docker_config.ldap.prefetch_batch_size
+    docker_config.ldap.prefetch_batch_size = 1
+    try:
+        actions.default(docker_config, action)
+    finally:
+        docker_config.ldap.prefetch_batch_size = prefetch_batch_size
+
+    db.connect()
+    try:
+        assert enseignants and None not in db.get_users_ids(enseignants)
+    finally:
+        db.disconnect()
+    assert len(open(os.path.join(str(tmpdir), 'timestamps.txt')).readlines()) == 2
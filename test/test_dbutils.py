@@ -0,0 +1,244 @@
+# coding: utf-8
+
+from synchromoodle.config import Config, DatabaseConfig, ConstantesConfig
+from synchromoodle import dbutils
+from synchromoodle.dbutils import BatchCursor, Database, close_pools, infile_line
+from test.utils import db_utils
+
+
+class FakeCursor:
+    def __init__(self):
+        self.calls = []
+        self.lastrowid = 42
+        self.rows = []
+
+    def execute(self, operation, params=None, multi=False):
+        self.calls.append(('execute', operation, params))
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def executemany(self, operation, seq_params):
+        self.calls.append(('executemany', operation, seq_params))
+
+    def close(self):
+        pass
+
+
+def test_batch_cursor():
+    fake = FakeCursor()
+    cursor = BatchCursor(fake, 10)
+    cursor.execute("INSERT INTO t (a) VALUES (%(a)s)", params={'a': 1})
+    cursor.execute("INSERT INTO t (a) VALUES (%(a)s)", params={'a': 2})
+    cursor.execute("DELETE FROM t WHERE a = %(a)s", params={'a': 1})
+    cursor.execute("  update t SET a = 3", params={})
+    assert fake.calls == []
+
+    cursor.execute("SELECT a FROM t")
+    assert fake.calls == [
+        ('executemany', "INSERT INTO t (a) VALUES (%(a)s)", [{'a': 1}, {'a': 2}]),
+        ('execute', "DELETE FROM t WHERE a = %(a)s", {'a': 1}),
+        ('execute', "  update t SET a = 3", {}),
+        ('execute', "SELECT a FROM t", None),
+    ]
+
+
+def test_batch_cursor_size():
+    fake = FakeCursor()
+    cursor = BatchCursor(fake, 2)
+    cursor.execute("INSERT INTO t (a) VALUES (%(a)s)", params={'a': 1})
+    assert fake.calls == []
+    cursor.execute("INSERT INTO t (a) VALUES (%(a)s)", params={'a': 2})
+    assert len(fake.calls) == 1
+
+
+def test_batch_cursor_attribute_flush():
+    fake = FakeCursor()
+    cursor = BatchCursor(fake, 10)
+    cursor.execute("INSERT INTO t (a) VALUES (%(a)s)", params={'a': 1})
+    assert cursor.lastrowid == 42
+    assert fake.calls == [('execute', "INSERT INTO t (a) VALUES (%(a)s)", {'a': 1})]
+
+
+def test_batch_cursor_lastrowid():
+    fake = FakeCursor()
+    cursor = BatchCursor(fake, 10)
+    cursor.execute("INSERT INTO t (a) VALUES (%(a)s)", params={'a': 1})
+    cursor.execute("INSERT INTO t (a) VALUES (%(a)s)", params={'a': 2})
+    cursor.execute("INSERT INTO t (a) VALUES (%(a)s)", params={'a': 3})
+    assert cursor.lastrowid == 42
+    assert fake.calls == [('executemany', "INSERT INTO t (a) VALUES (%(a)s)", [{'a': 1}, {'a': 2}]),
+                          ('execute', "INSERT INTO t (a) VALUES (%(a)s)", {'a': 3})]
+
+
+def test_cohorts_ids():
+    db = Database(DatabaseConfig(), ConstantesConfig())
+    db.mark = FakeCursor()
+    db.mark.rows = [(5, 3, "Élèves de la Classe 1ERE S2")]
+    db.load_cohorts_ids([3, 4])
+    db.load_cohorts_ids([3])
+    assert len(db.mark.calls) == 1
+    assert db.cohorts_ids == {3: {"Élèves de la Classe 1ERE S2": 5}, 4: {}}
+
+    assert db.get_id_cohort(3, "Élèves de la Classe 1ERE S2") == 5
+    assert len(db.mark.calls) == 1
+
+    assert db.create_cohort(4, "Profs de la Classe 1ERE S2", "", "", 0) == 42
+    assert db.get_id_cohort(4, "Profs de la Classe 1ERE S2") == 42
+    assert len(db.mark.calls) == 2
+
+
+class FakeConnection:
+    def __init__(self):
+        self.cursors = []
+
+    def cursor(self, prepared=False):
+        cursor = FakeCursor()
+        self.cursors.append((prepared, cursor))
+        return cursor
+
+    def close(self):
+        pass
+
+
+def test_execute_statement():
+    db = Database(DatabaseConfig(entete="mdl_"), ConstantesConfig())
+    db.connection = FakeConnection()
+    db.mark = FakeCursor()
+    statement = db.statements['get_id_cohort']
+    assert statement.sql == "SELECT id FROM mdl_cohort WHERE contextid = %(id_context)s AND name = %(cohort_name)s"
+    assert statement.prepared_sql == "SELECT id FROM mdl_cohort WHERE contextid = %s AND name = %s"
+
+    cursor = db.execute_statement('get_id_cohort', {'cohort_name': "Profs", 'id_context': 3})
+    assert db.execute_statement('get_id_cohort', {'cohort_name': "Élèves", 'id_context': 4}) is cursor
+    assert len(db.connection.cursors) == 1 and db.connection.cursors[0][0]
+    assert cursor.calls == [('execute', statement.prepared_sql, (3, "Profs")),
+                            ('execute', statement.prepared_sql, (4, "Élèves"))]
+    assert db.mark.calls == []
+
+    db.config.prepared = False
+    assert db.execute_statement('get_id_cohort', {'cohort_name': "Profs", 'id_context': 3}) is db.mark
+    assert db.mark.calls == [('execute', statement.sql, {'cohort_name': "Profs", 'id_context': 3})]
+
+
+def test_execute_statement_batch():
+    db = Database(DatabaseConfig(), ConstantesConfig())
+    db.connection = FakeConnection()
+    fake = FakeCursor()
+    db.mark = BatchCursor(fake, 10)
+    db.execute_statement('update_user_info_data', {'data': "4A", 'id_user': 1, 'id_field': 2})
+    assert db.connection.cursors == [] and fake.calls == []
+    db.execute_statement('get_user_id', {'username': "f1700ivg"})
+    assert [call[0] for call in fake.calls] == ['execute']
+    assert db.connection.cursors[0][1].calls == [('execute', db.statements['get_user_id'].prepared_sql, ("f1700ivg",))]
+
+
+
+def test_add_role_to_user_prepared():
+    db = Database(DatabaseConfig(entete="mdl_"), ConstantesConfig())
+    db.connection = FakeConnection()
+    db.mark = FakeCursor()
+    db.add_role_to_user(5, 3, 7)
+    assert db.mark.calls == []
+    assert [cursor.calls for _, cursor in db.connection.cursors] == [
+        [('execute', db.statements['get_id_role_assignment'].prepared_sql, (5, 3, 7))],
+        [('execute', db.statements['insert_role_assignment'].prepared_sql, (5, 3, 7))]]
+
+
+def test_stream():
+    db = Database(DatabaseConfig(), ConstantesConfig())
+    db.mark = FakeCursor()
+    connection = FakeConnection()
+    db._open_connection = lambda: connection
+    rows = db.stream("SELECT id FROM mdl_user", size=2)
+    assert connection.cursors == []
+
+    cursor = FakeCursor()
+    cursor.rows = [(1,), (2,), (3,)]
+    connection.cursor = lambda: cursor
+    assert list(rows) == [(1,), (2,), (3,)]
+    assert cursor.calls == [('execute', "SELECT id FROM mdl_user", None)]
+    assert db.mark.calls == []
+
+
+def test_iter_filtered_cohorts_members():
+    db = Database(DatabaseConfig(entete="mdl_"), ConstantesConfig())
+    fake = FakeCursor()
+    db.mark = BatchCursor(fake, 10)
+    db.mark.execute("DELETE FROM mdl_cohort_members WHERE cohortid = %(id_cohort)s", params={'id_cohort': 5})
+    fake.rows = [("Élèves de la Classe 1ERE S2", "f1700ivg"), ("Élèves de la Classe 1ERE S3", None)]
+    rows = list(db.iter_filtered_cohorts_members(3, 'Élèves de la Classe %'))
+    assert rows == [("Élèves de la Classe 1ERE S2", "f1700ivg"), ("Élèves de la Classe 1ERE S3", None)]
+    # La purge en attente est exécutée sur la connexion principale avant la lecture, qui la voit
+    assert [call[1].split()[0] for call in fake.calls] == ['DELETE', 'SELECT']
+
+
+def test_get_valid_users_absent_from():
+    db = Database(DatabaseConfig(entete="mdl_"), ConstantesConfig())
+    db.mark = FakeCursor()
+    connection = FakeConnection()
+    db._open_connection = lambda: connection
+    rows = db.get_valid_users_absent_from(iter(["F1700IVG"]))
+    assert connection.cursors == []
+
+    cursor = FakeCursor()
+    cursor.rows = [(1, "f1700abc", 0)]
+    connection.cursor = lambda: cursor
+    assert list(rows) == [(1, "f1700abc", 0)]
+    assert [call[1].split(' ')[0] for call in cursor.calls] == ['DROP', 'CREATE', 'INSERT', 'SELECT']
+    assert cursor.calls[2][2] == {'username_0': "f1700ivg"}
+    assert db.mark.calls == []
+
+def test_infile_line():
+    assert infile_line((1, None, "a\tb\\c\nd")) == "1\t\\N\ta\\tb\\\\c\\nd\n"
+
+
+def test_stage_rows(monkeypatch):
+    monkeypatch.setattr(dbutils, 'STAGING_CHUNK_SIZE', 2)
+    db = Database(DatabaseConfig(entete="mdl_"), ConstantesConfig())
+    db.mark = FakeCursor()
+    table = db.create_staging_table('usernames', 'user', ('username',))
+    assert table == "mdl_staging_usernames"
+    assert db.stage_rows(table, ('username',), iter([("a",), ("b",), ("c",)])) == 3
+    assert [call[1] for call in db.mark.calls] == [
+        "DROP TEMPORARY TABLE IF EXISTS mdl_staging_usernames",
+        "CREATE TEMPORARY TABLE mdl_staging_usernames (PRIMARY KEY (username)) SELECT username FROM mdl_user LIMIT 0",
+        "INSERT IGNORE INTO mdl_staging_usernames (username) VALUES (%(username_0)s), (%(username_1)s)",
+        "INSERT IGNORE INTO mdl_staging_usernames (username) VALUES (%(username_0)s)",
+    ]
+    assert db.mark.calls[3][2] == {'username_0': "c"}
+
+
+def test_pool(docker_config: Config):
+    config = DatabaseConfig(**docker_config.database.__dict__)
+    config.pool_size = 1
+    db = Database(config, docker_config.constantes)
+    db.connect()
+    connection_id = db.connection.connection_id
+    db.disconnect()
+
+    other = Database(config, docker_config.constantes)
+    other.connect()
+    try:
+        assert other.connection.connection_id == connection_id
+    finally:
+        other.disconnect()
+        close_pools()
+
+
+def test_reconcile_cohort_members(docker_config: Config):
+    db = Database(docker_config.database, docker_config.constantes)
+    db_utils.init(db)
+    db.connect()
+    try:
+        db.insert_cohort_member_rows([(1, 10), (4, 10), (4, 11)], 0)
+        counts = db.reconcile_cohort_members([(1, 10), (2, 10), (3, 11)], {10: {1, 2}}, 0)
+        assert counts == {2: [1, 0], 3: [1, 0], 4: [0, 1]}
+        assert db.get_cohort_member_rows([1, 2, 3, 4], []) == {(1, 10), (2, 10), (3, 11), (4, 11)}
+    finally:
+        db.disconnect()
@@ -6,8 +6,8 @@ import pytest
 from ldap3 import Connection
 
 from synchromoodle import ldaputils
-from synchromoodle.config import Config
-from synchromoodle.ldaputils import Ldap, StructureLdap, PersonneLdap, EleveLdap, EnseignantLdap
+from synchromoodle.config import Config, LdapConfig
+from synchromoodle.ldaputils import Ldap, StructureLdap, PersonneLdap, EleveLdap, EnseignantLdap, EtablissementsIndex
 from test.utils import ldap_utils
 
 datetime_value = datetime(2019, 4, 9, 21, 42, 1)
@@ -46,19 +46,46 @@ def test_structures_empty(ldap: Ldap):
     ldap.disconnect()
 
 
+def test_structures_cache(ldap: Ldap):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    structures = ldap.get_structures()
+    assert len(structures) == 2
+    assert ldap.get_structure("0290009c") is structures["0290009C"]
+    ldap.connection.delete(structures["0290009C"].dn)
+    assert ldap.get_structure("0290009C") is structures["0290009C"]
+    ldaputils.invalidate_structures_cache()
+    assert ldap.get_structure("0290009C") is None
+    assert set(ldap.get_domaines_etabs().keys()) == {"0291595B"}
+    ldap.disconnect()
+
+
 def test_personnes(ldap: Ldap):
     ldap.connect()
     ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
-    personnes = ldap.search_personne()
+    personnes = list(ldap.search_personne())
     assert len(personnes) == 77
     for person in personnes:
         assert isinstance(person, PersonneLdap)
     ldap.disconnect()
 
 
-def test_personnes_empty(ldap: Ldap):
+def test_personnes_paged(ldap: Ldap):
+    ldap = Ldap(LdapConfig(**ldap.config.__dict__))
+    ldap.config.page_size = 10
     ldap.connect()
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
     personnes = ldap.search_personne()
+    assert not isinstance(personnes, list)
+    uids = [personne.uid for personne in personnes]
+    assert len(uids) == 77
+    assert len(set(uids)) == 77
+    ldap.disconnect()
+
+
+def test_personnes_empty(ldap: Ldap):
+    ldap.connect()
+    personnes = list(ldap.search_personne())
     assert len(personnes) == 0
     ldap.disconnect()
 
@@ -66,7 +93,7 @@ def test_personnes_empty(ldap: Ldap):
 def test_eleves(ldap: Ldap):
     ldap.connect()
     ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
-    eleves = ldap.search_eleve()
+    eleves = list(ldap.search_eleve())
     assert len(eleves) > 0
     for student in eleves:
         assert isinstance(student, EleveLdap)
@@ -75,7 +102,7 @@ def test_eleves(ldap: Ldap):
 
 def test_eleves_empty(ldap: Ldap):
     ldap.connect()
-    eleves = ldap.search_eleve()
+    eleves = list(ldap.search_eleve())
     assert len(eleves) == 0
     ldap.disconnect()
 
@@ -83,7 +110,7 @@ def test_eleves_empty(ldap: Ldap):
 def test_teachers(ldap: Ldap):
     ldap.connect()
     ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
-    enseignants = ldap.search_enseignant()
+    enseignants = list(ldap.search_enseignant())
     assert len(enseignants) > 0
     for enseignant in enseignants:
         assert isinstance(enseignant, EnseignantLdap)
@@ -92,11 +119,145 @@ def test_teachers(ldap: Ldap):
 
 def test_teachers_empty(ldap: Ldap):
     ldap.connect()
-    enseignants = ldap.search_enseignant()
+    enseignants = list(ldap.search_enseignant())
     assert len(enseignants) == 0
     ldap.disconnect()
 
 
+def test_prefetch(ldap: Ldap):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    index = ldap.prefetch(["0290009C", "0291595B"])
+    for uai in ["0290009C", "0291595B"]:
+        assert uai in index
+        assert isinstance(index.get_structure(uai), StructureLdap)
+        assert {eleve.uid for eleve in index.get_eleves(uai)} == \
+            {eleve.uid for eleve in ldap.search_eleve(uai=uai)}
+        assert {enseignant.uid for enseignant in index.get_enseignants(uai)} == \
+            {enseignant.uid for enseignant in ldap.search_enseignant(uai=uai)}
+    assert "0000000A" not in index
+    ldap.disconnect()
+
+
+def test_personne_immuable(ldap: Ldap):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    eleves = list(ldap.search_eleve(uai="0290009C"))
+    eleve = eleves[0]
+    with pytest.raises(AttributeError):
+        eleve.mail = "autre@netocentre.fr"
+    copie = eleve.evolve(mail="autre@netocentre.fr")
+    assert copie.mail == "autre@netocentre.fr"
+    assert eleve.mail != copie.mail
+    assert copie.uid == eleve.uid
+    assert copie.classe.classe == eleve.classe.classe
+    assert eleves[0].classes[0].etab_dn is eleves[1].classes[0].etab_dn
+    with pytest.raises(AttributeError):
+        eleve.evolve(inconnu="valeur")
+    ldap.disconnect()
+
+
+
+def test_fingerprint_values(ldap: Ldap):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    eleve = list(ldap.search_eleve(uai="0290009C"))[0]
+    values = eleve.fingerprint_values()
+    assert values['uid'] == eleve.uid
+    assert values['niveau_formation'] == eleve.niveau_formation
+    assert [classe.classe for classe in ldaputils.extraire_classes_ldap(values['classes'])] == \
+           [classe.classe for classe in eleve.classes]
+    enseignant = list(ldap.search_enseignant(uai="0290009C"))[0]
+    assert enseignant.fingerprint_values()['profils'] == enseignant.profils
+    ldap.disconnect()
+
+def test_prefetch_pool(ldap: Ldap):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    ldap.disconnect()
+    pool_ldap = Ldap(LdapConfig(**ldap.config.__dict__))
+    pool_ldap.config.pool_size = 3
+    pool_ldap.config.prefetch_batch_size = 1
+    pool_ldap.connect()
+    index = pool_ldap.prefetch(["0290009C", "0291595B"])
+    for uai in ["0290009C", "0291595B"]:
+        assert index.get_structure(uai).uai == uai
+        assert {eleve.uid for eleve in index.get_eleves(uai)} == \
+            {eleve.uid for eleve in pool_ldap.search_eleve(uai=uai)}
+        assert {enseignant.uid for enseignant in index.get_enseignants(uai)} == \
+            {enseignant.uid for enseignant in pool_ldap.search_enseignant(uai=uai)}
+    pool_ldap.disconnect()
+
+
+def test_classes_index(ldap: Ldap):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    structure = ldap.search_structure("0290009C")[0]
+    index = ldap.search_classes_index("0290009C", structure.dn)
+    assert len(index.eleves_by_classe) == 9
+    for classe, uids in index.eleves_by_classe.items():
+        assert uids == {eleve.uid.lower() for eleve in ldap.search_eleves_in_classe(classe, "0290009C")}
+    assert len(index.eleves_by_classe["TS2"]) == 8
+    assert len(index.eleves_by_niveau_formation["TERMINALE GENERALE & TECHNO YC BT"]) == 70
+    assert index.enseignants == {'f1700jym', 'f1700jz1'}
+    assert index.enseignants_by_classe["TES1"] == {'f1700jym', 'f1700jz1'}
+    assert index.enseignants_by_classe["1ERE ES2"] == {'f1700jym'}
+    ldap.disconnect()
+
+
+def test_sync_eleve(ldap: Ldap):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    result = ldap.sync_eleve("0290009C")
+    assert result.cookie
+    assert {eleve.uid for _, eleve in result.changed} == {eleve.uid for eleve in ldap.search_eleve(uai="0290009C")}
+    known_uids = result.known_uids({})
+    assert len(known_uids) == len(result.changed)
+
+    ldap.connection.delete('uid=F1700ivg,ou=people,dc=esco-centre,dc=fr')
+    ldap.connection.modify('uid=F1700ivh,ou=people,dc=esco-centre,dc=fr', {'sn': [('MODIFY_REPLACE', ['Modifié'])]})
+    result = ldap.sync_eleve("0290009C", result.cookie)
+    assert [eleve.uid for _, eleve in result.changed] == ['F1700ivh']
+    assert result.deleted_uids(known_uids) == {'f1700ivg'}
+    assert 'f1700ivg' not in result.known_uids(known_uids).values()
+    ldap.disconnect()
+
+
+def test_personnes_uid_only(ldap: Ldap):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    personnes = list(ldap.search_personne(profil='uid-only'))
+    assert {personne.uid for personne in personnes} == {personne.uid for personne in ldap.search_personne()}
+    for personne in personnes:
+        assert personne.sn is None
+        assert personne.is_member_of is None
+    ldap.disconnect()
+
+
+def test_etablissements_index_release():
+    index = EtablissementsIndex(["0290009C", "0291595B"])
+    assert "0290009c" in index
+    index.release("0290009C")
+    assert "0290009C" not in index
+    assert index.get_eleves("0290009C") == []
+    index.update(EtablissementsIndex(["0290009C"]))
+    assert "0290009C" in index and "0291595B" in index
+    assert index.uais == ["0290009C", "0291595B"]
+
+
+def test_get_attributs():
+    assert ldaputils.get_attributs('uid-only') == ['uid']
+    assert ldaputils.get_attributs('uid-only', operationnels=True) == ['uid', 'modifyTimeStamp', 'entryCSN']
+    for attributs in ldaputils.PROFILS_ATTRIBUTS.values():
+        assert '+' not in attributs
+
+
 def test_get_filtre_eleves():
     assert ldaputils._get_filtre_eleves() == \
            "(&(objectClass=ENTEleve))"
@@ -105,6 +266,9 @@ def test_get_filtre_eleves():
         "(&(objectClass=ENTEleve)(modifyTimeStamp>=20190409214201Z))"
     assert ldaputils._get_filtre_eleves(since_timestamp=datetime_value, uai="other-uai") == \
         "(&(objectClass=ENTEleve)(ESCOUAI=other-uai)(modifyTimeStamp>=20190409214201Z))"
+    assert ldaputils._get_filtre_eleves(uai=["some-uai"]) == "(&(objectClass=ENTEleve)(ESCOUAI=some-uai))"
+    assert ldaputils._get_filtre_eleves(uai=["some-uai", "other-uai"]) == \
+        "(&(objectClass=ENTEleve)(|(ESCOUAI=some-uai)(ESCOUAI=other-uai)))"
 
 
 def test_get_filtre_etablissement():
@@ -113,6 +277,10 @@ def test_get_filtre_etablissement():
                                                               "(ENTStructureUAI=0290009C))"
     assert ldaputils._get_filtre_etablissement() == "(&(ObjectClass=ENTEtablissement)" \
                                                     "(!(ENTStructureSiren=0000000000000A)))"
+    assert ldaputils._get_filtre_etablissement(["0290009C", "0291595B"]) == \
+        "(&(ObjectClass=ENTEtablissement)" \
+        "(!(ENTStructureSiren=0000000000000A))" \
+        "(|(ENTStructureUAI=0290009C)(ENTStructureUAI=0291595B)))"
 
 
 def test_get_filtre_personnes():
@@ -0,0 +1,51 @@
+# coding: utf-8
+import os
+
+import pytest
+
+from synchromoodle import ldaputils
+from synchromoodle.config import Config, LdapConfig
+from synchromoodle.ldaputils import Ldap
+from synchromoodle.snapshot import write_snapshot, read_snapshot, SnapshotLdap, open_ldap
+from test.utils import ldap_utils
+
+
+@pytest.fixture(scope='function')
+def ldap(docker_config: Config):
+    ldap = Ldap(docker_config.ldap)
+    ldap_utils.reset(ldap)
+    return ldap
+
+
+def test_write_read_snapshot(tmpdir):
+    path = os.path.join(str(tmpdir), 'snapshot.jsonl.gz')
+    entries = [("uid=F1700ivg,ou=people,dc=esco-centre,dc=fr", {'uid': [b'F1700ivg'], 'sn': ['Élève'], 'mail': []})]
+    assert write_snapshot(path, entries) == 1
+    assert list(read_snapshot(path)) == \
+        [("uid=F1700ivg,ou=people,dc=esco-centre,dc=fr", {'uid': ['F1700ivg'], 'sn': ['Élève']})]
+
+
+def test_open_ldap():
+    assert type(open_ldap(LdapConfig())) is Ldap
+    assert isinstance(open_ldap(LdapConfig(snapshot='snapshot.jsonl')), SnapshotLdap)
+
+
+def test_snapshot_replay(ldap: Ldap, tmpdir):
+    ldap.connect()
+    ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+    ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+    path = os.path.join(str(tmpdir), 'snapshot.jsonl.gz')
+    write_snapshot(path, ldap.dump(["0290009C", "0291595B"]))
+
+    snapshot_ldap = SnapshotLdap(LdapConfig(**ldap.config.__dict__), path)
+    snapshot_ldap.connect()
+    ldaputils.invalidate_structures_cache()
+    assert sorted(structure.uai for structure in snapshot_ldap.search_structure()) == \
+        sorted(structure.uai for structure in ldap.search_structure())
+    for uai in ["0290009C", "0291595B"]:
+        assert sorted(repr(eleve) for eleve in snapshot_ldap.search_eleve(uai=uai)) == \
+            sorted(repr(eleve) for eleve in ldap.search_eleve(uai=uai))
+        assert sorted(repr(enseignant) for enseignant in snapshot_ldap.search_enseignant(uai=uai)) == \
+            sorted(repr(enseignant) for enseignant in ldap.search_enseignant(uai=uai))
+    snapshot_ldap.disconnect()
+    ldap.disconnect()
@@ -2,10 +2,12 @@
 
 import pytest
 import platform
-from synchromoodle.config import Config, ActionConfig
+from synchromoodle.config import Config, ActionConfig, FingerprintStoreConfig
 from synchromoodle.dbutils import Database
 from synchromoodle.ldaputils import Ldap
-from synchromoodle.synchronizer import Synchronizer
+from synchromoodle.synchronizer import Synchronizer, AdminsLocauxIndex, RoleAssignments, CohortMemberships, \
+    ProfileFields, UserChanges, ChangePlan, PlannedIds
+from synchromoodle.timestamp import FingerprintStore
 from test.utils import db_utils, ldap_utils
 
 
@@ -23,6 +25,91 @@ def ldap(docker_config: Config):
     return ldap
 
 
+def test_admins_locaux_index():
+    index = AdminsLocauxIndex("(esco|clg37):admin:Moodle:local:.*_0290009C$")
+    index.add(1, ["esco:admin:Moodle:local:Lycee_0290009c", "esco:Etablissements:Lycee_0290009C"], "admin")
+    index.add(2, ["esco:Etablissements:Lycee_0290009C"], "enseignant")
+    index.add(3, [], "sans groupe")
+    index.add(4, None, "sans groupe")
+    assert index.admins() == {1}
+    assert index.non_admins() == {2}
+    assert index.users_by_groupe["esco:Etablissements:Lycee_0290009C"] == {1, 2}
+
+
+def test_role_assignments():
+    role_assignments = RoleAssignments()
+    role_assignments.add(2, 3, 10)
+    role_assignments.add(5, 1184278, 10)
+    role_assignments.remove(14, 1, 11)
+    role_assignments.add(14, 1, 11)
+    role_assignments.remove(2, 3, 12)
+    assert list(role_assignments.added) == [(2, 3, 10), (5, 1184278, 10), (14, 1, 11)]
+    assert list(role_assignments.removed) == [(2, 3, 12)]
+    assert role_assignments.users() == {10, 11, 12}
+    assert role_assignments.roles() == {2, 5, 14}
+
+
+def test_cohort_memberships():
+    cohort_memberships = CohortMemberships()
+    cohort_memberships.add(1, 10)
+    cohort_memberships.add(2, 10)
+    cohort_memberships.restrict(10, [1, 2])
+    cohort_memberships.add(3, 11)
+    assert cohort_memberships.cohorts() == {1, 2, 3}
+    inserts, deletes = cohort_memberships.diff({(1, 10), (4, 10), (5, 10), (4, 11)})
+    assert inserts == [(2, 10), (3, 11)]
+    assert deletes == [(4, 10), (5, 10)]
+
+
+def test_profile_fields():
+    profile_fields = ProfileFields()
+    profile_fields.set(10, 1, "4A")
+    profile_fields.set(10, 2, "lycees.netocentre.fr")
+    profile_fields.set(11, 1, "4B")
+    profile_fields.set(11, 1, "4C")
+    assert profile_fields.users() == {10, 11}
+    assert profile_fields.fields() == {1, 2}
+    assert profile_fields.diff({(10, 1): "4A", (10, 2): "clg37.fr"}) == \
+        [(10, 2, "lycees.netocentre.fr"), (11, 1, "4C")]
+
+
+def test_user_changes():
+    users = UserChanges()
+    users.set(10, "F1700ivg", "Dorian", "Meyer", "dorian.meyer@netocentre.fr", 2, "0290009c")
+    users.set(11, "f1700ivh", "Léa", "Martin", "lea.martin@netocentre.fr", 2, "0290009c")
+    assert users.diff({10: ("Dorian", "Meyer", "dorian.meyer@netocentre.fr", 2, "0290009c"),
+                       11: ("Léa", "Durand", "lea.martin@netocentre.fr", 2, "0290009c")}) == \
+        [(11, "Léa", "Martin", "lea.martin@netocentre.fr", 2, "0290009c")]
+    assert users.usernames[10] == "f1700ivg"
+
+
+def test_change_plan():
+    plan = ChangePlan("0290009C")
+    plan.users_inserted.append("f1700ivg")
+    plan.role_grants.append((5, 3, 10))
+    assert list(plan.to_dict()) == list(ChangePlan.FIELDS)
+    assert plan.to_dict()['role_grants'] == [(5, 3, 10)]
+    assert plan.counts() == {'structure_changes': 0, 'users_inserted': 1, 'users_updated': 0, 'cohorts_created': 0,
+                             'role_grants': 1, 'role_revocations': 0, 'role_deletions': 0, 'cohort_adds': 0,
+                             'cohort_removes': 0, 'course_enrolments': 0, 'field_updates': 0}
+
+
+def test_planned_ids():
+    planned_ids = PlannedIds()
+    id_user, id_cohort = planned_ids.allocate(), planned_ids.allocate()
+    assert planned_ids.planned(id_user) and planned_ids.planned(id_cohort)
+    assert not planned_ids.planned(10) and not planned_ids.planned(None)
+    planned_ids.bind(id_user, 42)
+    assert planned_ids.resolve_row((id_cohort, id_user)) == (id_cohort, 42)
+
+    cohort_memberships = CohortMemberships()
+    cohort_memberships.add(7, id_user)
+    cohort_memberships.restrict(id_user, [7])
+    resolved = cohort_memberships.resolve(planned_ids)
+    assert list(resolved.added) == [(7, 42)]
+    assert resolved.cohorts_by_user == {42: {7}}
+
+
 class TestEtablissement:
     @pytest.fixture(autouse=True)
     def manage_ldap(self, ldap: Ldap):
@@ -69,6 +156,10 @@ class TestEtablissement:
         structure = ldap.get_structure("0290009C")
         assert structure is not None
         etab_context = synchronizer.handle_etablissement(structure.uai)
+        assert etab_context.structure.names() == ['categorie', 'zone_privee', 'forum']
+        assert db.get_id_course_category_by_theme("0290009c") is None
+        synchronizer.apply_plan(etab_context)
+        assert etab_context.plan.structure_changes == ['categorie', 'zone_privee', 'forum']
         assert etab_context.uai == "0290009C"
         assert etab_context.gere_admin_local is True
         assert etab_context.etablissement_regroupe is False
@@ -99,10 +190,11 @@ class TestEtablissement:
         synchronizer = Synchronizer(ldap, db, config)
         synchronizer.initialize()
         structure = ldap.get_structure("0290009C")
-        eleves = ldap.search_eleve(None, "0290009C")
+        eleves = list(ldap.search_eleve(None, "0290009C"))
         eleve = eleves[1]
         etab_context = synchronizer.handle_etablissement(structure.uai)
         synchronizer.handle_eleve(etab_context, eleve)
+        synchronizer.apply_plan(etab_context)
 
         db.mark.execute("SELECT * FROM {entete}user WHERE username = %(username)s".format(entete=db.entete),
                         params={
@@ -138,6 +230,48 @@ class TestEtablissement:
             assert result_cohort_enrollment is not None
             assert result_cohort_enrollment[2] == eleve_id
 
+    def test_fingerprint_eleve(self, ldap: Ldap, db: Database, config: Config, tmpdir):
+        ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+        ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+        db_utils.run_script('data/default-context.sql', db, connect=False)
+
+        fingerprint_store = FingerprintStore(FingerprintStoreConfig(file=str(tmpdir.join('fingerprints.sqlite'))))
+        synchronizer = Synchronizer(ldap, db, config, fingerprint_store=fingerprint_store)
+        synchronizer.initialize()
+        eleve = list(ldap.search_eleve(None, "0290009C"))[1]
+        synchronizer.apply_plan(synchronizer.handle_etablissement("0290009C"))
+        etab_context = synchronizer.handle_etablissement("0290009C")
+        synchronizer.handle_eleve(etab_context, eleve)
+        assert etab_context.profile_fields.users()
+        synchronizer.apply_plan(etab_context)
+        fingerprint_store.mark("0290009C")
+
+        etab_context = synchronizer.handle_etablissement("0290009C")
+        synchronizer.handle_eleve(etab_context, eleve)
+        assert not etab_context.profile_fields.users()
+
+        synchronizer.handle_eleve(etab_context, eleve.evolve(sn="Martin"))
+        assert etab_context.profile_fields.users()
+        fingerprint_store.close()
+
+    def test_enseignant_theme(self, ldap: Ldap, db: Database, config: Config):
+        ldap_utils.run_ldif('data/default-structures.ldif', ldap)
+        ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
+        db_utils.run_script('data/default-context.sql', db, connect=False)
+
+        synchronizer = Synchronizer(ldap, db, config)
+        synchronizer.initialize()
+        enseignants = list(ldap.search_enseignant(None, "0290009C"))
+        etab_context = synchronizer.handle_etablissement("0290009C")
+        sans_uai_courant = enseignants[0].evolve(uai_courant=None)
+        values = synchronizer.get_fingerprint_values(etab_context, sans_uai_courant)
+        for enseignant in enseignants:
+            synchronizer.handle_enseignant(etab_context, enseignant.evolve(uai_courant="0291595B"))
+        assert etab_context.etablissement_theme == "0290009c"
+        assert synchronizer.get_fingerprint_values(etab_context, sans_uai_courant) == values
+        users = etab_context.users
+        assert {row[-1] for row in list(users.inserts.values()) + list(users.values.values())} == {"0291595b"}
+
     def test_maj_enseignant(self, ldap: Ldap, db: Database, config: Config):
         ldap_utils.run_ldif('data/default-structures.ldif', ldap)
         ldap_utils.run_ldif('data/default-personnes-short.ldif', ldap)
@@ -147,10 +281,11 @@ class TestEtablissement:
         synchronizer = Synchronizer(ldap, db, config)
         synchronizer.initialize()
         structure = ldap.get_structure("0290009C")
-        enseignants = ldap.search_enseignant(None, "0290009C")
+        enseignants = list(ldap.search_enseignant(None, "0290009C"))
         enseignant = enseignants[1]
         etab_context = synchronizer.handle_etablissement(structure.uai)
         synchronizer.handle_enseignant(etab_context, enseignant)
+        synchronizer.apply_plan(etab_context)
 
         db.mark.execute("SELECT * FROM {entete}user WHERE username = %(username)s".format(entete=db.entete),
                         params={
@@ -163,6 +298,7 @@ class TestEtablissement:
         assert result[12] == 'noreply@ac-rennes.fr'
         assert result[27] == '0290009c'
         enseignant_id = result[0]
+        assert db.users_ids[str(enseignant.uid).lower()] == enseignant_id
 
         db.mark.execute("SELECT * FROM {entete}role_assignments WHERE userid = %(userid)s".format(entete=db.entete),
                         params={
@@ -185,7 +321,7 @@ class TestEtablissement:
 
         synchronizer = Synchronizer(ldap, db, config)
         synchronizer.initialize()
-        users = ldap.search_personne()
+        users = list(ldap.search_personne())
         user = users[0]
         synchronizer.handle_user_interetab(user)
 
@@ -211,10 +347,10 @@ class TestEtablissement:
 
         synchronizer = Synchronizer(ldap, db, config)
         synchronizer.initialize()
-        users = ldap.search_personne()
-        user = users[0]
-        user.is_member_of = [action_config.inter_etablissements.ldap_valeur_attribut_admin]
+        users = list(ldap.search_personne())
+        user = users[0].evolve(is_member_of=[action_config.inter_etablissements.ldap_valeur_attribut_admin])
         synchronizer.handle_user_interetab(user)
+        synchronizer.handle_admins_interetab()
 
         db.mark.execute("SELECT * FROM {entete}user WHERE username = %(username)s".format(entete=db.entete),
                         params={
@@ -238,7 +374,7 @@ class TestEtablissement:
 
         synchronizer = Synchronizer(ldap, db, config)
         synchronizer.initialize()
-        users = ldap.search_personne()
+        users = list(ldap.search_personne())
         user = users[0]
         synchronizer.handle_inspecteur(user)
 
@@ -275,11 +411,12 @@ class TestEtablissement:
         synchronizer.initialize()
         college = ldap.get_structure("0291595B")
         lycee = ldap.get_structure("0290009C")
-        eleves = ldap.search_eleve(None, "0291595B")
+        eleves = list(ldap.search_eleve(None, "0291595B"))
         eleve = eleves[0]
         college_context = synchronizer.handle_etablissement(college.uai)
         lycee_context = synchronizer.handle_etablissement(lycee.uai)
         synchronizer.handle_eleve(college_context, eleve)
+        synchronizer.apply_plan(college_context)
 
         db.mark.execute("SELECT * FROM {entete}user WHERE username = %(username)s".format(entete=db.entete),
                         params={
@@ -295,8 +432,9 @@ class TestEtablissement:
         assert len(roles_results) == 1
         assert roles_results[0][1] == 14
 
-        eleve.uai_courant = "0290009C"
+        eleve = eleve.evolve(uai_courant="0290009C")
         synchronizer.handle_eleve(lycee_context, eleve)
+        synchronizer.apply_plan(lycee_context)
         db.mark.execute("SELECT * FROM {entete}role_assignments WHERE userid = %(userid)s".format(entete=db.entete),
                         params={
                             'userid': eleve_id
@@ -313,9 +451,10 @@ class TestEtablissement:
         synchronizer = Synchronizer(ldap, db, config)
         synchronizer.initialize()
         etab_context = synchronizer.handle_etablissement("0290009C")
-        eleves = ldap.search_eleve(None, "0290009C")
+        eleves = list(ldap.search_eleve(None, "0290009C"))
         for eleve in eleves:
             synchronizer.handle_eleve(etab_context, eleve)
+        synchronizer.apply_plan(etab_context)
 
         eleves_by_cohorts_db, eleves_by_cohorts_ldap = \
             synchronizer.get_users_by_cohorts_comparators(etab_context, r'(Élèves de la Classe )(.*)$',
@@ -367,14 +506,15 @@ class TestEtablissement:
         synchronizer.initialize()
         etab_context = synchronizer.handle_etablissement("0290009C")
 
-        ldap_eleves = ldap.search_eleve(uai="0290009C")
-        ldap_enseignants = ldap.search_enseignant(uai="0290009C")
+        ldap_eleves = list(ldap.search_eleve(uai="0290009C"))
+        ldap_enseignants = list(ldap.search_enseignant(uai="0290009C"))
         for eleve in ldap_eleves:
             synchronizer.handle_eleve(etab_context, eleve)
         for enseignant in ldap_enseignants:
             synchronizer.handle_enseignant(etab_context, enseignant)
+        synchronizer.apply_plan(etab_context)
 
-        ldap_users = ldap.search_personne()
+        ldap_users = list(ldap.search_personne())
         db_valid_users = db.get_all_valid_users()
 
         users_to_anon = []
@@ -435,14 +575,15 @@ class TestEtablissement:
         synchronizer.initialize()
         etab_context = synchronizer.handle_etablissement("0290009C")
 
-        ldap_eleves = ldap.search_eleve(uai="0290009C")
-        ldap_enseignants = ldap.search_enseignant(uai="0290009C")
+        ldap_eleves = list(ldap.search_eleve(uai="0290009C"))
+        ldap_enseignants = list(ldap.search_enseignant(uai="0290009C"))
         enseignant = ldap_enseignants[0]
         enseignant2 = ldap_enseignants[1]
         for eleve in ldap_eleves:
             synchronizer.handle_eleve(etab_context, eleve)
         for enseignant in ldap_enseignants:
             synchronizer.handle_enseignant(etab_context, enseignant)
+        synchronizer.apply_plan(etab_context)
 
         db.mark.execute("SELECT id FROM {entete}user WHERE username = %(username)s".format(entete=db.entete), params={
             'username': str(enseignant.uid).lower()
@@ -0,0 +1,80 @@
+import uuid
+
+from pyasn1.codec.ber import encoder
+
+from synchromoodle import syncrepl
+
+
+class _Personne:
+    def __init__(self, uid):
+        self.uid = uid
+
+
+def _uuid():
+    return str(uuid.uuid4())
+
+
+def test_encode_sync_request():
+    assert syncrepl.encode_sync_request() == bytes.fromhex('30030a0101')
+    assert syncrepl.encode_sync_request(b'cookie') == bytes.fromhex('300b0a01010406636f6f6b6965')
+
+
+def test_decode_sync_state():
+    entry_uuid = uuid.uuid4()
+    value = syncrepl._SyncStateValue()
+    value['state'] = syncrepl.SYNC_STATE_DELETE
+    value['entryUUID'] = entry_uuid.bytes
+    assert syncrepl.decode_sync_state(encoder.encode(value)) == \
+        (syncrepl.SYNC_STATE_DELETE, str(entry_uuid), None)
+    value['cookie'] = b'cookie'
+    assert syncrepl.decode_sync_state(encoder.encode(value)) == \
+        (syncrepl.SYNC_STATE_DELETE, str(entry_uuid), b'cookie')
+
+
+def test_decode_sync_done():
+    assert syncrepl.decode_sync_done(None) == (None, False)
+    value = syncrepl._SyncDoneValue()
+    value['cookie'] = b'cookie'
+    value['refreshDeletes'] = True
+    assert syncrepl.decode_sync_done(encoder.encode(value)) == (b'cookie', True)
+
+
+def test_decode_sync_info():
+    entry_uuid = uuid.uuid4()
+    value = syncrepl._SyncInfoValue()
+    id_set = value.getComponentByName('syncIdSet')
+    id_set['refreshDeletes'] = True
+    id_set['syncUUIDs'].extend([entry_uuid.bytes])
+    assert syncrepl.decode_sync_info(encoder.encode(value)) == ('syncIdSet', None, True, [str(entry_uuid)])
+
+    value = syncrepl._SyncInfoValue()
+    value['newcookie'] = b'cookie'
+    assert syncrepl.decode_sync_info(encoder.encode(value)) == ('newcookie', b'cookie', False, [])
+
+
+def test_sync_result_refresh_deletes():
+    kept, deleted, added = _uuid(), _uuid(), _uuid()
+    known = {kept: 'f1700ivg', deleted: 'f1700ivl'}
+    result = syncrepl.SyncResult()
+    result.refresh_deletes = True
+    result.deleted[deleted] = None
+    result.changed.append((added, _Personne('F1700IVV')))
+    assert result.deleted_uids(known) == {'f1700ivl'}
+    assert result.known_uids(known) == {kept: 'f1700ivg', added: 'f1700ivv'}
+
+
+def test_sync_result_present_phase():
+    present, deleted, modified = _uuid(), _uuid(), _uuid()
+    known = {present: 'f1700ivg', deleted: 'f1700ivl', modified: 'f1700ivv'}
+    result = syncrepl.SyncResult()
+    result.present.add(present)
+    result.changed.append((modified, _Personne('f1700ivv')))
+    assert result.deleted_uids(known) == {'f1700ivl'}
+    assert result.known_uids(known) == {present: 'f1700ivg', modified: 'f1700ivv'}
+
+
+def test_sync_result_deleted_dn():
+    result = syncrepl.SyncResult()
+    result.refresh_deletes = True
+    result.deleted[_uuid()] = syncrepl._uid_from_dn('uid=F1700IVG,ou=people,dc=esco-centre,dc=fr')
+    assert result.deleted_uids({}) == {'f1700ivg'}
@@ -4,7 +4,7 @@ import tempfile
 import pytest
 
 from synchromoodle import timestamp
-from synchromoodle.config import TimestampStoreConfig
+from synchromoodle.config import TimestampStoreConfig, SyncCookieStoreConfig, FingerprintStoreConfig
 
 
 @pytest.fixture(name='tmp_file')
@@ -35,3 +35,52 @@ def test_read_write(tmp_file):
     ts1.write()
     ts2.read()
     assert ts2.get_timestamp("UAI2") == ts1.now
+
+
+def test_sync_cookie_read_write(tmp_file):
+    store1 = timestamp.SyncCookieStore(SyncCookieStoreConfig(file=tmp_file))
+    store2 = timestamp.SyncCookieStore(SyncCookieStoreConfig(file=tmp_file))
+    assert store1.get_cookie("UAI/eleves") is None
+    assert store1.get_uids("UAI/eleves") == {}
+
+    store1.mark("UAI/eleves", b"rid=000,csn=20190409214201.000000Z#000000#000#000000", {"uuid1": "f1700ivg"})
+    store1.mark("UAI/enseignants", None, {})
+    store1.write()
+    store2.read()
+    assert store2.get_cookie("uai/eleves") == b"rid=000,csn=20190409214201.000000Z#000000#000#000000"
+    assert store2.get_uids("UAI/eleves") == {"uuid1": "f1700ivg"}
+    assert store2.get_cookie("UAI/enseignants") is None
+
+
+def test_fingerprint_store(tmp_file):
+    store1 = timestamp.FingerprintStore(FingerprintStoreConfig(file=tmp_file))
+    fields = timestamp.fingerprint_fields({'sn': "Élève", 'classes': ["1ERE S2"]})
+    assert store1.changed_fields("UAI", "F1700ivg", fields) == ['classes', 'sn']
+
+    store1.stage("UAI", "F1700ivg", fields)
+    assert store1.changed_fields("UAI", "F1700ivg", fields) == ['classes', 'sn']
+    store1.mark("uai")
+    store1.write()
+    assert store1.changed_fields("UAI", "f1700ivg", fields) == []
+
+    store2 = timestamp.FingerprintStore(FingerprintStoreConfig(file=tmp_file))
+    changed = timestamp.fingerprint_fields({'sn': "Élève", 'classes': ["TS1"]})
+    assert store2.changed_fields("UAI", "f1700ivg", changed) == ['classes']
+    assert store2.changed_fields("UAI2", "f1700ivg", changed) == ['classes', 'sn']
+    store1.close()
+    store2.close()
+
+
+def test_fingerprint_store_take(tmp_file):
+    worker_store = timestamp.FingerprintStore(FingerprintStoreConfig(file=tmp_file))
+    store = timestamp.FingerprintStore(FingerprintStoreConfig(file=tmp_file))
+    fields = timestamp.fingerprint_fields({'sn': "Élève"})
+    worker_store.stage("UAI", "f1700ivg", fields)
+    fingerprints = worker_store.take("uai")
+    assert fingerprints == {"f1700ivg": fields} and worker_store.take("UAI") == {}
+
+    store.mark("UAI", fingerprints)
+    store.write()
+    assert store.changed_fields("UAI", "f1700ivg", fields) == []
+    worker_store.close()
+    store.close()
@@ -37,6 +37,8 @@ def run_script(script: str, db: Database, connect=True):
             while db.mark.nextset():
                 pass
         db.connection.commit()
+        db.users_ids = None
+        db.cohorts_ids = None
     finally:
         if connect:
             db.disconnect()
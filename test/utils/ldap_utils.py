@@ -6,7 +6,7 @@ from ldap3 import Connection, LEVEL
 from ldap3.core.exceptions import LDAPNoSuchObjectResult
 
 import test.utils.ldif as ldif
-from synchromoodle.ldaputils import Ldap
+from synchromoodle.ldaputils import Ldap, invalidate_structures_cache
 
 
 def _remove_all_in(connection: Connection, dn: str):
@@ -28,6 +28,7 @@ def reset(l: Ldap):
         _remove_all_in(connection, l.config.structuresDN)
     finally:
         l.disconnect()
+    invalidate_structures_cache()
 
 
 class LDIFLoader(ldif.LDIFRecordList):
@@ -54,3 +55,4 @@ def run_ldif(path: str, ldap: Ldap):
     with StringIO(ldif_data) as ldif_file:
         loader = LDIFLoader(ldap.connection, ldif_file)
         loader.parse()
+    invalidate_structures_cache()